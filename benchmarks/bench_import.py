@@ -0,0 +1,70 @@
+"""
+Benchmark the cold-start cost of importing the seeder modules.
+
+Each module is imported in a fresh interpreter with `python -X importtime`, and the
+median wall time of the interpreter and the cumulative import time of the module
+(including its own imports) are reported over several runs.
+
+Usage:
+  python -m benchmarks.bench_import [--runs N] [module ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = [
+  'seeder.models',
+  'seeder.items',
+  'seeder.parsers',
+  'seeder.pipelines',
+  'seeder.middlewares',
+  'seeder.spiders.tennis_explorer_spider',
+]
+
+
+def import_time(module):
+  """
+  Return the wall time (s) of an interpreter importing the module, and the module's cumulative import time (s).
+  """
+  start = time.perf_counter()
+  proc = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+    capture_output=True,
+    text=True,
+    check=True,
+    env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'),
+  )
+  wall = time.perf_counter() - start
+  cumulative = 0
+  for line in proc.stderr.splitlines():
+    # Lines are formatted as: "import time: self [us] | cumulative | imported package"
+    fields = [f.strip() for f in line.split('|')]
+    if len(fields) == 3 and fields[2] == module:
+      cumulative = int(fields[1])
+  return wall, cumulative / 1e6
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('modules', nargs='*', default=MODULES)
+  args = parser.parse_args(argv)
+
+  for module in args.modules:
+    runs = [import_time(module) for _ in range(args.runs)]
+    result = {
+      'benchmark': 'import',
+      'module': module,
+      'runs': args.runs,
+      'wall_seconds': round(statistics.median(r[0] for r in runs), 4),
+      'import_seconds': round(statistics.median(r[1] for r in runs), 4),
+    }
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+  main()
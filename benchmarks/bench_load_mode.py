@@ -0,0 +1,120 @@
+"""
+Benchmark the rows/sec written by the DatabasePipeline in its 'incremental' and 'backfill' load modes.
+
+A synthetic backfill of match, player and odds items is written to a fresh sqlite database
+for each load mode; the timings include opening and closing the pipeline, i.e. dropping and
+rebuilding the indexes in the 'backfill' mode.
+
+Usage:
+  python -m benchmarks.bench_load_mode [--matches N] [--bookmakers N] [--ticks N] [--write-mode bulk]
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+import sqlalchemy
+from scrapy.signalmanager import SignalManager
+
+from seeder.extensions import rows_upserted
+from seeder.items import MatchItem, MatchOddsItem
+from seeder.models import PlayerType
+from seeder.pipelines import DatabasePipeline
+
+
+def make_items(num_matches, num_bookmakers, num_ticks, start=datetime.datetime(2020, 1, 1)):
+  """
+  Generate the items that a crawl of num_matches singles matches would produce.
+  """
+  for n in range(num_matches):
+    match_at = start + datetime.timedelta(minutes=10 * n)
+    yield MatchItem(
+      match_number=n,
+      tournament=f'/tournament-{n % 50}/2020/atp-men/',
+      match_at=match_at,
+      match_type=PlayerType.single,
+      is_win_p1=True,
+      is_win_p2=False,
+      p1=f'/player/player-{n % 2000}/',
+      p2=f'/player/player-{(n * 7 + 1) % 2000}/',
+      result_p1=2,
+      result_p2=0,
+    )
+    for b in range(num_bookmakers):
+      for t in range(num_ticks):
+        yield MatchOddsItem(
+          match_number=n,
+          issued_by=f'bookmaker-{b}',
+          issued_at=match_at - datetime.timedelta(hours=num_ticks - t),
+          index=t + 1,
+          index_rev=num_ticks - t,
+          is_opening=(t == 0),
+          is_closing=(t == num_ticks - 1),
+          odds_p1=1.5 + 0.01 * t,
+          odds_p2=2.5 - 0.01 * t,
+        )
+
+
+def run(load_mode, write_mode, num_matches, num_bookmakers, num_ticks):
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(tmp_dir, 'seeder.db')}")
+    spider = types.SimpleNamespace(logger=logging.getLogger('bench_load_mode'))
+    pipeline = DatabasePipeline(
+      engine=engine,
+      write_mode=write_mode,
+      load_mode=load_mode,
+      flush_size=5000,
+      flush_interval=None,
+    )
+    # Count the rows actually upserted (skipped dependencies & failed rows aren't written)
+    written = {'rows': 0}
+    def _rows_upserted(model, num_rows, seconds):
+      written['rows'] += num_rows
+    pipeline.signals = SignalManager()
+    pipeline.signals.connect(_rows_upserted, signal=rows_upserted)
+    num_items = 0
+    start = time.perf_counter()
+    pipeline.open_spider(spider)
+    for item in make_items(num_matches, num_bookmakers, num_ticks):
+      pipeline.process_item(item, spider)
+      num_items += 1
+    pipeline.close_spider(spider)
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+  return {
+    'benchmark': 'load_mode',
+    'load_mode': load_mode,
+    'write_mode': write_mode,
+    'items': num_items,
+    'rows': written['rows'],
+    'seconds': round(elapsed, 3),
+    'rows_per_sec': round(written['rows'] / elapsed, 1),
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--matches', type=int, default=2000)
+  parser.add_argument('--bookmakers', type=int, default=10)
+  parser.add_argument('--ticks', type=int, default=5)
+  parser.add_argument('--write-mode', default='bulk', choices=DatabasePipeline.WRITE_MODES)
+  args = parser.parse_args(argv)
+
+  results = [
+    run(load_mode, args.write_mode, args.matches, args.bookmakers, args.ticks)
+    for load_mode in DatabasePipeline.LOAD_MODES
+  ]
+  for r in results:
+    print(json.dumps(r))
+  baseline = results[0]['rows_per_sec']
+  for r in results:
+    print(f"{r['load_mode']:>12}: {r['rows_per_sec']:>10.1f} rows/sec ({r['rows_per_sec'] / baseline:.2f}x)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,246 @@
+"""
+Benchmark the throughput & peak memory of the parsers over recorded pages: the bodies of
+the VCR cassettes of the tests, and of the local HTTP cache (if any), are parsed by the
+parser of their endpoint (as routed by TennisExplorerSpider.parse) with each engine.
+
+Each result reports the time spent in each phase of parsing a page: building the
+response's lxml selector tree and BeautifulSoup tree (as and when the parser first uses
+them), and the parser's parse_items & parse_links methods (excluding the tree building).
+
+Results may be saved as a baseline, and later results compared against it, in which case
+the benchmark exits with a non-zero status if the pages/sec of any parser & engine
+regressed by more than the threshold.
+
+Usage:
+  python -m benchmarks.bench_parsers [--cassettes GLOB] [--cache PATH] [--max-pages N]
+    [--engines bs4,lxml] [--repeat N] [--save-baseline PATH] [--baseline PATH] [--threshold F]
+"""
+import argparse
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from urllib.parse import urlparse
+
+import scrapy
+import yaml
+
+from seeder.parsers import ParsedDocument
+from seeder.parsers.match_result_parser import MatchResultParser
+from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+
+logger = logging.getLogger(__name__)
+
+CASSETTES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', '**', 'cassettes', '*.yaml')
+START_WATERMARK = datetime.datetime(1990, 1, 1)
+STOP_WATERMARK = datetime.datetime(2100, 1, 1)
+
+
+def cassette_responses(pattern):
+  responses = []
+  for path in sorted(glob.glob(pattern, recursive=True)):
+    with open(path) as f:
+      cassette = yaml.safe_load(f)
+    for interaction in cassette['interactions']:
+      recorded = interaction['response']
+      body = recorded['body']['string']
+      if 'gzip' in recorded['headers'].get('Content-Encoding', []):
+        body = gzip.decompress(body)
+      responses.append(scrapy.http.HtmlResponse(interaction['request']['uri'], body=body))
+  return responses
+
+
+def cached_responses(path, max_pages=None):
+  from seeder.httpcache import iter_cached_responses
+  responses = []
+  for (_, response) in iter_cached_responses(path):
+    if isinstance(response, scrapy.http.HtmlResponse):
+      responses.append(response)
+    if max_pages is not None and len(responses) >= max_pages:
+      break
+  return responses
+
+
+def default_cache_path():
+  from scrapy.utils.project import get_project_settings
+  from seeder.httpcache import cache_path
+  return cache_path(get_project_settings(), TennisExplorerSpider.name)
+
+
+def unique_pages(responses):
+  # The same page may be recorded by several cassettes
+  pages = {}
+  for response in responses:
+    pages.setdefault((response.url, response.body), response)
+  return list(pages.values())
+
+
+def make_parsers(engine):
+  ctx = {
+    'logger': logger,
+    'start_watermark': START_WATERMARK,
+    'stop_watermark': STOP_WATERMARK,
+    'engine': engine,
+  }
+  return {
+    endpoint: config['parser'](**ctx, **config.get('parser_kwargs', {}))
+    for (endpoint, config) in TennisExplorerSpider.ENDPOINT_PARSERS.items()
+  }
+
+
+class TimedDocument(ParsedDocument):
+  """
+  A ParsedDocument that accumulates the time spent building its trees in timings.
+  """
+
+  def __init__(self, response, timings):
+    super().__init__(response)
+    self.timings = timings
+
+  @property
+  def soup(self):
+    if self._soup is None:
+      start = time.perf_counter()
+      super().soup
+      self.timings['soup'] += time.perf_counter() - start
+    return self._soup
+
+  def build_selector(self):
+    start = time.perf_counter()
+    self.response.selector
+    self.timings['selector'] += time.perf_counter() - start
+
+
+def parse_page(parser, response, timings):
+  """
+  Parse a (fresh copy of a) page as the spider would, returning its number of items & links.
+  """
+  response = response.replace()
+  document = TimedDocument(response, timings)
+  # Every parser uses the selector, so it is built up front rather than timed within the parser
+  document.build_selector()
+  counts = {}
+  methods = ('parse_items', 'parse_links') if isinstance(parser, MatchResultParser) else ('parse_items',)
+  for method in methods:
+    built = timings['soup']
+    start = time.perf_counter()
+    counts[method] = len(getattr(parser, method)(response, document=document))
+    timings[method] += time.perf_counter() - start - (timings['soup'] - built)
+  return (counts.get('parse_items', 0), counts.get('parse_links', 0))
+
+
+def run(parser, engine, pages, repeat):
+  timings = {'selector': 0.0, 'soup': 0.0, 'parse_items': 0.0, 'parse_links': 0.0}
+  num_items = num_links = 0
+  start = time.perf_counter()
+  for _ in range(repeat):
+    for response in pages:
+      (items, links) = parse_page(parser, response, timings)
+      num_items += items
+      num_links += links
+  elapsed = time.perf_counter() - start
+
+  tracemalloc.start()
+  for response in pages:
+    parse_page(parser, response, dict.fromkeys(timings, 0.0))
+  (_, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  num_pages = repeat * len(pages)
+  return {
+    'benchmark': 'parsers',
+    'parser': type(parser).__name__,
+    'engine': engine,
+    'pages': num_pages,
+    'items': num_items,
+    'links': num_links,
+    'seconds': round(elapsed, 3),
+    'pages_per_sec': round(num_pages / elapsed, 1),
+    'items_per_sec': round(num_items / elapsed, 1),
+    'peak_kib': round(peak / 1024, 1),
+    'phases': {k: round(v / num_pages * 1000, 3) for (k, v) in timings.items()},
+  }
+
+
+def result_key(result):
+  return (result['parser'], result['engine'])
+
+
+def compare(results, baseline, threshold):
+  """
+  Return the results whose pages/sec regressed by more than threshold (a fraction) vs the baseline.
+  """
+  baseline = {result_key(r): r for r in baseline}
+  regressions = []
+  for r in results:
+    b = baseline.get(result_key(r))
+    if b is None:
+      print(f"{r['parser']} ({r['engine']}): no baseline result", file=sys.stderr)
+      continue
+    ratio = r['pages_per_sec'] / b['pages_per_sec']
+    regressed = ratio < 1 - threshold
+    print(
+      f"{r['parser']:>18} ({r['engine']:>4}): {r['pages_per_sec']:>8.1f} pages/sec vs {b['pages_per_sec']:>8.1f} baseline "
+      f"({ratio:.2f}x){' REGRESSED' if regressed else ''}",
+      file=sys.stderr,
+    )
+    if regressed:
+      regressions.append(r)
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--cassettes', default=CASSETTES, help="Glob of the VCR cassettes whose pages are parsed")
+  parser.add_argument('--cache', default=None, help="Path of an HTTP cache (dbm file or SegmentCache directory) whose pages are parsed (default: the project's, if it exists)")
+  parser.add_argument('--max-pages', type=int, default=1000, help="Maximum number of pages read from the HTTP cache")
+  parser.add_argument('--engines', default='bs4,lxml')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--save-baseline', default=None, help="Path to save the results to as a baseline")
+  parser.add_argument('--baseline', default=None, help="Path of a saved baseline to compare the results to")
+  parser.add_argument('--threshold', type=float, default=0.10, help="Fraction by which pages/sec may regress vs the baseline")
+  args = parser.parse_args(argv)
+
+  # The parsers' errors (e.g. pages of unexpected dates) are not of interest here
+  logger.setLevel(logging.CRITICAL)
+
+  responses = cassette_responses(args.cassettes)
+  cache = args.cache or default_cache_path()
+  if args.cache or os.path.exists(cache):
+    responses += cached_responses(cache, max_pages=args.max_pages)
+  pages = {}
+  for response in unique_pages(responses):
+    pages.setdefault(urlparse(response.url).path, []).append(response)
+
+  results = []
+  for engine in args.engines.split(','):
+    parsers = make_parsers(engine)
+    by_parser = {}
+    for (endpoint, endpoint_pages) in pages.items():
+      if endpoint in parsers:
+        by_parser.setdefault(type(parsers[endpoint]), (parsers[endpoint], []))[1].extend(endpoint_pages)
+    for (endpoint_parser, parser_pages) in by_parser.values():
+      results.append(run(endpoint_parser, engine, parser_pages, args.repeat))
+
+  for r in results:
+    print(json.dumps(r))
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as f:
+      for r in results:
+        f.write(json.dumps(r) + '\n')
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = [json.loads(line) for line in f if line.strip()]
+    if compare(results, baseline, args.threshold):
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,67 @@
+"""
+Benchmark the CPU time & peak memory of building the database rows of items with the
+ORM builders (make_with_dependencies + to_partial_dict) vs the row builders
+(make_rows_with_dependencies).
+
+Usage:
+  python -m benchmarks.bench_row_builders [--matches N] [--bookmakers N] [--ticks N]
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from benchmarks.bench_load_mode import make_items
+
+
+def build_records(items):
+  # As the DatabasePipeline did, build the ORM instances of a page's items and then their dicts
+  records = [r for item in items for r in item.make_with_dependencies()]
+  return [(type(r), r.to_partial_dict()) for r in records]
+
+
+def build_rows(items):
+  return [row for item in items for row in item.make_rows_with_dependencies()]
+
+
+def run(name, fn, items):
+  start = time.perf_counter()
+  fn(items)
+  elapsed = time.perf_counter() - start
+  tracemalloc.start()
+  fn(items)
+  (_, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return {
+    'benchmark': 'row_builders',
+    'builder': name,
+    'items': len(items),
+    'seconds': round(elapsed, 3),
+    'items_per_sec': round(len(items) / elapsed, 1),
+    'peak_kib': round(peak / 1024, 1),
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--matches', type=int, default=1000)
+  parser.add_argument('--bookmakers', type=int, default=10)
+  parser.add_argument('--ticks', type=int, default=5)
+  args = parser.parse_args(argv)
+
+  items = list(make_items(args.matches, args.bookmakers, args.ticks))
+  results = [run('orm', build_records, items), run('rows', build_rows, items)]
+  for r in results:
+    print(json.dumps(r))
+  baseline = results[0]
+  for r in results:
+    print(
+      f"{r['builder']:>6}: {r['items_per_sec']:>10.1f} items/sec ({r['items_per_sec'] / baseline['items_per_sec']:.2f}x), "
+      f"peak {r['peak_kib']:.0f} KiB ({r['peak_kib'] / baseline['peak_kib']:.2f}x)",
+      file=sys.stderr,
+    )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,268 @@
+"""
+Backfill a watermark span with several crawler processes, each crawling a disjoint shard of
+its dates:
+
+  scrapy backfill --start-watermark 2019-01-01 --stop-watermark 2022-12-31 --processes 8
+"""
+import datetime
+import logging
+import multiprocessing
+import os
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.settings import SETTINGS_PRIORITIES
+from scrapy.utils.log import configure_logging
+from scrapy.utils.misc import load_object
+
+from seeder.db import create_all, get_engine
+from seeder.httpcache import SegmentCacheStorage
+from seeder.models import BaseModel
+from seeder.pipelines import drop_backfill_indexes, rebuild_backfill_indexes
+
+logger = logging.getLogger(__name__)
+
+
+def plan_shards(start_watermark, stop_watermark, num_shards):
+  """
+  Split the dates of [start_watermark, stop_watermark] into at most num_shards contiguous,
+  disjoint shards of (nearly) equal numbers of days, and return their (start, stop) dates.
+  """
+  num_days = (stop_watermark - start_watermark).days + 1
+  num_shards = max(1, min(num_shards, num_days))
+  (size, extra) = divmod(num_days, num_shards)
+  shards = []
+  start = start_watermark
+  for k in range(num_shards):
+    stop = start + datetime.timedelta(days=size + (k < extra) - 1)
+    shards.append((start, stop))
+    start = stop + datetime.timedelta(days=1)
+  return shards
+
+
+def shard_cache_dir(settings, processes):
+  """
+  Return the directory below which each shard's crawl caches its responses in an HTTP cache
+  of its own, or None if the shards may share the HTTP cache.
+
+  Only the SegmentCacheStorage supports several writer processes: the dbm files of scrapy's
+  DbmCacheStorage have no locking, such that shards crawling at once would lose (or corrupt)
+  each other's cached pages, or fail to open the cache.
+  """
+  if processes <= 1 or not settings.getbool('HTTPCACHE_ENABLED'):
+    return None
+  if load_object(settings['HTTPCACHE_STORAGE']) is SegmentCacheStorage:
+    return None
+  return settings['HTTPCACHE_DIR']
+
+
+def run_shard(overrides, start_watermark, stop_watermark, log_file=None):
+  """
+  Crawl a shard in this (worker) process, and exit with a non-zero status unless the crawl
+  finished. The crawl inserts its own Crawl row, as any crawl does.
+  """
+  from scrapy.crawler import CrawlerProcess
+  from scrapy.utils.project import get_project_settings
+  from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+
+  settings = get_project_settings()
+  settings.setdict(overrides, priority='cmdline')
+  settings.setdict({
+    'SEEDER_START_DATE': None,
+    'SEEDER_START_WATERMARK': start_watermark.isoformat(),
+    'SEEDER_STOP_WATERMARK': stop_watermark.isoformat(),
+    'LOG_FILE': log_file,
+  }, priority='cmdline')
+  process = CrawlerProcess(settings)
+  crawler = process.create_crawler(TennisExplorerSpider)
+  process.crawl(crawler)
+  process.start()
+  finish_reason = crawler.stats.get_value('finish_reason')
+  if process.bootstrap_failed or finish_reason != 'finished':
+    raise SystemExit(1)
+
+
+class Shard(object):
+
+  def __init__(self, index, start_watermark, stop_watermark):
+    self.index = index
+    self.start_watermark = start_watermark
+    self.stop_watermark = stop_watermark
+    self.attempts = 0
+    self.process = None
+    self.started_at = None
+    self.elapsed = None
+    self.status = 'pending'
+
+  @property
+  def num_days(self):
+    return (self.stop_watermark - self.start_watermark).days + 1
+
+  def __str__(self):
+    return f"shard {self.index} [{self.start_watermark.date()}, {self.stop_watermark.date()}]"
+
+
+def _progress(shards, started_at):
+  counts = {status: sum(s.status == status for s in shards) for status in ('pending', 'running', 'finished', 'failed')}
+  days = sum(s.num_days for s in shards)
+  days_done = sum(s.num_days for s in shards if s.status == 'finished')
+  elapsed = time.monotonic() - started_at
+  eta = f", ETA {elapsed * (days - days_done) / days_done:.0f}s" if 0 < days_done < days else ''
+  return (
+    f"Backfill progress: {counts['finished']}/{len(shards)} shards finished ({days_done}/{days} days), "
+    f"{counts['running']} running, {counts['pending']} pending, {counts['failed']} failed; "
+    f"{elapsed:.0f}s elapsed{eta}."
+  )
+
+
+def backfill(shards, overrides=None, processes=1, retries=1, log_dir=None, cache_dir=None, target=run_shard, poll_interval=1.0, progress_interval=60.0):
+  """
+  Crawl the shards (see plan_shards) on up to processes worker processes at once, retrying
+  each failed shard up to retries times, and logging the progress every progress_interval
+  seconds. Each attempt's crawl is logged to {log_dir}/shard-{index}-{attempt}.log, if
+  log_dir is given. If cache_dir is given (see shard_cache_dir), each shard's responses are
+  cached in the HTTPCACHE_DIR {cache_dir}/shard-{index}.
+
+  Return the list of Shards, whose status is 'finished' or 'failed'.
+  """
+  context = multiprocessing.get_context('spawn')
+  shards = [Shard(k, start, stop) for (k, (start, stop)) in enumerate(shards)]
+  pending = list(shards)
+  running = []
+  started_at = last_progress = time.monotonic()
+
+  def _start(shard):
+    shard.attempts += 1
+    log_file = None
+    if log_dir is not None:
+      log_file = os.path.join(log_dir, f'shard-{shard.index}-{shard.attempts}.log')
+    shard_overrides = dict(overrides or {})
+    if cache_dir is not None:
+      shard_overrides['HTTPCACHE_DIR'] = os.path.join(cache_dir, f'shard-{shard.index}')
+    shard.process = context.Process(
+      target=target,
+      args=(shard_overrides, shard.start_watermark, shard.stop_watermark, log_file),
+      name=f'backfill-shard-{shard.index}',
+    )
+    shard.process.start()
+    shard.started_at = time.monotonic()
+    shard.status = 'running'
+    running.append(shard)
+    logger.info(f"Started {shard} (attempt {shard.attempts}){f', logging to {log_file}' if log_file else ''}.")
+
+  if log_dir is not None:
+    os.makedirs(log_dir, exist_ok=True)
+  try:
+    while pending or running:
+      while pending and len(running) < processes:
+        _start(pending.pop(0))
+      time.sleep(poll_interval)
+      for shard in [s for s in running if not s.process.is_alive()]:
+        running.remove(shard)
+        shard.process.join()
+        shard.elapsed = time.monotonic() - shard.started_at
+        if shard.process.exitcode == 0:
+          shard.status = 'finished'
+          logger.info(f"Finished {shard} in {shard.elapsed:.0f}s.")
+        elif shard.attempts <= retries:
+          shard.status = 'pending'
+          pending.append(shard)
+          logger.warning(f"Failed {shard} (exit code {shard.process.exitcode}): retrying.")
+        else:
+          shard.status = 'failed'
+          logger.error(f"Failed {shard} (exit code {shard.process.exitcode}) after {shard.attempts} attempts.")
+        logger.info(_progress(shards, started_at))
+        last_progress = time.monotonic()
+      if time.monotonic() - last_progress >= progress_interval:
+        logger.info(_progress(shards, started_at))
+        last_progress = time.monotonic()
+  finally:
+    for shard in running:
+      shard.process.terminate()
+      shard.process.join()
+  return shards
+
+
+class Command(ScrapyCommand):
+
+  requires_project = True
+  requires_crawler_process = False
+
+  def syntax(self):
+    return "[options]"
+
+  def short_desc(self):
+    return "Backfill a watermark span with several crawler processes over disjoint date shards"
+
+  def long_desc(self):
+    return (
+      "Split the dates of [--start-watermark, --stop-watermark] into --shards disjoint shards, "
+      "and crawl them with the tennisexplorer spider on up to --processes worker processes at "
+      "once, each with its own watermarks and Crawl row. Failed shards are retried up to "
+      "--retries times. The settings given with -s apply to every shard's crawl."
+    )
+
+  def add_options(self, parser):
+    super().add_options(parser)
+    parser.add_argument('--start-watermark', required=True, help="first date (YYYY-MM-DD) of the backfill")
+    parser.add_argument('--stop-watermark', required=True, help="last date (YYYY-MM-DD) of the backfill")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="number of crawler processes run at once (default: the number of cores)")
+    parser.add_argument('--shards', type=int, default=None, help="number of shards (default: 4 per process)")
+    parser.add_argument('--retries', type=int, default=2, help="number of times a failed shard is retried")
+    parser.add_argument('--log-dir', default='private/backfill', help="directory of the shards' crawl logs")
+
+  def run(self, args, opts):
+    configure_logging(self.settings)
+    start_watermark = datetime.datetime.fromisoformat(opts.start_watermark)
+    stop_watermark = datetime.datetime.fromisoformat(opts.stop_watermark)
+    if stop_watermark < start_watermark:
+      raise UsageError("--stop-watermark must not be before --start-watermark")
+    if opts.processes < 1:
+      raise UsageError("--processes must be positive")
+    if opts.processes > 1 and (self.settings.get('SEEDER_DB_CONN_STR') or '').startswith('sqlite'):
+      logger.warning("Shards write to the sqlite database concurrently, which serializes their writes.")
+
+    # The settings given on the command line (with -s) apply to each shard's crawl
+    overrides = {
+      name: value for (name, value) in self.settings.items()
+      if self.settings.getpriority(name) == SETTINGS_PRIORITIES['cmdline']
+    }
+    # In the backfill load mode, the indexes are dropped once before and rebuilt once after
+    # all the shards, rather than by each shard's pipeline while the others are loading
+    manage_indexes = (
+      self.settings.get('SEEDER_LOAD_MODE') == 'backfill'
+      and self.settings.getbool('SEEDER_LOAD_MANAGE_INDEXES', True)
+    )
+    if manage_indexes:
+      engine = get_engine()
+      create_all(engine, BaseModel)
+      dropped = drop_backfill_indexes(engine)
+      logger.info(f"Dropped {len(dropped)} secondary indexes for the backfill.")
+      overrides['SEEDER_LOAD_MANAGE_INDEXES'] = False
+    cache_dir = shard_cache_dir(self.settings, opts.processes)
+    if cache_dir is not None:
+      logger.warning(
+        f"The {self.settings['HTTPCACHE_STORAGE']} HTTP cache does not support several writers, so each "
+        f"shard caches its responses below {os.path.join(cache_dir, 'shard-<index>')} (see restate --cache). "
+        f"Set HTTPCACHE_STORAGE=seeder.httpcache.SegmentCacheStorage to share one cache.")
+    shards = plan_shards(start_watermark, stop_watermark, opts.shards or 4 * opts.processes)
+    logger.info(f"Backfilling [{start_watermark.date()}, {stop_watermark.date()}] in {len(shards)} shards on {opts.processes} processes.")
+    try:
+      shards = backfill(
+        shards,
+        overrides=overrides,
+        processes=opts.processes,
+        retries=opts.retries,
+        log_dir=opts.log_dir,
+        cache_dir=cache_dir,
+      )
+    finally:
+      if manage_indexes:
+        start = time.monotonic()
+        rebuild_backfill_indexes(engine)
+        logger.info(f"Rebuilt secondary indexes and analyzed tables in {time.monotonic() - start:.1f}s.")
+    for shard in shards:
+      logger.info(f"{str(shard).capitalize()}: {shard.status} after {shard.attempts} attempt(s).")
+    if any(shard.status != 'finished' for shard in shards):
+      self.exitcode = 1
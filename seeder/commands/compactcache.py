@@ -0,0 +1,45 @@
+"""
+Compact the segment files of the HTTP cache of the SegmentCacheStorage:
+
+  scrapy compactcache --min-dead-ratio 0.25
+"""
+import logging
+import os
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.log import configure_logging
+
+from seeder.httpcache import SegmentCache, cache_path
+from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+
+logger = logging.getLogger(__name__)
+
+
+class Command(ScrapyCommand):
+
+  requires_project = True
+  requires_crawler_process = False
+
+  def syntax(self):
+    return "[options]"
+
+  def short_desc(self):
+    return "Compact the segment files of the HTTP cache (SegmentCacheStorage)"
+
+  def add_options(self, parser):
+    super().add_options(parser)
+    parser.add_argument('--cache', default=None, help="path of the HTTP cache directory (default: the spider's in HTTPCACHE_DIR)")
+    parser.add_argument('--min-dead-ratio', type=float, default=0.25, help="compact the sealed segments with at least this fraction of dead bytes")
+
+  def run(self, args, opts):
+    configure_logging(self.settings)
+    path = opts.cache or cache_path(self.settings, TennisExplorerSpider.name)
+    if not os.path.isdir(path):
+      raise UsageError(f"No SegmentCacheStorage cache directory found at '{path}'")
+    cache = SegmentCache(path, compress=self.settings.getbool('HTTPCACHE_GZIP'))
+    try:
+      reclaimed = cache.compact(min_dead_ratio=opts.min_dead_ratio)
+    finally:
+      cache.close()
+    logger.info(f"Compacted the HTTP cache at '{path}', reclaiming {reclaimed / 2**20:.1f} MiB.")
@@ -0,0 +1,227 @@
+"""
+Restate the database (or columnar files) from the pages stored in the HTTP cache, without
+the network, e.g. after a parser fix:
+
+  scrapy restate --start-date 2022-01-01 --stop-date 2022-12-31 --processes 8
+"""
+import collections
+import datetime
+import logging
+import re
+import time
+
+from urllib.parse import parse_qs, urlparse
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.log import configure_logging
+
+from seeder.httpcache import cache_path, iter_cached_responses
+from seeder.parsers.offload import _init_worker, parse_page, start_workers
+from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+from seeder.util.numeric import coerce_int
+from seeder.util.urls import date_from_qs
+
+logger = logging.getLogger(__name__)
+
+SINKS = ('db', 'columnar')
+DETAIL_ENDPOINT = '/match-detail/'
+
+
+def make_sink(settings, sink):
+  """
+  Return the item pipeline that the restated items are written through: the DatabasePipeline
+  in bulk write mode, or the ColumnarFilePipeline.
+  """
+  from seeder.db import KeyCache
+  from seeder.pipelines import ColumnarFilePipeline, DatabasePipeline
+  if sink == 'columnar':
+    return ColumnarFilePipeline(
+      directory=settings.get('SEEDER_COLUMNAR_DIR', 'private/columnar'),
+      file_format=settings.get('SEEDER_COLUMNAR_FORMAT', 'parquet'),
+      row_group_size=settings.getint('SEEDER_COLUMNAR_ROW_GROUP_SIZE', 100000),
+      compression=settings.get('SEEDER_COLUMNAR_COMPRESSION', 'zstd'),
+      key_cache_size=settings.getint('SEEDER_KEY_CACHE_SIZE', KeyCache.DEFAULT_MAX_SIZE),
+    )
+  return DatabasePipeline(
+    write_mode='bulk',
+    flush_size=settings.getint('SEEDER_BULK_FLUSH_SIZE', 1000),
+    flush_interval=settings.getfloat('SEEDER_BULK_FLUSH_INTERVAL', 5.0),
+    key_cache_size=settings.getint('SEEDER_KEY_CACHE_SIZE', KeyCache.DEFAULT_MAX_SIZE),
+    load_mode=settings.get('SEEDER_LOAD_MODE', 'incremental'),
+  )
+
+
+def _match_number(url):
+  return coerce_int(parse_qs(urlparse(url).query).get('id', [''])[-1])
+
+
+def _is_dated_within(url, start_date, stop_date):
+  dt = date_from_qs(url, on_errors='coerce')
+  return (dt is not None) and (start_date <= dt <= stop_date)
+
+
+def select_pages(path, endpoints, phase, start_date=None, stop_date=None, url_pattern=None, match_numbers=None):
+  """
+  Yield the cached responses of a restatement phase:
+    - 'listings': the pages of the endpoints other than /match-detail/, dated within
+      [start_date, stop_date] if given.
+    - 'details': the /match-detail/ pages, of the match_numbers if given.
+  The pages are selected by their url, before their bodies are read (from a SegmentCache).
+  """
+  def _is_selected(url):
+    endpoint = urlparse(url).path
+    if endpoint not in endpoints:
+      return False
+    if url_pattern is not None and not url_pattern.search(url):
+      return False
+    if phase == 'details':
+      return (endpoint == DETAIL_ENDPOINT) and (match_numbers is None or _match_number(url) in match_numbers)
+    if endpoint == DETAIL_ENDPOINT:
+      return False
+    return (start_date is None) or _is_dated_within(url, start_date, stop_date)
+
+  for (_, response) in iter_cached_responses(path, url_filter=_is_selected):
+    yield response
+
+
+def parse_pages(responses, executor=None, max_pending=64):
+  """
+  Yield (response url, (items, links) or exception) for each response, parsed in order on
+  the executor's worker processes (or in this process if there is no executor), with at
+  most max_pending responses in flight.
+  """
+  if executor is None:
+    for response in responses:
+      try:
+        yield (response.url, parse_page(response.url, response.body, encoding=response.encoding))
+      except Exception as e:
+        yield (response.url, e)
+    return
+
+  pending = collections.deque()
+
+  def _result():
+    (url, future) = pending.popleft()
+    try:
+      return (url, future.result())
+    except Exception as e:
+      return (url, e)
+
+  for response in responses:
+    pending.append((response.url, executor.submit(parse_page, response.url, response.body, encoding=response.encoding)))
+    if len(pending) >= max_pending:
+      yield _result()
+  while pending:
+    yield _result()
+
+
+def restate(path, spider, sink, processes=0, start_date=None, stop_date=None, url_pattern=None, max_pending=64):
+  """
+  Parse the pages cached at path with the spider's parsers, and write their items through
+  the sink (an item pipeline). The listing pages (e.g. /results/) are restated first; if a
+  date range is given, only the /match-detail/ pages they link to are then restated.
+
+  Return a dict of the number of pages, items & errors per endpoint.
+  """
+  stats = collections.defaultdict(collections.Counter)
+  executor = None
+  if processes > 0:
+    (executor, log_listener) = start_workers(spider.parser_specs, processes)
+  else:
+    _init_worker(spider.parser_specs)
+
+  sink.open_spider(spider)
+  try:
+    linked = set() if start_date is not None else None
+    for phase in ('listings', 'details'):
+      responses = select_pages(
+        path,
+        spider.parser_specs,
+        phase,
+        start_date=start_date,
+        stop_date=stop_date,
+        url_pattern=url_pattern,
+        match_numbers=linked if phase == 'details' else None,
+      )
+      for (url, result) in parse_pages(responses, executor=executor, max_pending=max_pending):
+        endpoint = urlparse(url).path
+        stats[endpoint]['pages'] += 1
+        if isinstance(result, Exception):
+          logger.error(f"Failed to parse cached page '{url}': {result!r}")
+          stats[endpoint]['errors'] += 1
+          continue
+        (items, links) = result
+        for item in items:
+          sink.process_item(item, spider)
+        stats[endpoint]['items'] += len(items)
+        if linked is not None:
+          linked.update(_match_number(href) for href in links if urlparse(href).path == DETAIL_ENDPOINT)
+  finally:
+    sink.close_spider(spider)
+    if executor is not None:
+      executor.shutdown()
+      log_listener.stop()
+  return {endpoint: dict(counts) for (endpoint, counts) in stats.items()}
+
+
+class Command(ScrapyCommand):
+
+  requires_project = True
+  requires_crawler_process = False
+
+  def syntax(self):
+    return "[options]"
+
+  def short_desc(self):
+    return "Restate the database from the pages in the HTTP cache, without the network"
+
+  def long_desc(self):
+    return (
+      "Parse the pages stored in the HTTP cache (HTTPCACHE_DIR) with the parsers of the "
+      "tennisexplorer spider, on a pool of worker processes, and write their items through a "
+      "bulk sink. If a date range is given, the /results/ pages of its dates and the "
+      "/match-detail/ pages they link to are restated."
+    )
+
+  def add_options(self, parser):
+    super().add_options(parser)
+    parser.add_argument('--cache', default=None, help="path of the HTTP cache dbm file or SegmentCache directory (default: the spider's in HTTPCACHE_DIR)")
+    parser.add_argument('--start-date', default=None, help="first date (YYYY-MM-DD) of the /results/ pages to restate")
+    parser.add_argument('--stop-date', default=None, help="last date (YYYY-MM-DD) of the /results/ pages to restate")
+    parser.add_argument('--url-pattern', default=None, help="only restate pages whose url matches this regex")
+    parser.add_argument('--processes', type=int, default=0, help="number of worker processes (default: 0, parse in this process)")
+    parser.add_argument('--sink', choices=SINKS, default='db', help="write the items to the database (in bulk) or to columnar files")
+
+  def run(self, args, opts):
+    configure_logging(self.settings)
+    if (opts.start_date is None) != (opts.stop_date is None):
+      raise UsageError("Both or neither of --start-date and --stop-date must be given")
+    start_date = stop_date = None
+    if opts.start_date is not None:
+      start_date = datetime.datetime.fromisoformat(opts.start_date)
+      stop_date = datetime.datetime.fromisoformat(opts.stop_date)
+
+    spider = TennisExplorerSpider(
+      start_watermark=start_date,
+      stop_watermark=stop_date,
+      exclude_endpoints=self.settings.getlist('SEEDER_EXCLUDE_ENDPOINTS'),
+      odds_storage=self.settings.get('SEEDER_ODDS_STORAGE', 'ticks'),
+      parser_engine=self.settings.get('SEEDER_PARSER_ENGINE', 'lxml'),
+    )
+    path = opts.cache or cache_path(self.settings, spider.name)
+    start = time.monotonic()
+    stats = restate(
+      path,
+      spider,
+      make_sink(self.settings, opts.sink),
+      processes=opts.processes,
+      start_date=start_date,
+      stop_date=stop_date,
+      url_pattern=re.compile(opts.url_pattern) if opts.url_pattern else None,
+    )
+    for (endpoint, counts) in sorted(stats.items()):
+      logger.info(f"Restated {endpoint}: {counts}")
+    logger.info(f"Restated {sum(c.get('pages', 0) for c in stats.values())} cached pages in {time.monotonic() - start:.1f}s.")
+    if any(c.get('errors') for c in stats.values()):
+      self.exitcode = 1
@@ -1,38 +1,129 @@
+import functools
 import logging
 import os
+import threading
+import time
+import uuid
+import weakref
 import sqlalchemy
-from scrapy.utils.project import get_project_settings
 
-from sqlalchemy import select, inspect
+from collections import OrderedDict
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from sqlalchemy import event, select, inspect, text
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 
 logger = logging.getLogger(__name__)
 
 SEEDER_DB_CONN_STR = 'SEEDER_DB_CONN_STR'
 
+UPSERT_DIALECTS = {'sqlite', 'postgresql', 'mysql'}
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def project_settings():
+  """
+  Return the scrapy project settings, which are read only once per process.
+  """
+  from scrapy.utils.project import get_project_settings
+  return get_project_settings()
+
+def get_conn_str():
+  """
+  Return the database connection string set in the environment or the project settings.
+  """
+  if os.getenv(SEEDER_DB_CONN_STR): 
+    logger.info(f"Variable {SEEDER_DB_CONN_STR} was set in env; using this to create engine.")
+    return os.getenv(SEEDER_DB_CONN_STR) 
+  if project_settings().get(SEEDER_DB_CONN_STR):
+    logger.info(f"Using {SEEDER_DB_CONN_STR} from scrapy project settings.")
+    return project_settings().get(SEEDER_DB_CONN_STR)
+  raise ValueError(f"No ${SEEDER_DB_CONN_STR} is set in the settings.py or environment.")
 
 def get_engine(conn_str=None, **kwargs):
   """
-  Create a sqlalchemy engine.
+  Return the sqlalchemy engine for a connection string, creating it on first use.
+
+  Engines created without engine argument overrides are cached per connection string,
+  such that every component of a process shares the same engine and connection pool.
   """
-  engine_args = get_project_settings().get('SEEDER_SQLALCHEMY_ENGINE_ARGS', {})
   if conn_str:
     logger.info("get_engine() supplied with conn_str override.")
-  elif os.getenv(SEEDER_DB_CONN_STR): 
-    logger.info(f"Variable {SEEDER_DB_CONN_STR} was set in env; using this to create engine.")
-    conn_str = os.getenv(SEEDER_DB_CONN_STR) 
-  elif get_project_settings().get(SEEDER_DB_CONN_STR):
-    logger.info(f"Using {SEEDER_DB_CONN_STR} from scrapy project settings.")
-    conn_str = get_project_settings().get(SEEDER_DB_CONN_STR)
-  if not conn_str:
-    raise ValueError(f"No ${SEEDER_DB_CONN_STR} is set in the settings.py or environment.")
+  else:
+    conn_str = get_conn_str()
+  if kwargs:
+    return create_engine(conn_str, **kwargs)
+  with _engines_lock:
+    engine = _engines.get(conn_str)
+    if engine is None:
+      engine = _engines[conn_str] = create_engine(conn_str)
+    return engine
+
+def pool_args(conn_str, settings):
+  """
+  Return the connection pool arguments set by the SEEDER_DB_POOL_* settings for a connection string.
+
+  No arguments are returned for sqlite, which keeps sqlalchemy's default pools: a
+  SingletonThreadPool for in-memory databases and a QueuePool for files, the latter of
+  which may serve concurrent readers but is written by a single writer thread.
+  """
+  if conn_str.startswith('sqlite'):
+    return {}
+  return {
+    'pool_size': settings.getint('SEEDER_DB_POOL_SIZE', 5),
+    'max_overflow': settings.getint('SEEDER_DB_POOL_MAX_OVERFLOW', 10),
+    'pool_timeout': settings.getfloat('SEEDER_DB_POOL_TIMEOUT', 30),
+    'pool_pre_ping': settings.getbool('SEEDER_DB_POOL_PRE_PING', True),
+    'pool_recycle': settings.getint('SEEDER_DB_POOL_RECYCLE', -1),
+  }
 
+def create_engine(conn_str, **kwargs):
+  """
+  Create a new sqlalchemy engine with the pool arguments and SEEDER_SQLALCHEMY_ENGINE_ARGS of its dialect.
+  """
+  settings = project_settings()
+  engine_args = settings.get('SEEDER_SQLALCHEMY_ENGINE_ARGS', {})
   dialect = conn_str.split(':')[0]
-  _args = dict(engine_args.get(dialect, {}), **kwargs)
+  _args = dict(pool_args(conn_str, settings), **engine_args.get(dialect, {}), **kwargs)
   return sqlalchemy.create_engine(conn_str, **_args)
 
-def upsert_dict(sessionmaker, model, record):
+_created_schemas = weakref.WeakKeyDictionary()
+_created_schemas_lock = threading.Lock()
+
+def create_all(engine, base_model):
+  """
+  Create the tables of a declarative base that do not exist, once per engine & process.
+
+  Another process (e.g. a shard of the backfill command) may create the same tables
+  concurrently, so a table whose creation fails because it now exists is skipped.
+  """
+  with _created_schemas_lock:
+    created = _created_schemas.setdefault(engine, set())
+    if base_model.metadata in created:
+      return False
+    try:
+      base_model.metadata.create_all(engine)
+    except sqlalchemy.exc.DBAPIError:
+      for table in base_model.metadata.sorted_tables:
+        try:
+          table.create(engine, checkfirst=True)
+        except sqlalchemy.exc.DBAPIError:
+          if not inspect(engine).has_table(table.name):
+            raise
+    created.add(base_model.metadata)
+    return True
+
+def upsert_dict(sessionmaker, model, record, exists=None):
   """
   Upsert a dictionary-like record to a row of the provided model. 
+
+  If it is already known whether the row exists, exists may be set to True or False
+  to update or insert the row directly without first retrieving it by its primary key.
+  Should that assumption turn out to be wrong, the upsert is retried with a retrieval.
   """
   primary_keys = inspect(model).primary_key
   missing_keys = set([pk.name for pk in primary_keys]) - record.keys()
@@ -42,6 +133,27 @@ def upsert_dict(sessionmaker, model, record):
     pk.name: record.get(pk.name)
     for pk in primary_keys
   }
+  if exists is not None:
+    with sessionmaker() as session:
+      if exists:
+        stmt = (
+          sqlalchemy.update(model)
+          .where(*[pk == where_payload[pk.name] for pk in primary_keys])
+          .values(**record)
+        )
+        is_written = session.execute(stmt).rowcount > 0
+      else:
+        try:
+          session.execute(sqlalchemy.insert(model).values(**record))
+          is_written = True
+        except sqlalchemy.exc.IntegrityError:
+          session.rollback()
+          is_written = False
+      if is_written:
+        session.commit()
+        return True
+    logger.debug(f"Row existence assumption (exists={exists}) was wrong for {model.__name__} {where_payload}")
+
   with sessionmaker() as session:
     current = session.get(model, where_payload)
     if current:
@@ -53,6 +165,25 @@ def upsert_dict(sessionmaker, model, record):
     success = True
   return success 
 
+def upsert_row(sessionmaker, model, row, exists=None):
+  """
+  Upsert a column dict (e.g. from a model's make_row) to a row of the provided model
+  using Core statements only, such that no ORM instance is built for the row.
+
+  If exists is not known, the row is written with a single-row native upsert statement
+  (see upsert_dicts); dialects without one fall back to upsert_dict.
+  """
+  if exists is not None:
+    return upsert_dict(sessionmaker, model, row, exists=exists)
+  _primary_key(model, row)
+  with sessionmaker() as session:
+    dialect = session.get_bind().dialect
+    if dialect.name in UPSERT_DIALECTS:
+      session.execute(_upsert_statement(dialect, model.__table__, [row]))
+      session.commit()
+      return True
+  return upsert_dict(sessionmaker, model, row)
+
 def upsert_record(sessionmaker, record):
   """
   Upsert an ORM instance to the database.
@@ -69,13 +200,585 @@ def upsert_item(sessionmaker, item):
   """
   return upsert_dict(sessionmaker, item.__model__, dict(item))
 
+def _primary_key(model, record):
+  primary_keys = inspect(model).primary_key
+  missing_keys = set([pk.name for pk in primary_keys]) - record.keys()
+  if len(missing_keys) > 0:
+    raise ValueError(f"Cannot upsert item; missing primary keys: [{missing_keys}]")
+  return tuple(record.get(pk.name) for pk in primary_keys)
+
+def _max_bind_params(dialect):
+  """
+  Return the maximum number of bound parameters allowed in a single statement.
+  """
+  if dialect.name == 'sqlite':
+    # SQLITE_MAX_VARIABLE_NUMBER was raised from 999 in sqlite 3.32.0
+    version = getattr(dialect.dbapi, 'sqlite_version_info', (0, 0, 0))
+    return 32766 if version >= (3, 32, 0) else 999
+  if dialect.name == 'postgresql':
+    return 32767
+  return 65535
+
+def _upsert_statement(dialect, table, rows):
+  """
+  Build a dialect-native multi-row INSERT that updates the provided (non-key) columns
+  of any rows that already exist.
+  """
+  primary_keys = [pk.name for pk in table.primary_key.columns]
+  update_keys = [k for k in rows[0].keys() if k not in primary_keys]
+  # Column onupdate defaults are not applied to the update clause of an upsert
+  onupdate = {
+    col.name: col.onupdate.arg(None) if col.onupdate.is_callable else col.onupdate.arg
+    for col in table.columns
+    if (col.onupdate is not None) and (col.name not in rows[0])
+  }
+  if dialect.name in ('sqlite', 'postgresql'):
+    insert = sqlite.insert if dialect.name == 'sqlite' else postgresql.insert
+    stmt = insert(table).values(rows)
+    if not (update_keys or onupdate):
+      return stmt.on_conflict_do_nothing(index_elements=primary_keys)
+    return stmt.on_conflict_do_update(
+      index_elements=primary_keys,
+      set_={**{k: stmt.excluded[k] for k in update_keys}, **onupdate},
+    )
+  if dialect.name == 'mysql':
+    stmt = mysql.insert(table).values(rows)
+    if not (update_keys or onupdate):
+      return stmt.on_duplicate_key_update({pk: stmt.inserted[pk] for pk in primary_keys})
+    return stmt.on_duplicate_key_update(
+      {**{k: stmt.inserted[k] for k in update_keys}, **onupdate}
+    )
+  raise ValueError(f"Dialect '{dialect.name}' does not support a native upsert statement.")
+
+def _insert_ignore_statement(dialect, table, rows):
+  """
+  Build a dialect-native multi-row INSERT that skips the rows whose primary key already exists.
+  """
+  if dialect.name in ('sqlite', 'postgresql'):
+    insert = sqlite.insert if dialect.name == 'sqlite' else postgresql.insert
+    primary_keys = [pk.name for pk in table.primary_key.columns]
+    return insert(table).values(rows).on_conflict_do_nothing(index_elements=primary_keys)
+  if dialect.name == 'mysql':
+    return mysql.insert(table).values(rows).prefix_with('IGNORE')
+  raise ValueError(f"Dialect '{dialect.name}' does not support a native insert-or-ignore statement.")
+
+def insert_new_dicts(sessionmaker, model, records):
+  """
+  Insert a batch of dictionary-like records (each with the same keys) as rows of the
+  provided model in a single transaction, skipping those whose row already exists.
+
+  Return the number of rows inserted.
+  """
+  if not records:
+    return 0
+  table = model.__table__
+  inserted = 0
+  with sessionmaker() as session:
+    dialect = session.get_bind().dialect
+    chunk_size = max(1, _max_bind_params(dialect) // (len(records[0]) + 2))
+    for k in range(0, len(records), chunk_size):
+      inserted += session.execute(_insert_ignore_statement(dialect, table, records[k:k + chunk_size])).rowcount
+    session.commit()
+  return inserted
+
+def upsert_dicts(sessionmaker, model, records):
+  """
+  Upsert a batch of dictionary-like records to rows of the provided model.
+
+  Records that share a primary key are merged in order (such that later values take
+  precedence), and the merged records are then written in a single transaction using
+  a multi-row INSERT ... ON CONFLICT DO UPDATE (sqlite, postgresql) or 
+  INSERT ... ON DUPLICATE KEY UPDATE (mysql) statement for each distinct set of keys.
+  As with upsert_dict, only the keys present in a record are updated on existing rows.
+
+  Dialects without a native upsert statement fall back to upsert_dict for each record.
+  """
+  merged = {}
+  for record in records:
+    key = _primary_key(model, record)
+    current = merged.get(key)
+    merged[key] = {**current, **record} if current else dict(record)
+
+  # Multi-row VALUES clauses require each row to have the same keys; group records
+  # by their keyset, in order of the keyset's first appearance.
+  groups = {}
+  for record in merged.values():
+    groups.setdefault(tuple(sorted(record.keys())), []).append(record)
+
+  table = model.__table__
+  with sessionmaker() as session:
+    dialect = session.get_bind().dialect
+    if dialect.name not in UPSERT_DIALECTS:
+      logger.debug(f"Dialect '{dialect.name}' has no native upsert; falling back to upsert_dict.")
+      return all(upsert_dict(sessionmaker, model, r) for r in merged.values())
+    max_params = _max_bind_params(dialect)
+    for (keys, rows) in groups.items():
+      # Reserve parameters for any created_at/updated_at defaults added to each row
+      chunk_size = max(1, max_params // (len(keys) + 2))
+      for k in range(0, len(rows), chunk_size):
+        session.execute(_upsert_statement(dialect, table, rows[k:k + chunk_size]))
+    session.commit()
+  return True
+
+def _table_order(model):
+  return model.metadata.sorted_tables.index(model.__table__)
+
+
+class KeyCache(object):
+  """
+  A bounded in-process cache of the primary keys of rows known to exist in the database.
+
+  Keys are tracked for a fixed set of models and stored compactly (single UUID keys as
+  their 16 raw bytes). At most max_size keys are held per model, after which the least
+  recently used keys are evicted. While no keys of a model have been evicted (and its
+  table was fully preloaded), a key missing from the cache is known not to exist.
+  """
+
+  # The default of the SEEDER_KEY_CACHE_SIZE setting, shared by every pipeline with a KeyCache
+  DEFAULT_MAX_SIZE = 250000
+
+  def __init__(self, models, max_size=DEFAULT_MAX_SIZE):
+    self.max_size = max_size
+    self.keys = {model: OrderedDict() for model in models}
+    self.is_complete = {model: False for model in models}
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def _compact(key):
+    if len(key) == 1 and isinstance(key[0], uuid.UUID):
+      return key[0].bytes
+    return key
+
+  def __len__(self):
+    return sum(len(keys) for keys in self.keys.values())
+
+  def preload(self, sessionmaker):
+    """
+    Load the primary keys of the most recently updated rows of each model's table.
+    """
+    for (model, keys) in self.keys.items():
+      table = model.__table__
+      stmt = (
+        select(*table.primary_key.columns)
+        .order_by(table.c.updated_at.desc())
+        .limit(self.max_size + 1)
+      )
+      with sessionmaker() as session:
+        rows = session.execute(stmt).all()
+      with self.lock:
+        keys.clear()
+        # Add the oldest keys first such that they are the first to be evicted
+        for row in reversed(rows[:self.max_size]):
+          keys[self._compact(tuple(row))] = None
+        self.is_complete[model] = len(rows) <= self.max_size
+      logger.info(f"Preloaded {len(keys)} {model.__name__} keys (complete: {self.is_complete[model]}).")
+
+  def add(self, model, record):
+    keys = self.keys.get(model)
+    if keys is None:
+      return
+    key = self._compact(_primary_key(model, record))
+    with self.lock:
+      keys[key] = None
+      keys.move_to_end(key)
+      if len(keys) > self.max_size:
+        keys.popitem(last=False)
+        self.is_complete[model] = False
+
+  def contains(self, model, record):
+    """
+    Return whether the record's primary key is known to exist in the database.
+    """
+    keys = self.keys.get(model)
+    if keys is None:
+      return False
+    key = self._compact(_primary_key(model, record))
+    with self.lock:
+      if key in keys:
+        keys.move_to_end(key)
+        return True
+    return False
+
+  def exists(self, model, record):
+    """
+    Return True if the record's row is known to exist, False if it is known not to
+    exist, or None if this is not known.
+    """
+    if self.contains(model, record):
+      return True
+    if self.is_complete.get(model, False):
+      return False
+    return None
+
+
+class UpsertBuffer(object):
+  """
+  Accumulate dictionary-like records for each model in memory and upsert them to the 
+  database in bulk with upsert_dicts.
+
+  The buffer is flushed when it holds flush_size distinct records or when flush_interval
+  seconds have elapsed since the last flush, checked each time a record is added.
+  If both are None, the buffer is only flushed by calling flush.
+  Models are flushed in the foreign key dependency order of their tables, and the keys
+  of written records are added to the key_cache, if one is provided.
+
+  Records may be added from multiple threads; flushes are serialized such that
+  updates to the same row are always written in the order they were added.
+
+  If on_upsert is given, it is called with the model, the number of records written and
+  the seconds taken once each model's records are flushed.
+
+  Records added with add_after (e.g. a marker that the records of a page were written) are
+  upserted at the end of the next flush, and only if every record the buffer was given has
+  been written: once any record failed, they are discarded.
+  """
+
+  def __init__(self, sessionmaker, flush_size=1000, flush_interval=5.0, key_cache=None, logger=logger, on_upsert=None):
+    self.sessionmaker = sessionmaker
+    self.key_cache = key_cache
+    self.on_upsert = on_upsert
+    self.flush_size = flush_size
+    self.flush_interval = flush_interval
+    self.logger = logger
+    self.records = {}
+    self.after = {}
+    self.size = 0
+    self.has_failed = False
+    self.last_flushed_at = time.monotonic()
+    self.lock = threading.Lock()
+    self.flush_lock = threading.Lock()
+
+  def __len__(self):
+    return self.size
+
+  def get(self, model, record):
+    """
+    Return a copy of the buffered record with the same primary key as record, if any.
+    """
+    key = _primary_key(model, record)
+    with self.lock:
+      current = self.records.get(model, {}).get(key)
+      return dict(current) if current else None
+
+  def add(self, model, record):
+    key = _primary_key(model, record)
+    with self.lock:
+      bucket = self.records.setdefault(model, {})
+      current = bucket.get(key)
+      if current:
+        current.update(record)
+      else:
+        bucket[key] = dict(record)
+        self.size += 1
+    if self.should_flush():
+      self.flush()
+
+  def add_after(self, model, record):
+    key = _primary_key(model, record)
+    with self.lock:
+      bucket = self.after.setdefault(model, {})
+      bucket[key] = {**bucket.get(key, {}), **record}
+
+  def should_flush(self):
+    if (self.flush_size is not None) and (self.size >= self.flush_size):
+      return True
+    elapsed = time.monotonic() - self.last_flushed_at
+    return (self.flush_interval is not None) and (elapsed >= self.flush_interval)
+
+  def flush(self):
+    """
+    Upsert all buffered records and empty the buffer, returning the number of records written.
+
+    If the bulk upsert of a model's records fails, each record is retried individually
+    with upsert_dict so that a single bad record cannot discard the rest of the batch.
+    """
+    with self.flush_lock:
+      with self.lock:
+        records, self.records, self.size = self.records, {}, 0
+        after, self.after = self.after, {}
+        self.last_flushed_at = time.monotonic()
+      num_written = self._flush(records)
+      self.has_failed = self.has_failed or num_written < sum(len(r) for r in records.values())
+      if self.has_failed:
+        num_discarded = sum(len(r) for r in after.values())
+        if num_discarded:
+          self.logger.warning(f"Discarded {num_discarded} records to write after the buffered records, since some of those failed.")
+        return num_written
+      return num_written + self._flush(after)
+
+  def _flush(self, records):
+    num_written = 0
+    for model in sorted(records, key=_table_order):
+      rows = list(records[model].values())
+      start = time.monotonic()
+      try:
+        upsert_dicts(self.sessionmaker, model, rows)
+        written = rows
+      except Exception as e:
+        self.logger.error(
+          f"Encountered exception '{e}' when bulk upserting {len(rows)} {model.__name__} records; "
+          "retrying each record individually."
+        )
+        written = []
+        for r in rows:
+          try:
+            upsert_dict(self.sessionmaker, model, r)
+            written.append(r)
+          except Exception as e:
+            self.logger.error(f"Encountered exception '{e}' when upserting {model.__name__} record {r}")
+      num_written += len(written)
+      if self.on_upsert is not None:
+        self.on_upsert(model, len(written), time.monotonic() - start)
+      if self.key_cache is not None:
+        for r in written:
+          self.key_cache.add(model, r)
+    return num_written
+
+
+# Connection settings that trade durability for write throughput during bulk loads
+BULK_LOAD_STATEMENTS = {
+  'sqlite': [
+    'PRAGMA synchronous = OFF',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -{cache_size_kib}',
+  ],
+  'postgresql': [
+    'SET synchronous_commit TO OFF',
+  ],
+  'mysql': [
+    'SET SESSION unique_checks = 0',
+  ],
+}
+
+def secondary_indexes(models):
+  """
+  Return the (non primary key) indexes declared on the tables of the provided models.
+  """
+  return [index for model in models for index in model.__table__.indexes]
+
+def _index_exists(engine, index):
+  return index.name in {i['name'] for i in inspect(engine).get_indexes(index.table.name)}
+
+def drop_indexes(engine, indexes):
+  """
+  Drop the provided indexes if they exist, returning those that were dropped.
+
+  Another process may drop the same index concurrently, in which case the index counts as
+  dropped (by either process).
+  """
+  dropped = []
+  for index in indexes:
+    try:
+      index.drop(engine, checkfirst=True)
+      dropped.append(index)
+    except sqlalchemy.exc.DBAPIError as e:
+      if not _index_exists(engine, index):
+        dropped.append(index)
+        continue
+      # e.g. mysql refuses to drop indexes required by a foreign key constraint
+      logger.warning(f"Could not drop index {index.name}: {e}")
+  return dropped
+
+def create_indexes(engine, indexes):
+  """
+  Create the provided indexes if they do not exist, such that another process creating
+  the same index concurrently does not fail the creation.
+  """
+  for index in indexes:
+    try:
+      index.create(engine, checkfirst=True)
+    except sqlalchemy.exc.DBAPIError:
+      if not _index_exists(engine, index):
+        raise
+
+def analyze(engine, models):
+  """
+  Update the query planner statistics of the tables of the provided models.
+  """
+  tables = [model.__tablename__ for model in models]
+  if engine.dialect.name == 'mysql':
+    statements = [f"ANALYZE TABLE {', '.join(tables)}"]
+  elif engine.dialect.name in ('sqlite', 'postgresql'):
+    statements = [f"ANALYZE {table}" for table in tables]
+  else:
+    return
+  with engine.begin() as conn:
+    for stmt in statements:
+      conn.execute(text(stmt))
+
+
+class BulkLoadSettings(object):
+  """
+  Apply the dialect's BULK_LOAD_STATEMENTS to each connection checked out from an engine's pool.
+
+  For sqlite, the database is also switched to write-ahead logging (which persists).
+  When the settings are removed, the pooled connections of file-backed databases are
+  disposed such that no connection keeps the bulk load settings.
+  """
+
+  def __init__(self, engine, cache_size_kib=256 * 1024):
+    self.engine = engine
+    self.statements = [
+      stmt.format(cache_size_kib=cache_size_kib)
+      for stmt in BULK_LOAD_STATEMENTS.get(engine.dialect.name, [])
+    ]
+
+  def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+    cursor = dbapi_connection.cursor()
+    for stmt in self.statements:
+      cursor.execute(stmt)
+    cursor.close()
+
+  @property
+  def is_in_memory(self):
+    return self.engine.dialect.name == 'sqlite' and self.engine.url.database in (None, '', ':memory:')
+
+  def apply(self):
+    if self.engine.dialect.name == 'sqlite' and not self.is_in_memory:
+      with self.engine.connect() as conn:
+        conn.exec_driver_sql('PRAGMA journal_mode = WAL')
+    event.listen(self.engine, 'checkout', self._on_checkout)
+
+  def remove(self):
+    if event.contains(self.engine, 'checkout', self._on_checkout):
+      event.remove(self.engine, 'checkout', self._on_checkout)
+      if not self.is_in_memory:
+        self.engine.dispose()
+
+
+class WriterPool(object):
+  """
+  Run blocking database writes on a pool of worker threads instead of the reactor thread.
+
+  Each call to submit returns a Deferred that fires with the result of the write once
+  it has run on a worker thread. At most max_pending writes are queued or running at
+  once: a further write waits (without blocking the reactor) in a DeferredSemaphore until
+  a worker thread has finished a write, and only then is handed to the thread pool. Its
+  Deferred fires later accordingly, such that a caller awaiting it (e.g. scrapy, for the
+  Deferred returned by an item pipeline) is throttled by the speed of the database.
+
+  The components writing to the same engine share one pool (see get_writer_pool), whose
+  worker threads are stopped once each of its users has closed it.
+  """
+
+  def __init__(self, num_threads=1, max_pending=100, name='seeder-db-writer'):
+    self.threadpool = ThreadPool(minthreads=num_threads, maxthreads=num_threads, name=name)
+    self.slots = defer.DeferredSemaphore(max_pending)
+    self.pending = set()
+    self.is_started = False
+    self.num_users = 1
+
+  def start(self):
+    # The reactor is imported on use, such that importing this module does not install it
+    from twisted.internet import reactor
+    if not self.is_started:
+      self.threadpool.start()
+      self._shutdown_trigger = reactor.addSystemEventTrigger('during', 'shutdown', self.threadpool.stop)
+      self.is_started = True
+
+  def submit(self, fn, *args, **kwargs):
+    from twisted.internet import reactor
+    self.start()
+    # The write is handed to the thread pool once a slot is free, which is released when it has run
+    d = self.slots.run(threads.deferToThreadPool, reactor, self.threadpool, fn, *args, **kwargs)
+    self.pending.add(d)
+
+    def _release(result):
+      self.pending.discard(d)
+      return result
+
+    return d.addBoth(_release)
+
+  def join(self):
+    """
+    Return a Deferred that fires once all submitted writes have finished, including
+    any writes submitted by the callbacks of writes that were pending.
+    """
+    if not self.pending:
+      return defer.succeed(None)
+    d = defer.DeferredList(list(self.pending), consumeErrors=True)
+    return d.addCallback(lambda _: self.join())
+
+  def close(self):
+    """
+    Return a Deferred that fires once all submitted writes have finished and, if this
+    was the pool's last user, the worker threads have been stopped.
+    """
+    def _stop(_):
+      from twisted.internet import reactor
+      self.num_users -= 1
+      if self.num_users > 0:
+        return
+      with _writer_pools_lock:
+        for (engine, pool) in list(_writer_pools.items()):
+          if pool is self:
+            del _writer_pools[engine]
+      if self.is_started:
+        reactor.removeSystemEventTrigger(self._shutdown_trigger)
+        self.threadpool.stop()
+        self.is_started = False
+
+    return self.join().addCallback(_stop)
+
+
+_writer_pools = {}
+_writer_pools_lock = threading.Lock()
+
+def get_writer_pool(engine, num_threads=1, max_pending=100):
+  """
+  Return the WriterPool that writes to an engine, creating it on first use.
+
+  Every component of a process that writes to the same engine (e.g. the DatabasePipeline
+  and the UrlCacheMiddleware) shares its pool, such that max_pending bounds all of their
+  writes and sqlite, which supports a single writer, is only ever written by 1 thread.
+  Each caller must close the pool once it is done with it.
+  """
+  if num_threads > 1 and engine.dialect.name == 'sqlite':
+    logger.warning(f"sqlite supports only 1 concurrent writer; ignoring writer_threads={num_threads}.")
+    num_threads = 1
+  with _writer_pools_lock:
+    pool = _writer_pools.get(engine)
+    if pool is None:
+      pool = _writer_pools[engine] = WriterPool(num_threads=num_threads, max_pending=max_pending)
+    else:
+      pool.num_users += 1
+    return pool
+
+
+def __getattr__(name):
+  # The default engine is created lazily on first access, such that importing the
+  # seeder modules neither reads the project settings nor requires a connection string.
+  if name == 'default_engine':
+    return get_engine()
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-default_engine = get_engine()
 
 class DatabaseMixin(object):
-  def __init__(self, engine=default_engine, **kwargs):
+  """
+  Provide an engine & sessionmaker, using the default engine (see get_engine) if none is given.
+
+  The default engine is only created when first used, rather than when the component is
+  constructed or its module is imported. The sessionmaker is a scoped_session registry
+  that provides each thread (e.g. each WriterPool thread) with its own session, and hence
+  its own pooled connection, such that writes from different threads run in parallel.
+  """
+
+  def __init__(self, engine=None, **kwargs):
     super().__init__(**kwargs)
-    self.engine = engine
-    self.sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine)
+    self._engine = engine
+    self._sessionmaker = None
+
+  @property
+  def engine(self):
+    if self._engine is None:
+      self._engine = get_engine()
+    return self._engine
+
+  @property
+  def sessionmaker(self):
+    if self._sessionmaker is None:
+      self._sessionmaker = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=self.engine))
+    return self._sessionmaker
+
   def create_all(self, base_model):
-    base_model.metadata.create_all(self.engine)
+    create_all(self.engine, base_model)
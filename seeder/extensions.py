@@ -0,0 +1,153 @@
+"""
+Scrapy extensions of the crawl (see the EXTENSIONS setting).
+"""
+import logging
+from urllib.parse import urlparse
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.extensions.throttle import AutoThrottle
+from twisted.internet import task
+
+from seeder.util import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class EndpointThrottle(AutoThrottle):
+  """
+  An AutoThrottle whose delay adapts to the latency of each download slot separately, with
+  the target_concurrency, min_delay & max_delay of the slot in the DOWNLOAD_SLOTS setting
+  (e.g. the endpoints' slots of TennisExplorerSpider.ENDPOINT_PARSERS), defaulting to the
+  AUTOTHROTTLE_TARGET_CONCURRENCY, DOWNLOAD_DELAY & AUTOTHROTTLE_MAX_DELAY settings.
+
+  Nb this overrides the private _spider_opened & _adjust_delay hooks of scrapy's AutoThrottle
+  (as of scrapy 2.19), whose use by its response_downloaded handler is pinned by a test.
+  """
+
+  def __init__(self, crawler):
+    super().__init__(crawler)
+    self.slot_settings = {}
+
+  def _spider_opened(self, spider):
+    super()._spider_opened(spider)
+    # The spider may have added its slots to the settings (see Spider.update_settings)
+    self.slot_settings = self.crawler.settings.getdict('DOWNLOAD_SLOTS')
+
+  def _adjust_delay(self, slot, latency, response):
+    config = self.slot_settings.get(response.meta.get('download_slot'), {})
+    target_delay = latency / config.get('target_concurrency', self.target_concurrency)
+    # As the AutoThrottle: move halfway to the target delay, or straight up to it
+    new_delay = max(target_delay, (slot.delay + target_delay) / 2.0)
+    new_delay = min(max(config.get('min_delay', self.mindelay), new_delay), config.get('max_delay', self.maxdelay))
+    # Error pages (and redirects) are usually quick, so they may only increase the delay
+    if response.status != 200 and new_delay <= slot.delay:
+      return
+    slot.delay = new_delay
+
+
+# Sent by the spider once it parsed a page (with the response, parse_seconds, num_items &
+# num_links), and by the DatabasePipeline once it upserted rows of a model (with the model,
+# num_rows & seconds), possibly from its writer threads
+page_parsed = object()
+rows_upserted = object()
+
+
+class CrawlMetrics(object):
+  """
+  Record histograms of the download latency, parse time, items & links of the pages of each
+  endpoint, the HTTP cache hits & misses of each endpoint, and histograms of the upsert time
+  & counts of the rows written of each model (see the SEEDER_METRICS_ settings).
+
+  The metrics are exported every interval seconds and when the spider is closed: to the
+  crawl's stats (a summary of each histogram under seeder/metrics/), and, if textfile is
+  given, to a file in the Prometheus text format (e.g. in the directory of the node
+  exporter's textfile collector), which is replaced atomically.
+  """
+
+  def __init__(self, crawler, textfile=None, interval=60.0):
+    self.crawler = crawler
+    self.stats = crawler.stats
+    self.textfile = textfile
+    self.interval = interval
+    self.cache_enabled = crawler.settings.getbool('HTTPCACHE_ENABLED')
+    self.spider = None
+    self.endpoints = ()
+    self.loop = None
+    self.registry = metrics.MetricRegistry()
+    self.registry.histogram('seeder_download_latency_seconds', "Download latency of the pages of each endpoint.", metrics.LATENCY_BUCKETS)
+    self.registry.histogram('seeder_parse_seconds', "Parse time of the pages of each endpoint.", metrics.DURATION_BUCKETS)
+    self.registry.histogram('seeder_page_items', "Number of items parsed from the pages of each endpoint.", metrics.COUNT_BUCKETS)
+    self.registry.histogram('seeder_page_links', "Number of links parsed from the pages of each endpoint.", metrics.COUNT_BUCKETS)
+    self.registry.counter('seeder_httpcache_requests_total', "Number of the pages of each endpoint served from (hit) or not found in (miss) the HTTP cache.")
+    self.registry.histogram('seeder_db_upsert_seconds', "Time of the database upserts of each model.", metrics.DURATION_BUCKETS)
+    self.registry.counter('seeder_db_rows_total', "Number of the database rows upserted of each model.")
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    settings = crawler.settings
+    if not settings.getbool('SEEDER_METRICS_ENABLED'):
+      raise NotConfigured
+    extension = cls(
+      crawler,
+      textfile=settings.get('SEEDER_METRICS_TEXTFILE'),
+      interval=settings.getfloat('SEEDER_METRICS_INTERVAL', 60.0),
+    )
+    crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+    crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+    crawler.signals.connect(extension.response_received, signal=signals.response_received)
+    crawler.signals.connect(extension.page_parsed, signal=page_parsed)
+    crawler.signals.connect(extension.rows_upserted, signal=rows_upserted)
+    return extension
+
+  def endpoint(self, response):
+    # The label of the endpoint of a response, bounded to the spider's endpoints
+    path = urlparse(response.url).path
+    return path.strip('/') if path in self.endpoints else 'other'
+
+  def spider_opened(self, spider):
+    self.spider = spider
+    self.endpoints = tuple(getattr(spider, 'ENDPOINT_PARSERS', ()))
+    if self.interval:
+      self.loop = task.LoopingCall(self.export)
+      self.loop.start(self.interval, now=False)
+
+  def spider_closed(self, spider, reason):
+    if self.loop is not None and self.loop.running:
+      self.loop.stop()
+    self.export()
+
+  def response_received(self, response, request, spider):
+    endpoint = self.endpoint(response)
+    cached = 'cached' in response.flags
+    if self.cache_enabled:
+      self.registry.inc('seeder_httpcache_requests_total', endpoint=endpoint, result='hit' if cached else 'miss')
+    # Cached responses were not downloaded
+    latency = response.meta.get('download_latency')
+    if not cached and latency is not None:
+      self.registry.observe('seeder_download_latency_seconds', latency, endpoint=endpoint)
+
+  def page_parsed(self, response, parse_seconds, num_items, num_links):
+    endpoint = self.endpoint(response)
+    self.registry.observe('seeder_parse_seconds', parse_seconds, endpoint=endpoint)
+    self.registry.observe('seeder_page_items', num_items, endpoint=endpoint)
+    self.registry.observe('seeder_page_links', num_links, endpoint=endpoint)
+
+  def rows_upserted(self, model, num_rows, seconds):
+    self.registry.observe('seeder_db_upsert_seconds', seconds, model=model.__name__)
+    self.registry.inc('seeder_db_rows_total', num_rows, model=model.__name__)
+
+  def export(self):
+    """
+    Set the metrics' stats (e.g. seeder/metrics/parse_seconds/match-detail), and write the
+    textfile, if any.
+    """
+    for (name, metric) in self.registry.metrics.items():
+      for (labels, value) in self.registry.series(name).items():
+        key = '/'.join(['seeder/metrics', name[len('seeder_'):]] + [v for (_, v) in labels])
+        self.stats.set_value(key, value.summary() if metric['type'] == 'histogram' else value)
+    if self.textfile:
+      try:
+        self.registry.write_textfile(self.textfile, const_labels={'spider': getattr(self.spider, 'name', '')})
+      except OSError as e:
+        logger.error(f"Failed to write the crawl metrics to '{self.textfile}': {e}")
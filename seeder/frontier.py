@@ -0,0 +1,356 @@
+"""
+A crawl frontier shared by any number of worker processes, stored in the frontier table of
+the seeder database, and a scrapy scheduler that pulls its requests from the frontier (see
+the SEEDER_FRONTIER_ settings).
+"""
+import datetime
+import heapq
+import itertools
+import logging
+import pickle
+import time
+import uuid
+
+from scrapy.core.scheduler import BaseScheduler
+from scrapy.utils.request import request_from_dict
+from sqlalchemy import and_, func, or_, select, update
+from twisted.internet import task
+
+from seeder.db import DatabaseMixin, insert_new_dicts
+from seeder.models import BaseModel, FrontierRequest, FrontierStatus
+
+logger = logging.getLogger(__name__)
+
+# The fingerprint of a request claimed from the frontier
+FRONTIER_META_KEY = 'frontier_fingerprint'
+
+# Sent (with the response) by the FrontierMiddleware once the output of a response's
+# callback has been consumed, i.e. once the request claimed from the frontier is done
+request_processed = object()
+
+
+class Frontier(DatabaseMixin):
+  """
+  A queue of requests in the frontier table, shared by the workers that push to & claim
+  from the same queue (name).
+
+  Requests are deduplicated by their fingerprint: a request already in the queue (whether
+  pending, leased or done) is not pushed again. Workers claim the pending requests of the
+  highest priority with a lease of lease_secs seconds, which they renew while they hold the
+  requests. A claim is a single conditional UPDATE of the candidate rows, such that each row
+  is claimed by at most one worker on any database (incl. sqlite) without row locks. Requests
+  whose lease expired (e.g. of a killed worker) are claimed again, until they were claimed
+  max_attempts times.
+  """
+
+  CLAIM_ROUNDS = 3
+
+  def __init__(self, queue, engine=None, lease_secs=300, max_attempts=3):
+    super().__init__(engine=engine)
+    self.queue = queue
+    self.lease = datetime.timedelta(seconds=lease_secs)
+    self.max_attempts = max_attempts
+
+  def _claimable(self, now):
+    return and_(
+      FrontierRequest.queue == self.queue,
+      FrontierRequest.attempts < self.max_attempts,
+      or_(
+        FrontierRequest.status == FrontierStatus.pending,
+        and_(FrontierRequest.status == FrontierStatus.leased, FrontierRequest.lease_expires_at < now),
+      ),
+    )
+
+  def push(self, rows):
+    """
+    Insert the rows (see FrontierRequest.make_row) of the requests not yet in the queue,
+    returning the number inserted.
+    """
+    return insert_new_dicts(self.sessionmaker, FrontierRequest, rows)
+
+  def claim(self, owner, limit):
+    """
+    Lease up to limit claimable requests to the owner, and return their (fingerprint, payload).
+    """
+    lease_id = uuid.uuid4()
+    for _ in range(self.CLAIM_ROUNDS):
+      now = datetime.datetime.utcnow()
+      with self.sessionmaker() as session:
+        claimed = session.execute(
+          select(func.count()).where(FrontierRequest.queue == self.queue, FrontierRequest.lease_id == lease_id)
+        ).scalar()
+        candidates = session.execute(
+          select(FrontierRequest.fingerprint)
+          .where(self._claimable(now))
+          .order_by(FrontierRequest.priority.desc(), FrontierRequest.created_at)
+          .limit(limit - claimed)
+        ).scalars().all()
+        # Ends the read transaction, such that the claim is a write transaction of its own
+        session.commit()
+        if not candidates:
+          break
+        # Only the candidates that are still claimable (i.e. not claimed by another worker
+        # meanwhile) are leased
+        result = session.execute(
+          update(FrontierRequest)
+          .where(FrontierRequest.fingerprint.in_(candidates), self._claimable(now))
+          .values(
+            status=FrontierStatus.leased,
+            lease_owner=owner,
+            lease_id=lease_id,
+            lease_expires_at=now + self.lease,
+            attempts=FrontierRequest.attempts + 1,
+          )
+        )
+        session.commit()
+        if claimed + result.rowcount >= limit:
+          break
+    with self.sessionmaker() as session:
+      return session.execute(
+        select(FrontierRequest.fingerprint, FrontierRequest.payload)
+        .where(FrontierRequest.queue == self.queue, FrontierRequest.lease_id == lease_id)
+        .order_by(FrontierRequest.priority.desc(), FrontierRequest.created_at)
+      ).all()
+
+  def _update_leased(self, owner, values, fingerprints=None):
+    clauses = [
+      FrontierRequest.queue == self.queue,
+      FrontierRequest.status == FrontierStatus.leased,
+      FrontierRequest.lease_owner == owner,
+    ]
+    if fingerprints is not None:
+      clauses.append(FrontierRequest.fingerprint.in_(fingerprints))
+    with self.sessionmaker() as session:
+      result = session.execute(update(FrontierRequest).where(*clauses).values(**values))
+      session.commit()
+      return result.rowcount
+
+  def renew(self, owner):
+    """
+    Extend the leases of the requests held by the owner, returning their number.
+    """
+    return self._update_leased(owner, {'lease_expires_at': datetime.datetime.utcnow() + self.lease})
+
+  def complete(self, owner, fingerprints):
+    """
+    Mark the requests leased to the owner as done.
+    """
+    if not fingerprints:
+      return 0
+    return self._update_leased(owner, {'status': FrontierStatus.done, 'lease_expires_at': None}, fingerprints=list(fingerprints))
+
+  def release(self, owner, fingerprints=None):
+    """
+    Return the requests still leased to the owner (or those of the fingerprints, e.g. whose
+    download failed) to the queue, such that other workers may attempt them. Their attempts
+    stay counted, so a request released max_attempts times is not claimed again.
+    """
+    values = {'status': FrontierStatus.pending, 'lease_owner': None, 'lease_id': None, 'lease_expires_at': None}
+    if fingerprints is not None:
+      if not fingerprints:
+        return 0
+      fingerprints = list(fingerprints)
+    return self._update_leased(owner, values, fingerprints=fingerprints)
+
+  def has_pending(self, owner):
+    """
+    Return whether the queue has requests that the owner may yet claim or that other workers
+    hold (whose pages may link to further requests).
+    """
+    now = datetime.datetime.utcnow()
+    held_by_others = and_(
+      FrontierRequest.queue == self.queue,
+      FrontierRequest.status == FrontierStatus.leased,
+      FrontierRequest.lease_owner != owner,
+    )
+    with self.sessionmaker() as session:
+      stmt = select(FrontierRequest.fingerprint).where(or_(self._claimable(now), held_by_others)).limit(1)
+      return session.execute(stmt).first() is not None
+
+  def counts(self):
+    """
+    Return the number of requests of the queue by status name.
+    """
+    with self.sessionmaker() as session:
+      rows = session.execute(
+        select(FrontierRequest.status, func.count())
+        .where(FrontierRequest.queue == self.queue)
+        .group_by(FrontierRequest.status)
+      ).all()
+    return {status.name: count for (status, count) in rows}
+
+
+class FrontierScheduler(BaseScheduler):
+  """
+  A scrapy scheduler (see SCHEDULER) whose requests are pushed to & claimed from a Frontier,
+  such that any number of workers crawling the same queue share its work dynamically.
+
+  Enqueued requests are buffered and pushed in batches, and requests are claimed in batches
+  of batch_size into a local priority queue. A request is done once the output of its
+  response's callback has been consumed (see FrontierMiddleware); the requests it yielded
+  are always pushed before it is marked done, so the pages of a killed worker are reclaimed
+  with their links once their leases expire. Retries of a claimed request (e.g. by the
+  RetryMiddleware) stay with the worker that holds its lease.
+
+  A claimed request whose download failed (e.g. after its retries, or on an IgnoreRequest)
+  never reaches the spider middlewares, so the scheduler gives the claimed requests that
+  have no errback its own, which releases them to the queue with their attempt counted
+  (before scrapy logs the error as usual).
+  """
+
+  def __init__(self, crawler, frontier, batch_size=16, flush_interval=1.0, flush_size=500, poll_interval=1.0):
+    self.crawler = crawler
+    self.frontier = frontier
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.flush_size = flush_size
+    self.poll_interval = poll_interval
+    self.stats = crawler.stats
+    self.spider = None
+    self.owner = None
+    self.queue = []
+    self.counter = itertools.count()
+    self.pushes = {}
+    self.completions = set()
+    self.failures = set()
+    self.last_empty_claim = None
+    self.loops = []
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    settings = crawler.settings
+    frontier = Frontier(
+      settings.get('SEEDER_FRONTIER_QUEUE') or crawler.spidercls.name,
+      lease_secs=settings.getfloat('SEEDER_FRONTIER_LEASE_SECS', 300),
+      max_attempts=settings.getint('SEEDER_FRONTIER_MAX_ATTEMPTS', 3),
+    )
+    return cls(
+      crawler,
+      frontier,
+      batch_size=settings.getint('SEEDER_FRONTIER_BATCH_SIZE', 0) or settings.getint('CONCURRENT_REQUESTS'),
+      flush_interval=settings.getfloat('SEEDER_FRONTIER_FLUSH_INTERVAL', 1.0),
+      flush_size=settings.getint('SEEDER_FRONTIER_FLUSH_SIZE', 500),
+    )
+
+  def open(self, spider):
+    self.spider = spider
+    self.owner = spider.crawl_id
+    self.frontier.create_all(BaseModel)
+    self.crawler.signals.connect(self.request_processed, signal=request_processed)
+    self.loops = [
+      task.LoopingCall(self.flush),
+      task.LoopingCall(self.frontier.renew, self.owner),
+    ]
+    self.loops[0].start(self.flush_interval, now=False)
+    self.loops[1].start(self.frontier.lease.total_seconds() / 3, now=False)
+    spider.logger.info(f"Crawling frontier queue '{self.frontier.queue}': {self.frontier.counts()}")
+
+  def close(self, reason):
+    for loop in self.loops:
+      if loop.running:
+        loop.stop()
+    self.flush()
+    released = self.frontier.release(self.owner)
+    if released:
+      self.spider.logger.warning(f"Released {released} unfinished requests to frontier queue '{self.frontier.queue}'.")
+    self.spider.logger.info(f"Closed frontier queue '{self.frontier.queue}': {self.frontier.counts()}")
+
+  def flush(self):
+    """
+    Push the buffered requests, then mark the processed requests done and release the
+    failed ones.
+    """
+    if self.pushes:
+      rows = list(self.pushes.values())
+      self.pushes = {}
+      inserted = self.frontier.push(rows)
+      self.stats.inc_value('frontier/pushed', inserted)
+      self.stats.inc_value('frontier/duplicate', len(rows) - inserted)
+    if self.completions:
+      (completions, self.completions) = (self.completions, set())
+      self.frontier.complete(self.owner, completions)
+      self.stats.inc_value('frontier/done', len(completions))
+    if self.failures:
+      (failures, self.failures) = (self.failures, set())
+      self.frontier.release(self.owner, failures)
+      self.stats.inc_value('frontier/failed', len(failures))
+
+  def request_processed(self, response, spider):
+    fingerprint = response.meta.get(FRONTIER_META_KEY)
+    if fingerprint is not None:
+      self.completions.add(fingerprint)
+
+  def download_failed(self, failure):
+    """
+    The errback of the requests claimed from the frontier, which returns the failure such
+    that scrapy handles it as if the request had no errback.
+    """
+    fingerprint = failure.request.meta.get(FRONTIER_META_KEY)
+    if fingerprint is not None:
+      self.failures.add(fingerprint)
+    return failure
+
+  def _push_local(self, request):
+    heapq.heappush(self.queue, (-request.priority, next(self.counter), request))
+
+  def enqueue_request(self, request):
+    if request.dont_filter and FRONTIER_META_KEY in request.meta:
+      # A retry of a request claimed by this worker, which still holds its lease
+      self._push_local(request)
+      return True
+    claimed = request.meta.get(FRONTIER_META_KEY)
+    if claimed is not None:
+      # A redirect of a claimed request, which is a new request of the frontier: the claimed
+      # request is done, since its redirect's response reports the new request's fingerprint
+      self.completions.add(claimed)
+      meta = {k: v for (k, v) in request.meta.items() if k != FRONTIER_META_KEY}
+      request = request.replace(meta=meta)
+    if request.errback == self.download_failed:
+      request = request.replace(errback=None)
+    fingerprint = self.crawler.request_fingerprinter.fingerprint(request).hex()
+    if fingerprint in self.pushes:
+      self.stats.inc_value('frontier/duplicate')
+      return True
+    self.pushes[fingerprint] = FrontierRequest.make_row(
+      queue=self.frontier.queue,
+      fingerprint=fingerprint,
+      url=request.url,
+      priority=request.priority,
+      payload=pickle.dumps(request.to_dict(spider=self.spider), protocol=4),
+    )
+    self.stats.inc_value('frontier/enqueued')
+    if len(self.pushes) >= self.flush_size:
+      self.flush()
+    return True
+
+  def _claim(self):
+    if self.last_empty_claim is not None and time.monotonic() - self.last_empty_claim < self.poll_interval:
+      return
+    self.flush()
+    rows = self.frontier.claim(self.owner, self.batch_size)
+    self.last_empty_claim = None if rows else time.monotonic()
+    for (fingerprint, payload) in rows:
+      request = request_from_dict(pickle.loads(payload), spider=self.spider)
+      request.meta[FRONTIER_META_KEY] = fingerprint
+      if request.errback is None:
+        request.errback = self.download_failed
+      self._push_local(request)
+    self.stats.inc_value('frontier/claimed', len(rows))
+
+  def next_request(self):
+    if not self.queue:
+      self._claim()
+    if not self.queue:
+      return None
+    (_, _, request) = heapq.heappop(self.queue)
+    self.stats.inc_value('frontier/dequeued')
+    return request
+
+  def has_pending_requests(self):
+    if self.queue or self.pushes:
+      return True
+    self.flush()
+    return self.frontier.has_pending(self.owner)
+
+  def __len__(self):
+    return len(self.queue) + len(self.pushes)
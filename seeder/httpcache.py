@@ -0,0 +1,405 @@
+"""
+The HTTP cache policy & storage of the crawl (see the HTTPCACHE_ settings), and a reader of
+the responses stored in the cache, e.g. to replay them through the parsers without the network.
+"""
+import datetime
+import mmap
+import os
+import pickle
+import re
+import sqlite3
+import time
+import uuid
+import zlib
+
+from importlib import import_module
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from scrapy.extensions.httpcache import DummyPolicy
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
+from scrapy.utils.response import response_from_dict
+
+from seeder.util.numeric import coerce_int
+from seeder.util.urls import date_from_qs
+
+# The ttls (in seconds) of the unsettled cached pages of each endpoint
+DEFAULT_TTLS = {
+  '/results/': 0,
+  '/next/': 0,
+  '/match-detail/': 0,
+}
+
+
+def cache_path(settings, spider_name):
+  """
+  Return the path of a spider's HTTP cache: the dbm file written by scrapy's DbmCacheStorage,
+  or the directory of the SegmentCacheStorage.
+  """
+  if load_object(settings['HTTPCACHE_STORAGE']) is SegmentCacheStorage:
+    return str(Path(data_path(settings['HTTPCACHE_DIR']), spider_name))
+  return str(Path(data_path(settings['HTTPCACHE_DIR']), f'{spider_name}.db'))
+
+
+def iter_cached_responses(path, dbm_module='dbm', url_filter=None):
+  """
+  Yield (cached_at, response) for each response stored in an HTTP cache: a DbmCacheStorage
+  dbm file or a SegmentCache directory, where cached_at is the unix timestamp at which the
+  response was stored. If url_filter is given, only the responses of the urls for which
+  url_filter(url) is true are yielded (and, in a SegmentCache, read).
+  """
+  if os.path.isdir(path):
+    cache = SegmentCache(path, readonly=True)
+    try:
+      yield from cache.iter_responses(url_filter=url_filter)
+    finally:
+      cache.close()
+    return
+
+  db = import_module(dbm_module).open(str(path), 'r')
+  try:
+    for key in db.keys():
+      if not key.endswith(b'_data'):
+        continue
+      fingerprint = key[:-len(b'_data')]
+      cached_at = float(db[fingerprint + b'_time'])
+      response = response_from_dict(pickle.loads(db[key]))
+      if url_filter is None or url_filter(response.url):
+        yield (cached_at, response)
+  finally:
+    db.close()
+
+
+# The date in the header of a /match-detail/ page, e.g. <span class="upper">19.06.2022</span>
+MATCH_DATE_PATTERN = re.compile(rb'class="upper">\s*(\d{1,2})\.(\d{1,2})\.(\d{4})\s*<')
+
+
+def match_date(body):
+  """
+  Return the date of the match of a /match-detail/ page, if any.
+  """
+  m = MATCH_DATE_PATTERN.search(body)
+  if m is None:
+    return None
+  (day, month, year) = (int(g) for g in m.groups())
+  try:
+    return datetime.datetime(year, month, day)
+  except ValueError:
+    return None
+
+
+class SettledPolicy(DummyPolicy):
+  """
+  Serve the cached pages whose data is settled, and revalidate the pages whose data may
+  still change, such that a single crawl hits the cache for everything settled and the
+  network only for what can still change.
+
+  A page is settled once settle_days have passed since the end of its date: the date in
+  the query of a /results/ page, or the match date of a /match-detail/ page. A cached page
+  is fresh forever if it was cached after it settled. Otherwise (e.g. the /next/ pages,
+  today's pages, and pages cached before they settled) it is fresh for the ttl (in seconds)
+  of its endpoint; a ttl of 0 revalidates the page on every request. Pages of endpoints
+  without a ttl (e.g. robots.txt) are always fresh, as with the DummyPolicy.
+
+  Stale pages are refetched, and the cached page is only served if the server fails.
+  Server errors are never cached, since a settled page would be served forever.
+  """
+
+  def __init__(self, settings):
+    super().__init__(settings)
+    self.settle_age = datetime.timedelta(days=settings.getfloat('SEEDER_HTTPCACHE_SETTLE_DAYS', 2))
+    self.ttls = {
+      endpoint: float(ttl)
+      for (endpoint, ttl) in settings.getdict('SEEDER_HTTPCACHE_TTLS', DEFAULT_TTLS).items()
+    }
+
+  def settled_at(self, url, cachedresponse):
+    """
+    Return the (utc) datetime after which the page's data no longer changes, if known.
+    """
+    endpoint = urlparse(url).path
+    if endpoint == '/results/':
+      day = date_from_qs(url, on_errors='coerce')
+    elif endpoint == '/match-detail/':
+      day = match_date(cachedresponse.body)
+    else:
+      return None
+    if day is None:
+      return None
+    return day + datetime.timedelta(days=1) + self.settle_age
+
+  def is_cached_response_fresh(self, cachedresponse, request):
+    endpoint = urlparse_cached(request).path
+    if endpoint not in self.ttls:
+      return True
+    # The unix timestamp at which the page was cached, as set by the cache storage
+    cached_at = request.meta.get('cache_timestamp')
+    if cached_at is None:
+      return False
+    settled_at = self.settled_at(request.url, cachedresponse)
+    if settled_at is not None and cached_at >= settled_at.replace(tzinfo=datetime.timezone.utc).timestamp():
+      return True
+    ttl = self.ttls[endpoint]
+    return ttl > 0 and (time.time() - cached_at) < ttl
+
+  def should_cache_response(self, response, request):
+    return super().should_cache_response(response, request) and response.status < 500
+
+  def is_cached_response_valid(self, cachedresponse, response, request):
+    return response.status == 304 or response.status >= 500
+
+
+class SegmentCache(object):
+  """
+  A store of responses in append-only segment files, indexed by request fingerprint in an
+  sqlite index with metadata columns of each response's url: its endpoint (path), query
+  date (of e.g. /results/ pages) and match number (of /match-detail/ pages).
+
+  Each record is a (zlib compressed, if compress) pickle of the response's dict, appended
+  to the writer's active segment before its index row is committed, such that the index
+  only refers to complete records. Segments are read with memory maps, and the index is in
+  WAL mode, such that any number of reader processes may share the cache with its writers.
+  Each writer appends to its own segments, which are sealed once they reach segment_bytes
+  (or the writer is closed); only sealed segments are compacted (see compact).
+  """
+
+  INDEX = 'index.sqlite'
+  SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS responses (
+      fingerprint TEXT PRIMARY KEY,
+      url TEXT NOT NULL,
+      endpoint TEXT,
+      query_date TEXT,
+      match_number INTEGER,
+      status INTEGER,
+      cached_at REAL NOT NULL,
+      segment TEXT NOT NULL,
+      offset INTEGER NOT NULL,
+      length INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_responses_endpoint_query_date ON responses (endpoint, query_date)",
+    "CREATE INDEX IF NOT EXISTS ix_responses_match_number ON responses (match_number)",
+    "CREATE INDEX IF NOT EXISTS ix_responses_segment ON responses (segment)",
+    "CREATE TABLE IF NOT EXISTS segments (name TEXT PRIMARY KEY, is_sealed INTEGER NOT NULL DEFAULT 0)",
+  )
+
+  def __init__(self, directory, compress=True, segment_bytes=256 * 2**20, readonly=False):
+    self.directory = str(directory)
+    self.compress = compress
+    self.segment_bytes = segment_bytes
+    self.readonly = readonly
+    if not readonly:
+      os.makedirs(self.directory, exist_ok=True)
+    index_path = os.path.join(self.directory, self.INDEX)
+    if readonly:
+      index_path = Path(index_path).absolute().as_uri() + '?mode=ro'
+    self.index = sqlite3.connect(index_path, timeout=30, isolation_level=None, uri=readonly)
+    if not readonly:
+      self.index.execute("PRAGMA journal_mode=WAL")
+      self.index.execute("PRAGMA synchronous=NORMAL")
+      for stmt in self.SCHEMA:
+        self.index.execute(stmt)
+    self.maps = {}
+    self.segment = None
+    self.segment_file = None
+
+  def _path(self, segment):
+    return os.path.join(self.directory, segment)
+
+  def _read(self, segment, offset, length):
+    mm = self.maps.get(segment)
+    if mm is None or len(mm) < offset + length:
+      # (Re)map the segment, which may have grown since it was mapped
+      if mm is not None:
+        mm.close()
+      with open(self._path(segment), 'rb') as f:
+        mm = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    payload = mm[offset:offset + length]
+    # Uncompressed records are pickles, which start with the PROTO opcode
+    return pickle.loads(payload if payload[:1] == pickle.PROTO else zlib.decompress(payload))
+
+  def get(self, fingerprint):
+    """
+    Return (cached_at, response dict) of the response stored for a request fingerprint, if any.
+    """
+    for _ in range(2):
+      row = self.index.execute(
+        "SELECT cached_at, segment, offset, length FROM responses WHERE fingerprint = ?", (fingerprint,)
+      ).fetchone()
+      if row is None:
+        return None
+      (cached_at, segment, offset, length) = row
+      try:
+        return (cached_at, self._read(segment, offset, length))
+      except FileNotFoundError:
+        # The segment was compacted since the index was read, so the record has moved
+        continue
+    return None
+
+  def _open_segment(self):
+    self.segment = f'{int(time.time() * 1000)}-{os.getpid()}-{uuid.uuid4().hex[:8]}.seg'
+    self.segment_file = open(self._path(self.segment), 'ab', buffering=0)
+    self.index.execute("INSERT INTO segments (name) VALUES (?)", (self.segment,))
+
+  def _seal_segment(self):
+    if self.segment_file is not None:
+      self.segment_file.close()
+      self.index.execute("UPDATE segments SET is_sealed = 1 WHERE name = ?", (self.segment,))
+      self.segment = self.segment_file = None
+
+  def _append(self, payload):
+    if self.segment_file is not None and self.segment_file.tell() + len(payload) > self.segment_bytes:
+      self._seal_segment()
+    if self.segment_file is None:
+      self._open_segment()
+    offset = self.segment_file.tell()
+    self.segment_file.write(payload)
+    return (self.segment, offset, len(payload))
+
+  def put(self, fingerprint, data, cached_at=None):
+    """
+    Store a response dict (see Response.to_dict) for a request fingerprint.
+    """
+    assert not self.readonly
+    payload = pickle.dumps(data, protocol=4)
+    (segment, offset, length) = self._append(zlib.compress(payload) if self.compress else payload)
+    url = data['url']
+    endpoint = urlparse(url).path
+    query_date = date_from_qs(url, on_errors='coerce')
+    match_number = coerce_int(parse_qs(urlparse(url).query).get('id', [''])[-1]) if endpoint == '/match-detail/' else None
+    self.index.execute(
+      "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+      (
+        fingerprint, url, endpoint, query_date.date().isoformat() if query_date else None, match_number,
+        data.get('status'), cached_at or time.time(), segment, offset, length,
+      ),
+    )
+
+  def iter_responses(self, url_filter=None, endpoint=None, start_date=None, stop_date=None):
+    """
+    Yield (cached_at, response) for each stored response, in the order it was written (or
+    compacted) in.
+
+    The responses may be filtered by the endpoint & query date range in their index rows,
+    and by url_filter(url) before their records are read. A record whose segment was
+    compacted since the index was read is looked up again, and read from its new segment.
+    """
+    query = (
+      "SELECT fingerprint, url, cached_at, segment, offset, length FROM responses"
+      " LEFT JOIN segments ON segments.name = responses.segment"
+    )
+    (clauses, params) = ([], [])
+    if endpoint is not None:
+      clauses.append("endpoint = ?")
+      params.append(endpoint)
+    if start_date is not None:
+      clauses.append("query_date >= ?")
+      params.append(start_date.date().isoformat())
+    if stop_date is not None:
+      clauses.append("query_date <= ?")
+      params.append(stop_date.date().isoformat())
+    if clauses:
+      query += " WHERE " + " AND ".join(clauses)
+    rows = self.index.execute(query + " ORDER BY segments.rowid, offset", params).fetchall()
+    for (fingerprint, url, cached_at, segment, offset, length) in rows:
+      if url_filter is not None and not url_filter(url):
+        continue
+      try:
+        data = self._read(segment, offset, length)
+      except FileNotFoundError:
+        record = self.get(fingerprint)
+        if record is None:
+          continue
+        (cached_at, data) = record
+      yield (cached_at, response_from_dict(data))
+
+  def compact(self, min_dead_ratio=0.25):
+    """
+    Rewrite the live records of each sealed segment in which at least min_dead_ratio of the
+    bytes are dead (i.e. of responses since stored again) into new segments, and delete
+    the old segments. Return the number of bytes reclaimed.
+
+    Readers that have already mapped a deleted segment keep reading it until they unmap
+    it; readers that look a record up after it moved find it in its new segment.
+    """
+    assert not self.readonly
+    reclaimed = 0
+    sealed = [name for (name,) in self.index.execute("SELECT name FROM segments WHERE is_sealed = 1 ORDER BY name")]
+    for name in sealed:
+      size = os.path.getsize(self._path(name)) if os.path.exists(self._path(name)) else 0
+      live = self.index.execute(
+        "SELECT fingerprint, offset, length FROM responses WHERE segment = ? ORDER BY offset", (name,)
+      ).fetchall()
+      live_bytes = sum(length for (_, _, length) in live)
+      if size and (size - live_bytes) / size < min_dead_ratio:
+        continue
+      for (fingerprint, offset, length) in live:
+        mm = self.maps.get(name)
+        if mm is None or len(mm) < offset + length:
+          with open(self._path(name), 'rb') as f:
+            mm = self.maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (segment, new_offset, _) = self._append(mm[offset:offset + length])
+        # Only move the record if it was not stored again (by any writer) meanwhile
+        self.index.execute(
+          "UPDATE responses SET segment = ?, offset = ? WHERE fingerprint = ? AND segment = ? AND offset = ?",
+          (segment, new_offset, fingerprint, name, offset),
+        )
+      self.index.execute("DELETE FROM segments WHERE name = ?", (name,))
+      mm = self.maps.pop(name, None)
+      if mm is not None:
+        mm.close()
+      if size:
+        os.remove(self._path(name))
+      reclaimed += size - live_bytes
+    self._seal_segment()
+    return reclaimed
+
+  def close(self):
+    if not self.readonly:
+      self._seal_segment()
+    for mm in self.maps.values():
+      mm.close()
+    self.maps = {}
+    self.index.close()
+
+
+class SegmentCacheStorage(object):
+  """
+  A scrapy HTTP cache storage (see HTTPCACHE_STORAGE) that stores each spider's responses
+  in a SegmentCache in {HTTPCACHE_DIR}/{spider name}/.
+  """
+
+  def __init__(self, settings):
+    self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+    self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+    self.compress = settings.getbool('HTTPCACHE_GZIP')
+    self.segment_bytes = settings.getint('SEEDER_HTTPCACHE_SEGMENT_BYTES', 256 * 2**20)
+    self.cache = None
+
+  def open_spider(self, spider):
+    self.cache = SegmentCache(
+      os.path.join(self.cachedir, spider.name),
+      compress=self.compress,
+      segment_bytes=self.segment_bytes,
+    )
+    self._fingerprinter = spider.crawler.request_fingerprinter
+
+  def close_spider(self, spider):
+    self.cache.close()
+
+  def retrieve_response(self, spider, request):
+    entry = self.cache.get(self._fingerprinter.fingerprint(request).hex())
+    if entry is None:
+      return None
+    (cached_at, data) = entry
+    if 0 < self.expiration_secs < time.time() - cached_at:
+      return None
+    request.meta['cache_timestamp'] = cached_at
+    return response_from_dict(data)
+
+  def store_response(self, spider, request, response):
+    self.cache.put(self._fingerprinter.fingerprint(request).hex(), response.to_dict())
@@ -1,4 +1,4 @@
-from seeder.models import Match, MatchOdds, Player
+from seeder.models import Match, MatchOdds, MatchOddsSeries, Player
 
 import scrapy
 
@@ -13,12 +13,18 @@ def item_from_model(classname, model):
     for col in colnames
   }
   attr_names['__model__'] = model
+  # Items are pickled by reference to their class, e.g. when returned by parse worker processes
+  attr_names['__module__'] = __name__
   attr_names['make'] = lambda obj: obj.__model__.make(**dict(obj))
   attr_names['make_dependencies'] = lambda obj: obj.__model__.make_dependencies(**dict(obj))
   attr_names['make_with_dependencies'] = lambda obj: obj.__model__.make_with_dependencies(**dict(obj))
+  attr_names['make_row'] = lambda obj: obj.__model__.make_row(**dict(obj))
+  attr_names['make_dependency_rows'] = lambda obj: obj.__model__.make_dependency_rows(**dict(obj))
+  attr_names['make_rows_with_dependencies'] = lambda obj: obj.__model__.make_rows_with_dependencies(**dict(obj))
   return type(classname, (scrapy.Item,), attr_names) 
 
 
 MatchItem = item_from_model('MatchItem', Match)
 MatchOddsItem = item_from_model('MatchOddsItem', MatchOdds)
+MatchOddsSeriesItem = item_from_model('MatchOddsSeriesItem', MatchOddsSeries)
 PlayerItem = item_from_model('PlayerItem', Player)
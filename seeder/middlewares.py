@@ -1,34 +1,339 @@
+import datetime
 import logging
 
+from urllib.parse import urlparse, parse_qs
+
+import scrapy
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+from sqlalchemy import and_, exists, or_, select
+from twisted.internet import task
+
+from seeder.frontier import FrontierScheduler, request_processed
+from seeder.db import DatabaseMixin, UpsertBuffer, get_writer_pool, upsert_item, upsert_row
+from seeder.models import BaseModel, Crawl, CrawledUrl, Match, MatchOdds, MatchOddsSeries, MatchSurface
+from seeder.parsers import PARSERS_VERSION
+from seeder.util.fingerprint import FINGERPRINT_META_KEY, UNCHANGED_META_KEY, VOLATILE_PATTERNS, fingerprint_body
+from seeder.util.numeric import coerce_int
 
-from seeder.db import DatabaseMixin, default_engine, upsert_item
-from seeder.models import BaseModel, Crawl, CrawledUrl
+# Sent (with the url & body fingerprint of a changed page) by the UrlCacheMiddleware once
+# each item of the page was processed by the item pipelines without error
+page_scraped = object()
 
 
 class UrlCacheMiddleware(DatabaseMixin):
   """
-  Populate a crawl & URL metadata table of when pages have been crawled 
+  Populate a crawl & URL metadata table of when pages have been crawled
+
+  If flush_interval is positive, the metadata is written behind: the insert & update
+  of each URL's row are collapsed into a single buffered row state, and the buffered
+  rows are upserted in bulk every flush_interval seconds, when flush_size rows are
+  buffered, when the spider is idle, and when the spider is closed. Each flush is a
+  single transaction, so a killed process loses at most the URLs crawled since the
+  last flush but never leaves a partially written row in the crawled_urls table.
+
+  If writer_threads is positive, the metadata is written on the engine's WriterPool, which
+  is shared with the DatabasePipeline (see get_writer_pool), rather than on the reactor
+  thread. The insert & update of a URL's row upsert disjoint columns, so their order does
+  not matter. The pool tracks the pending writes, which are awaited when the spider is
+  closed, and bounds them: once it holds max_pending writes, the next one waits (without
+  blocking the reactor) until a write has finished.
+
+  If fingerprint_patterns is not None, a fingerprint of each response's body (with the
+  volatile fragments matching the patterns removed, and salted with the PARSERS_VERSION)
+  is compared to the one stored for its URL, as preloaded when the spider is opened.
+  Responses whose fingerprint is unchanged are flagged with the UNCHANGED_META_KEY in
+  their meta, such that the spider may skip parsing items from data that has already been
+  processed. The fingerprint of a changed page is not stored here: once the callback's
+  output was consumed and each of its items was processed by the item pipelines without
+  error (or drop), the page_scraped signal is sent, upon which the DatabasePipeline stores
+  it once the items are written. A page whose items failed is thus parsed again when next
+  crawled.
   """
 
-  def __init__(self, engine=default_engine):
+  def __init__(self, engine=None, writer_threads=0, writer_max_pending=100, flush_interval=0, flush_size=1000, fingerprint_patterns=None, stats=None):
     super().__init__(engine=engine)
+    self.fingerprint_patterns = fingerprint_patterns
+    self.stats = stats
+    self.writer_pool = None
+    if writer_threads > 0:
+      self.writer_pool = get_writer_pool(self.engine, num_threads=writer_threads, max_pending=writer_max_pending)
+    self.flush_interval = flush_interval
+    self.flush_size = flush_size
+    self.buffer = None
+    self.flush_loop = None
+    self.signals = None
+    self.fingerprints = {}
+    # The number of items not yet processed of each page being scraped, or None while its
+    # callback's output is being consumed
+    self.pages = {}
 
   @classmethod
   def from_crawler(cls, crawler):
-    middleware = cls()
+    middleware = cls(
+      writer_threads=crawler.settings.getint('SEEDER_DB_WRITER_THREADS', 0),
+      writer_max_pending=crawler.settings.getint('SEEDER_DB_WRITER_MAX_PENDING', 100),
+      flush_interval=crawler.settings.getfloat('SEEDER_URL_CACHE_FLUSH_INTERVAL', 0),
+      flush_size=crawler.settings.getint('SEEDER_URL_CACHE_FLUSH_SIZE', 1000),
+      fingerprint_patterns=cls._fingerprint_patterns(crawler.settings),
+      stats=crawler.stats,
+    )
     crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+    crawler.signals.connect(middleware.spider_idle, signal=signals.spider_idle)
+    crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+    crawler.signals.connect(middleware.item_scraped, signal=signals.item_scraped)
+    crawler.signals.connect(middleware.item_failed, signal=signals.item_dropped)
+    crawler.signals.connect(middleware.item_failed, signal=signals.item_error)
+    middleware.signals = crawler.signals
     return middleware
 
+  @staticmethod
+  def _fingerprint_patterns(settings):
+    if not settings.getbool('SEEDER_FINGERPRINT_ENABLED'):
+      return None
+    patterns = settings.getlist('SEEDER_FINGERPRINT_VOLATILE_PATTERNS', None)
+    if patterns is None:
+      return VOLATILE_PATTERNS
+    return [p.encode() for p in patterns]
+
+  def _write(self, spider, fn, *args):
+    if self.writer_pool is None:
+      return fn(*args)
+    d = self.writer_pool.submit(fn, *args)
+    d.addErrback(lambda f: spider.logger.error(f"Encountered exception '{f.value}' when writing crawl metadata {args}"))
+    return d
+
+  def _record(self, spider, record):
+    if self.buffer is None:
+      return self._write(spider, upsert_row, self.sessionmaker, CrawledUrl, record)
+    self.buffer.add(CrawledUrl, record)
+    if len(self.buffer) >= self.flush_size:
+      self.flush(spider)
+
+  def flush(self, spider):
+    if self.buffer is not None and len(self.buffer) > 0:
+      return self._write(spider, self.buffer.flush)
+
+  def load_fingerprints(self):
+    stmt = select(CrawledUrl.url_id, CrawledUrl.body_fingerprint).where(
+      CrawledUrl.is_crawled.is_(True),
+      CrawledUrl.body_fingerprint.is_not(None),
+    )
+    with self.sessionmaker() as session:
+      self.fingerprints = dict(session.execute(stmt).all())
+
+  def stored_fingerprint(self, url):
+    """
+    Return the body fingerprint stored for a crawled url when the spider was opened, if any.
+    """
+    return self.fingerprints.get(CrawledUrl.surrogate_key(url))
+
+  def check_fingerprint(self, response, spider):
+    fingerprint = fingerprint_body(response.body, self.fingerprint_patterns, version=PARSERS_VERSION)
+    is_unchanged = (fingerprint == self.stored_fingerprint(response.url))
+    response.meta[FINGERPRINT_META_KEY] = fingerprint
+    response.meta[UNCHANGED_META_KEY] = is_unchanged
+    if self.stats is not None:
+      key = 'hit' if is_unchanged else 'miss'
+      self.stats.inc_value(f'seeder/fingerprint/{key}', spider=spider)
+
   def process_spider_input(self, response, spider):
-    CrawledUrl.insert(self.sessionmaker, response.url)
+    if self.fingerprint_patterns is not None:
+      self.check_fingerprint(response, spider)
+    self._record(spider, CrawledUrl.insert_payload(response.url))
     return None
 
+  def _start_page(self, response, spider):
+    """
+    Record that a response was crawled, and return the state of its page if its items are
+    to be tracked (i.e. if its fingerprint changed).
+    """
+    self._record(spider, CrawledUrl.update_payload(spider, response.url))
+    if (self.fingerprint_patterns is None) or (response.meta.get(UNCHANGED_META_KEY) is not False):
+      return None
+    page = self.pages[response] = {'items': 0, 'processed': 0, 'is_consumed': False}
+    return page
+
   def process_spider_output(self, response, result, spider):
-    CrawledUrl.update(self.sessionmaker, spider, response.url)
-    for i in result:
-      yield i
+    page = self._start_page(response, spider)
+    if page is None:
+      yield from result
+      return
+    try:
+      for i in result:
+        if not isinstance(i, scrapy.Request):
+          page['items'] += 1
+        yield i
+    except BaseException:
+      self.pages.pop(response, None)
+      raise
+    page['is_consumed'] = True
+    self._scraped(response)
+
+  async def process_spider_output_async(self, response, result, spider):
+    page = self._start_page(response, spider)
+    try:
+      async for i in result:
+        if (page is not None) and not isinstance(i, scrapy.Request):
+          page['items'] += 1
+        yield i
+    except BaseException:
+      self.pages.pop(response, None)
+      raise
+    if page is not None:
+      page['is_consumed'] = True
+      self._scraped(response)
+
+  def item_scraped(self, item, response, spider):
+    page = self.pages.get(response)
+    if page is not None:
+      page['processed'] += 1
+      self._scraped(response)
+
+  def item_failed(self, item, response, spider, **kwargs):
+    # The page's items are incomplete, so its fingerprint is not stored
+    self.pages.pop(response, None)
+
+  def _scraped(self, response):
+    page = self.pages[response]
+    if page['is_consumed'] and page['processed'] >= page['items']:
+      del self.pages[response]
+      if self.signals is not None:
+        self.signals.send_catch_log(signal=page_scraped, url=response.url, fingerprint=response.meta[FINGERPRINT_META_KEY])
 
   def spider_opened(self, spider):
     self.create_all(BaseModel)
     Crawl.insert(self.sessionmaker, spider)
+    if self.fingerprint_patterns is not None:
+      self.load_fingerprints()
+    if self.flush_interval > 0:
+      self.buffer = UpsertBuffer(self.sessionmaker, flush_size=None, flush_interval=None, logger=spider.logger)
+      self.flush_loop = task.LoopingCall(self.flush, spider)
+      self.flush_loop.start(self.flush_interval, now=False)
+
+  def spider_idle(self, spider):
+    self.flush(spider)
+
+  def spider_closed(self, spider):
+    if self.flush_loop is not None and self.flush_loop.running:
+      self.flush_loop.stop()
+    self.flush(spider)
+    if self.writer_pool is not None:
+      return self.writer_pool.close()
+
+
+class FinalizedMatchMiddleware(DatabaseMixin):
+  """
+  Drop requests to the /match-detail/ pages of matches that are already finalized in the database.
+
+  A match is finalized if it has a result, a known surface, and a closing line (or odds
+  series) issued more than settle_age before the spider was opened. The match numbers of all finalized
+  matches are loaded once when the spider is opened, such that no SQL is run per request.
+  """
+
+  ENDPOINT = '/match-detail/'
+
+  def __init__(self, engine=None, settle_age=datetime.timedelta(days=2), stats=None):
+    super().__init__(engine=engine)
+    self.settle_age = settle_age
+    self.stats = stats
+    self.finalized = set()
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    if not crawler.settings.getbool('SEEDER_SKIP_FINALIZED_MATCHES'):
+      raise NotConfigured
+    middleware = cls(
+      settle_age=datetime.timedelta(days=crawler.settings.getfloat('SEEDER_MATCH_SETTLE_DAYS', 2)),
+      stats=crawler.stats,
+    )
+    crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+    return middleware
+
+  def load_finalized(self):
+    cutoff = datetime.datetime.utcnow() - self.settle_age
+    has_closing_line = exists().where(and_(
+      MatchOdds.match_id == Match.match_id,
+      MatchOdds.is_closing.is_(True),
+      MatchOdds.issued_at < cutoff,
+    ))
+    has_closing_series = exists().where(and_(
+      MatchOddsSeries.match_id == Match.match_id,
+      MatchOddsSeries.closing_at < cutoff,
+    ))
+    stmt = select(Match.match_number).where(
+      Match.is_win_p1.is_not(None),
+      Match.match_surface.is_not(None),
+      Match.match_surface != MatchSurface.unknown,
+      or_(has_closing_line, has_closing_series),
+    )
+    with self.sessionmaker() as session:
+      return set(session.execute(stmt).scalars().all())
+
+  def spider_opened(self, spider):
+    self.create_all(BaseModel)
+    self.finalized = self.load_finalized()
+    spider.logger.info(f"Loaded {len(self.finalized)} finalized matches whose {self.ENDPOINT} pages will be skipped.")
+
+  def is_finalized(self, request):
+    url = urlparse(request.url)
+    if url.path != self.ENDPOINT:
+      return False
+    match_number = coerce_int(parse_qs(url.query).get('id', [''])[-1])
+    return match_number in self.finalized
+
+  def _is_skipped(self, r, spider):
+    if isinstance(r, scrapy.Request) and self.is_finalized(r):
+      spider.logger.debug(f"Skipping request for finalized match: {r.url}")
+      if self.stats is not None:
+        self.stats.inc_value('seeder/finalized_matches/skipped', spider=spider)
+      return True
+    return False
+
+  def process_spider_output(self, response, result, spider):
+    for r in result:
+      if not self._is_skipped(r, spider):
+        yield r
+
+  async def process_spider_output_async(self, response, result, spider):
+    async for r in result:
+      if not self._is_skipped(r, spider):
+        yield r
+
+
+class FrontierMiddleware(object):
+  """
+  Signal that the request of a response is processed once the output of its callback has been
+  consumed, such that the FrontierScheduler marks requests claimed from the frontier done
+  only after the requests & items they yielded were passed on.
+
+  Responses whose callback raised are processed too, since retrying them would not help.
+  This middleware should be the spider middleware closest to the engine (lowest order).
+  """
+
+  def __init__(self, crawler):
+    self.crawler = crawler
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    # (issubclass would match any scheduler, since BaseScheduler's metaclass checks its interface)
+    if FrontierScheduler not in load_object(crawler.settings['SCHEDULER']).__mro__:
+      raise NotConfigured
+    return cls(crawler)
+
+  def _processed(self, response, spider):
+    self.crawler.signals.send_catch_log(signal=request_processed, response=response, spider=spider)
+
+  def process_spider_output(self, response, result, spider):
+    for i in result:
+      yield i
+    self._processed(response, spider)
+
+  async def process_spider_output_async(self, response, result, spider):
+    async for i in result:
+      yield i
+    self._processed(response, spider)
+
+  def process_spider_exception(self, response, exception, spider):
+    self._processed(response, spider)
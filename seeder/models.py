@@ -4,15 +4,17 @@ import re
 import logging
 import uuid
 
+from collections.abc import Mapping
 from urllib.parse import urlparse
 
-from sqlalchemy import ForeignKey, Column
-from sqlalchemy import Integer, String, Boolean, DateTime, Float, Enum
+from sqlalchemy import ForeignKey, Column, select
+from sqlalchemy import Integer, String, Boolean, DateTime, Float, Enum, LargeBinary
 from sqlalchemy_utils import UUIDType
 
 from sqlalchemy.orm import declarative_base, relationship
 
 from seeder.db import upsert_dict
+from seeder.util.series import pack_floats, pack_timestamps, unpack_floats, unpack_timestamps
 
 logger = logging.getLogger(__name__)
 
@@ -39,13 +41,20 @@ class Base(object):
   def surrogate_key(cls, *args, **kwargs):
     raise NotImplementedError
  
+  @classmethod
+  def make_payload(cls, **kwargs):
+    """
+    Return the column values of a record built from an item payload, including its surrogate keys.
+    """
+    return dict(**kwargs)
+
   @classmethod
   def make(cls, **kwargs):
-    return cls(**kwargs)
+    return cls(**cls.make_payload(**kwargs))
 
   @classmethod
-  def make_dependencies(cls, *args, **kwargs):
-    return []
+  def make_dependencies(cls, **kwargs):
+    return [model(**row) for (model, row) in cls.make_dependency_rows(**kwargs)]
   
   @classmethod
   def make_with_dependencies(cls, **kwargs):
@@ -53,6 +62,25 @@ class Base(object):
     deps = cls.make_dependencies(**kwargs)
     return deps + [record]
 
+  # The make_*row* builders mirror the make* builders above, but return plain column
+  # dicts (without None values, as in to_partial_dict) for Core statements rather than
+  # ORM instances, avoiding the cost of instrumented attributes on the write path.
+
+  @classmethod
+  def make_row(cls, **kwargs):
+    return {k: v for (k, v) in cls.make_payload(**kwargs).items() if v is not None}
+
+  @classmethod
+  def make_dependency_rows(cls, **kwargs):
+    """
+    Return the (model, row) pairs of the skeleton records this record depends on.
+    """
+    return []
+
+  @classmethod
+  def make_rows_with_dependencies(cls, **kwargs):
+    return cls.make_dependency_rows(**kwargs) + [(cls, cls.make_row(**kwargs))]
+
   def to_partial_dict(self):
     return {k: v for (k, v) in self.to_dict().items() if v is not None}
 
@@ -101,6 +129,7 @@ class CrawledUrl(BaseModel):
   is_crawled = Column(Boolean, default=False, nullable=False)
   last_crawled_at = Column(DateTime, nullable=True)
   last_crawl_id = Column(UUIDType(binary=True), ForeignKey("crawls.crawl_id"), nullable=True)
+  body_fingerprint = Column(String(40), nullable=True)
 
   last_crawl = relationship("Crawl", foreign_keys=[last_crawl_id])
 
@@ -109,27 +138,76 @@ class CrawledUrl(BaseModel):
     return uuid.uuid5(cls.UUID_NAMESPACE, url)
 
   @classmethod
-  def insert(cls, session, url):
+  def insert_payload(cls, url):
     parsed = urlparse(url)
-    return upsert_dict(session, cls, {
+    return {
       'url_id': cls.surrogate_key(url),
       'url': url,
       'netloc': parsed.netloc or None,
       'path': parsed.path or None,
       'params': parsed.params or None,
-    })
+    }
 
   @classmethod
-  def update(cls, session, spider, url):
-    return upsert_dict(session, cls, {
+  def update_payload(cls, spider, url, body_fingerprint=None):
+    payload = {
       'url_id': cls.surrogate_key(url),
       'url': url,
       'is_crawled': True,
       'last_crawled_at': datetime.datetime.utcnow(),
       'last_crawl_id': spider.crawl_id,
-    })
+    }
+    if body_fingerprint is not None:
+      payload['body_fingerprint'] = body_fingerprint
+    return payload
+
+  @classmethod
+  def insert(cls, session, url):
+    return upsert_dict(session, cls, cls.insert_payload(url))
+
+  @classmethod
+  def update(cls, session, spider, url):
+    return upsert_dict(session, cls, cls.update_payload(spider, url))
  
 
+class FrontierStatus(enum.Enum):
+  pending = 0
+  leased = 1
+  done = 2
+
+
+class FrontierRequest(BaseModel):
+  """
+  A request of a shared crawl frontier (see seeder.frontier), keyed by its queue and request
+  fingerprint, with its serialized request in payload.
+
+  Pending requests are claimed by a worker (lease_owner, e.g. a crawl_id) with a lease that
+  the worker renews until the request is done; requests whose lease expired (e.g. of a
+  killed worker) may be claimed again, up to the frontier's maximum number of attempts.
+  """
+  __tablename__ = "frontier"
+
+  queue = Column(String(64), primary_key=True)
+  fingerprint = Column(String(40), primary_key=True)
+  url = Column(String, nullable=False)
+  endpoint = Column(String)
+  priority = Column(Integer, nullable=False, default=0)
+  payload = Column(LargeBinary, nullable=False)
+  status = Column(Enum(FrontierStatus), nullable=False, default=FrontierStatus.pending, index=True)
+  attempts = Column(Integer, nullable=False, default=0)
+  lease_owner = Column(UUIDType(binary=True), nullable=True, index=True)
+  lease_id = Column(UUIDType(binary=True), nullable=True, index=True)
+  lease_expires_at = Column(DateTime, nullable=True)
+
+  @classmethod
+  def make_payload(cls, **kwargs):
+    payload = dict(**kwargs)
+    payload['endpoint'] = urlparse(kwargs['url']).path or None
+    payload.setdefault('status', FrontierStatus.pending)
+    payload.setdefault('attempts', 0)
+    return payload
+
+
 class MatchSurface(enum.Enum):
   unknown = 0
   hard = 1
@@ -199,27 +277,27 @@ class Player(BaseModel):
     return uuid.uuid5(cls.UUID_NAMESPACE, path)
 
   @classmethod
-  def make(cls, **kwargs):
+  def make_payload(cls, **kwargs):
     payload = dict(**kwargs)
     slug = kwargs['slug']
     player_type = kwargs.get('player_type', PlayerType.from_url(slug))
     payload['player_id'] = cls.surrogate_key(slug)
-    payload['player_type'] = kwargs.get('player_type', PlayerType.from_url(slug))
+    payload['player_type'] = player_type
     if player_type == PlayerType.double:
       slugs = cls.parse_slugs(slug)
       payload['p1'] = cls.surrogate_key(kwargs.get('p1', slugs[0]))
       payload['p2'] = cls.surrogate_key(kwargs.get('p2', slugs[1]))
-    return cls(**payload)
+    return payload
 
   @classmethod
-  def make_dependencies(cls, **kwargs):
+  def make_dependency_rows(cls, **kwargs):
     slug = kwargs['slug']
     player_type = kwargs.get('player_type', PlayerType.from_url(slug))
     if player_type == PlayerType.double:
       slugs = cls.parse_slugs(slug)
       return [
-        cls.make(slug=slugs[0]),
-        cls.make(slug=slugs[1]),
+        (cls, cls.make_row(slug=slugs[0])),
+        (cls, cls.make_row(slug=slugs[1])),
       ]
     return []
   
@@ -269,20 +347,20 @@ class Match(BaseModel):
     return uuid.uuid5(cls.UUID_NAMESPACE, str(match_number))
 
   @classmethod
-  def make(cls, **kwargs):
+  def make_payload(cls, **kwargs):
     payload = dict(**kwargs)
     payload['match_id'] = cls.surrogate_key(kwargs['match_number'])
     payload['p1'] = Player.surrogate_key(kwargs.get('p1'))
     payload['p2'] = Player.surrogate_key(kwargs.get('p2'))
-    return cls(**payload)
+    return payload
 
   @classmethod
-  def make_dependencies(cls, **kwargs):
+  def make_dependency_rows(cls, **kwargs):
     deps = []
     for player in ['p1', 'p2']:
       slug = kwargs.get(player)
       if slug:
-        deps += Player.make_with_dependencies(slug=slug)
+        deps += Player.make_rows_with_dependencies(slug=slug)
     return deps
 
 
@@ -309,7 +387,7 @@ class MatchOdds(BaseModel):
     return uuid.uuid5(cls.UUID_NAMESPACE, name)
 
   @classmethod
-  def make(cls, **kwargs):
+  def make_payload(cls, **kwargs):
     payload = dict(**kwargs)
     payload['match_odds_id'] = cls.surrogate_key(
       kwargs['match_number'],
@@ -317,10 +395,114 @@ class MatchOdds(BaseModel):
       kwargs['issued_at'],
     )
     payload['match_id'] = Match.surrogate_key(kwargs['match_number'])
-    return cls(**payload)
+    return payload
 
   @classmethod
-  def make_dependencies(cls, **kwargs):
+  def make_dependency_rows(cls, **kwargs):
+    return [
+      (Match, Match.make_row(match_number=kwargs['match_number']))
+    ]
+
+
+class MatchOddsSeries(BaseModel):
+  """
+  A compact alternative to MatchOdds that stores the series of odds issued by a bookmaker
+  for a match in a single row, with packed little-endian arrays (see seeder.util.series)
+  of the ticks' issued_at timestamps (int64 microseconds since the epoch) and odds
+  (float64, with NaN for missing odds), ordered by issued_at.
+
+  The index, index_rev and is_closing values of each tick follow from its position in
+  the series, and only the first tick may be an opening line (if is_opening is set).
+  """
+  __tablename__ = "match_odds_series"
+
+  match_odds_series_id = Column(UUIDType(binary=True), primary_key=True)
+  match_id = Column(UUIDType(binary=True), ForeignKey("matches.match_id"))
+  match_number = Column(Integer, index=True)
+  issued_by = Column(String)
+  num_ticks = Column(Integer)
+  is_opening = Column(Boolean)
+  opening_at = Column(DateTime)
+  closing_at = Column(DateTime)
+  issued_at = Column(LargeBinary)
+  odds_p1 = Column(LargeBinary)
+  odds_p2 = Column(LargeBinary)
+
+  issued_for = relationship("Match", foreign_keys=[match_id])
+
+  @classmethod
+  def surrogate_key(cls, match_number, issued_by):
+    return uuid.uuid5(cls.UUID_NAMESPACE, f'{match_number}-{issued_by}')
+
+  @classmethod
+  def payload_from_ticks(cls, ticks):
+    """
+    Return the column values of the series of a bookmaker's odds ticks for a match,
+    where each tick is a MatchOdds payload.
+    """
+    ticks = sorted(ticks, key=lambda t: t['issued_at'])
+    return {
+      'match_number': ticks[0]['match_number'],
+      'issued_by': ticks[0]['issued_by'],
+      'num_ticks': len(ticks),
+      'is_opening': bool(ticks[0].get('is_opening')),
+      'opening_at': ticks[0]['issued_at'],
+      'closing_at': ticks[-1]['issued_at'],
+      'issued_at': pack_timestamps([t['issued_at'] for t in ticks]),
+      'odds_p1': pack_floats([t.get('odds_p1') for t in ticks]),
+      'odds_p2': pack_floats([t.get('odds_p2') for t in ticks]),
+    }
+
+  @classmethod
+  def make_payload(cls, **kwargs):
+    payload = dict(**kwargs)
+    payload['match_odds_series_id'] = cls.surrogate_key(kwargs['match_number'], kwargs['issued_by'])
+    payload['match_id'] = Match.surrogate_key(kwargs['match_number'])
+    return payload
+
+  @classmethod
+  def make_dependency_rows(cls, **kwargs):
+    return [
+      (Match, Match.make_row(match_number=kwargs['match_number']))
+    ]
+
+  @classmethod
+  def expand(cls, row):
+    """
+    Expand a series row (an instance, a Core row, or a mapping of its column values)
+    back to its ticks, as MatchOdds payloads.
+    """
+    get = row.__getitem__ if isinstance(row, Mapping) else lambda k: getattr(row, k)
+    issued_at = unpack_timestamps(get('issued_at'))
+    odds_p1 = unpack_floats(get('odds_p1'))
+    odds_p2 = unpack_floats(get('odds_p2'))
+    num_ticks = len(issued_at)
     return [
-      Match.make(match_number=kwargs['match_number'])
+      {
+        'match_number': get('match_number'),
+        'issued_by': get('issued_by'),
+        'issued_at': issued_at[k],
+        'index': k + 1,
+        'index_rev': num_ticks - k,
+        'is_opening': (k == 0) and bool(get('is_opening')),
+        'is_closing': (k == num_ticks - 1),
+        'odds_p1': odds_p1[k],
+        'odds_p2': odds_p2[k],
+      }
+      for k in range(num_ticks)
     ]
+
+  def to_ticks(self):
+    return type(self).expand(self)
+
+  @classmethod
+  def read_ticks(cls, sessionmaker, match_numbers=None):
+    """
+    Read the expanded ticks of the stored series, optionally of the given match numbers only.
+    """
+    stmt = select(cls.__table__)
+    if match_numbers is not None:
+      stmt = stmt.where(cls.match_number.in_(list(match_numbers)))
+    with sessionmaker() as session:
+      rows = session.execute(stmt).mappings().all()
+    return [tick for row in rows for tick in cls.expand(row)]
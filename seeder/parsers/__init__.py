@@ -1,10 +1,83 @@
+from bs4 import BeautifulSoup
+
+# The version of the items parsed from pages, which salts the pages' body fingerprints (see
+# the UrlCacheMiddleware). Bump it whenever a change to the parsers or the models changes
+# the items of a page, such that pages are re-ingested even though their html is unchanged.
+PARSERS_VERSION = 1
+
+
+class ParsedDocument(object):
+  """
+  The parsed document of a response, shared by all the parser methods handling it such
+  that its body is decoded and each of its trees is built at most once.
+
+  The BeautifulSoup and lxml trees are built lazily on first use, and the results of
+  xpath queries on the response's (scrapy) selector are memoized per query.
+  """
+
+  def __init__(self, response):
+    self.response = response
+    self._soup = None
+    self._xpaths = {}
+
+  @property
+  def soup(self):
+    if self._soup is None:
+      self._soup = BeautifulSoup(self.response.body, 'html.parser')
+    return self._soup
+
+  @property
+  def tree(self):
+    """
+    The lxml tree of the response, as built (once) by its scrapy selector.
+    """
+    return self.response.selector.root
+
+  def xpath(self, query):
+    result = self._xpaths.get(query)
+    if result is None:
+      result = self._xpaths[query] = self.response.selector.xpath(query)
+    return result
+
+
 class Parser(object):
 
   def __init__(self, *args, **kwargs):
     pass
 
-  def parse_items(self, response):
+  def parse_items(self, response, document=None):
     return []
 
-  def parse_links(self, response):
+  def parse_links(self, response, document=None):
     return []
+
+
+def lxml_has_class(el, classes):
+  """
+  Return whether an element matches any of classes, as BeautifulSoup's class_ filter does:
+  either its whole class attribute or any one of its classes must be in classes.
+  """
+  value = el.get('class')
+  if value is None:
+    return False
+  return (value in classes) or any(c in classes for c in value.split())
+
+
+def lxml_next_element(el):
+  """
+  Return the node after the start of an element in document order, as BeautifulSoup's
+  next_element does: the element's leading text if it has any, else its first child,
+  else the next node in document order.
+  """
+  if el.text:
+    return el.text
+  node = el[0] if len(el) else None
+  while node is None and el is not None:
+    if el.tail:
+      return el.tail
+    node = el.getnext()
+    el = el.getparent()
+  if node is not None and not isinstance(node.tag, str):
+    # Comments & processing instructions are strings in BeautifulSoup
+    return node.text
+  return node
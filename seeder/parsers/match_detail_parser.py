@@ -1,3 +1,4 @@
+import heapq
 import logging
 import re
 
@@ -5,17 +6,24 @@ import datetime
 
 from urllib.parse import urlparse, parse_qs
 
-from bs4 import BeautifulSoup
 import scrapy
+from lxml import etree
 
-from seeder.models import MatchSurface
-from seeder.items import MatchOddsItem, MatchItem
-from seeder.parsers import Parser
+from seeder.models import MatchOddsSeries, MatchSurface
+from seeder.items import MatchOddsItem, MatchOddsSeriesItem, MatchItem
+from seeder.parsers import ParsedDocument, Parser, lxml_next_element
 from seeder.util.numeric import coerce_float, coerce_int, coerce_timedelta
 
 logger = logging.getLogger(__name__)
 
 
+def _class_test(name):
+  """
+  Return an xpath predicate matching elements with the class name, as BeautifulSoup's class_ filter does.
+  """
+  return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
 class MatchDetailParser(Parser):
   """
   Parse a MatchOddsItem instance for each odds change record in the moneyline 
@@ -31,29 +39,64 @@ class MatchDetailParser(Parser):
       make any guarantees of the accuracy. The timestamps appear to be on the partner site
       oddsportal.com.
 
+  The odds are stored according to odds_storage, as either:
+    - 'ticks': a MatchOddsItem for each odds change record;
+    - 'series': a MatchOddsSeriesItem for each bookmaker's series of odds change records;
+    - 'both': both of the above.
+
+  The odds table is parsed with either engine:
+    - 'bs4': from the document's BeautifulSoup tree (html.parser).
+    - 'lxml': with compiled xpaths from the lxml tree of the response's selector, which
+      is faster and produces the same items.
+
   TODOs:
     - Refactor the parsers methods, especially the convoluted full outer join of dictionaries
     - Add parsers (& models) for bets other than moneyline
   """
 
-  def __init__(self, logger=logger, **kwargs):
+  ODDS_STORAGES = ('ticks', 'series', 'both')
+  ENGINES = ('bs4', 'lxml')
+
+  # The compiled xpaths of the 'lxml' engine, which mirror the BeautifulSoup finds
+  ODDS_TABLE_XPATH = etree.XPath("(//*[@id='oddsMenu-1-data'])[1]")
+  ODDS_ROWS_XPATH = etree.XPath(f"descendant::tr[{_class_test('one')} or {_class_test('two')}]")
+  BOOKMAKER_XPATH = etree.XPath(f"(descendant::td)[1]/descendant::span[{_class_test('t')}][1]")
+  ODDS_DIVS_XPATH = etree.XPath(f"descendant::div[{_class_test('odds-in')}]")
+  ODDS_CHANGES_XPATH = etree.XPath(f"descendant::div[{_class_test('odds-change-div')}][1]")
+  ODDS_CHANGE_ROWS_XPATH = etree.XPath("descendant::tr")
+  CELLS_XPATH = etree.XPath("descendant::td")
+  TEXT_XPATH = etree.XPath("string()")
+
+  def __init__(self, logger=logger, odds_storage='ticks', engine='lxml', **kwargs):
+    if odds_storage not in self.ODDS_STORAGES:
+      raise ValueError(f"Unknown odds_storage '{odds_storage}'; expected one of {self.ODDS_STORAGES}")
+    if engine not in self.ENGINES:
+      raise ValueError(f"Unknown engine '{engine}'; expected one of {self.ENGINES}")
     self.logger = logger
+    self.odds_storage = odds_storage
+    self.engine = engine
+
+  # The header box with the match date, time, tournament, round & surface
+  HEADER_XPATH = '//*[@id="center"]/div[1]'
 
-  def parse_links(self, response):
+  def parse_links(self, response, document=None):
     return []
 
-  def parse_items(self, response):
+  def parse_items(self, response, document=None):
     """
     Parse a match results table into an iterable of items.
     """
-    odds_items = self._parse_moneyline_odds_items(response, global_context={})
-    match_items = self._parse_match_items(response, global_context={})
+    document = document or ParsedDocument(response)
+    odds_items = self._parse_moneyline_odds_items(response, global_context={}, document=document)
+    match_items = self._parse_match_items(response, global_context={}, document=document)
     return odds_items + match_items
 
-  def _parse_match_timestamp(self, response):
+  def _parse_match_timestamp(self, response, document=None):
+    document = document or ParsedDocument(response)
     try:
-      match_date_text = response.selector.xpath('//*[@id="center"]/div[1]/span/text()').get()
-      match_time_text = response.selector.xpath('//*[@id="center"]/div[1]/text()[1]').get()
+      header = document.xpath(self.HEADER_XPATH)
+      match_date_text = header.xpath('./span/text()').get()
+      match_time_text = header.xpath('./text()[1]').get()
       if not match_date_text:
         raise ValueError(f"Could not retrieve a match date from {response.url}")
       if not match_time_text:
@@ -80,7 +123,7 @@ class MatchDetailParser(Parser):
       return None
 
 
-  def _parse_match_round(self, response):
+  def _parse_match_round(self, response, document=None):
     """
     Parse the round text describing when the match occurred in the tournament order
     from the html of a /match-detail/ page. The html fragment we are parsing looks like:
@@ -88,9 +131,9 @@ class MatchDetailParser(Parser):
       <span class="upper">19.06.2022</span>, 14:25, <a href="...">Tournament</a>, Round, Surface
     </div>
     """
+    document = document or ParsedDocument(response)
     try:
-
-      text = response.selector.xpath('//*[@id="center"]/div[1]/text()').getall()[-1]
+      text = document.xpath(self.HEADER_XPATH).xpath('./text()').getall()[-1]
       if not text:
         raise ValueError(f"Could not retrieve match metadata text from {response.url}")
       tokens = text.split(',')
@@ -101,7 +144,7 @@ class MatchDetailParser(Parser):
       self.logger.error(e)
       return None
 
-  def _parse_match_surface(self, response):
+  def _parse_match_surface(self, response, document=None):
     """
     Parse the surface (grass/clay/etc) from the html of a /match-detail/ page. 
     The html fragment we are parsing looks like: 
@@ -109,8 +152,9 @@ class MatchDetailParser(Parser):
       <span class="upper">19.06.2022</span>, 14:25, <a href="...">Tournament</a>, Round, Surface
     </div>
     """
+    document = document or ParsedDocument(response)
     try:
-      text = response.selector.xpath('//*[@id="center"]/div[1]/text()').getall()[-1]
+      text = document.xpath(self.HEADER_XPATH).xpath('./text()').getall()[-1]
       if not text:
         raise ValueError(f"Could not retrieve match metadata text from {response.url}")
       tokens = text.strip().split(',')
@@ -121,7 +165,7 @@ class MatchDetailParser(Parser):
       self.logger.error(e)
       return MatchSurface.unknown
 
-  def _parse_moneyline_odds_items(self, response, global_context={}):
+  def _parse_moneyline_odds_items(self, response, global_context={}, document=None):
     """
     Extract a transaction fact table of match odds issued by each available
     bookmaker for the moneyline wager.
@@ -131,32 +175,42 @@ class MatchDetailParser(Parser):
     resolution of 1 minute for each change they've detected. We extract each
     change for each bookmaker as a distinct fact record.
     """
-    match_at = self._parse_match_timestamp(response)
+    document = document or ParsedDocument(response)
+    match_at = self._parse_match_timestamp(response, document=document)
     match_number = coerce_int(parse_qs(urlparse(response.url).query)['id'][0])
     if not match_at:
       return []
-    soup = BeautifulSoup(response.body, "html.parser")
-    root_tab = soup.find(id="oddsMenu-1-data")
-    if not root_tab:
-      self.logger.error(f"Could not retrieve the data table from '{response.url}'")
-      return []
-
     context = {
       'match_at': match_at,
       'match_number': match_number,
     }
     items = []
+    if self.engine == 'lxml':
+      root_tab = self.ODDS_TABLE_XPATH(document.tree)
+      if not root_tab:
+        self.logger.error(f"Could not retrieve the data table from '{response.url}'")
+        return []
+      for row in self.ODDS_ROWS_XPATH(root_tab[0]):
+        items += self._parse_match_odds_records_lxml(row, context=context)
+      return items
+
+    root_tab = document.soup.find(id="oddsMenu-1-data")
+    if not root_tab:
+      self.logger.error(f"Could not retrieve the data table from '{response.url}'")
+      return []
+
     for row in root_tab.find_all("tr", class_=["one", "two"]):
       _it = self._parse_match_odds_records(row, context=context)
       items += _it
     return items
   
-  def _parse_match_items(self, response, global_context=None):
+  def _parse_match_items(self, response, global_context=None, document=None):
     # Add the parial match item to upsert (to get the surface & round) 
+    document = document or ParsedDocument(response)
     return [MatchItem(
       match_number=coerce_int(parse_qs(urlparse(response.url).query)['id'][0]),
-      match_surface=self._parse_match_surface(response),
-      match_round=self._parse_match_round(response),
+      match_surface=self._parse_match_surface(response, document=document),
+      match_round=self._parse_match_round(response, document=document),
     )]
 
   def _parse_match_odds_records(self, soup, context):
@@ -172,49 +226,14 @@ class MatchDetailParser(Parser):
     odds_divs = soup.find_all("div", class_="odds-in")
     if len(odds_divs) != 2:
       self.logger.error(
-        f"Expected 2 odds change div columns for {bookmaker} but found {len(odds_change_divs)}"
+        f"Expected 2 odds change div columns for {bookmaker} but found {len(odds_divs)}"
       )
-      return None
-
-    def _merge_odds_series(odds):
-      issue_timestamps = set([o['issued_at'] for o in odds[0]] + [o['issued_at'] for o in odds[1]])
-      sorted_odds = [
-        sorted(odds[0], key=lambda r: r['issued_at']),
-        sorted(odds[1], key=lambda r: r['issued_at']),
-      ]
-      last_vals = [None, None]
-      k_last = [0, 0]
-      records = []
-      num_timestamps = len(issue_timestamps)
-      for idx, ts in enumerate(sorted(issue_timestamps), start=1):
-        # Increment the time index for each player. Since the odds for each side of the line
-        # maybe updated at different timestamps, this is a convoluted way of performing a
-        # full outer join & a forward fill on the series.
-        for p in range(len(sorted_odds)):
-          if sorted_odds[p][k_last[p]].get('issued_at') == ts:
-            last_vals[p] = sorted_odds[p][k_last[p]].get('odds') 
-            k_last[p] = min(k_last[p] + 1, len(sorted_odds[p]) - 1)
-
-        record = {
-          'match_number': context['match_number'],
-          'issued_by': bookmaker,
-          'issued_at': ts,
-          'index': idx,
-          'index_rev': num_timestamps - (idx - 1),
-          'is_opening': (idx == 1) and (ts < context['match_at']), # opening must be issued strictkly before match time 
-          'is_closing': (idx == num_timestamps),
-          'odds_p1': last_vals[0],
-          'odds_p2': last_vals[1],
-        }
-        records.append(record)
-
-      return records
+      return []
 
     odds = [
       [],
       [],
     ]
-    timestamps = []
     for p, div in enumerate(odds_divs):
       # Try to find an odds-change-div, which contains the table of
       # odds changes issued by the bookmaker if multiple were issued.
@@ -228,7 +247,7 @@ class MatchDetailParser(Parser):
             continue
 
           odds[p].append({
-            'issued_at': datetime.datetime.strptime(f"{year}.{fields[0].text}", "%Y.%d.%m. %H:%M"),
+            'issued_at': _parse_issued_at(year, fields[0].text),
             'odds': coerce_float(fields[1].text),
           })
       else:
@@ -237,6 +256,119 @@ class MatchDetailParser(Parser):
           'issued_at': context.get('match_at'),
           'odds': coerce_float(div.text),
         })
-   
-    result = _merge_odds_series(odds)
-    return [MatchOddsItem(**r) for r in result]
+
+    return self._make_odds_items(_merge_odds_series(odds, bookmaker, context))
+
+  def _parse_match_odds_records_lxml(self, row, context):
+    """
+    Extract each issued odds for a match from a single row of the lxml tree (the 'lxml'
+    engine), reproducing the results of _parse_match_odds_records.
+    """
+    assert 'match_at' in context
+    year = context['match_at'].year
+    bookmaker = lxml_next_element(self.BOOKMAKER_XPATH(row)[0])
+    odds_divs = self.ODDS_DIVS_XPATH(row)
+    if len(odds_divs) != 2:
+      self.logger.error(
+        f"Expected 2 odds change div columns for {bookmaker} but found {len(odds_divs)}"
+      )
+      return []
+
+    odds = [
+      [],
+      [],
+    ]
+    for p, div in enumerate(odds_divs):
+      odds_changes = self.ODDS_CHANGES_XPATH(div)
+      if odds_changes:
+        for r in self.ODDS_CHANGE_ROWS_XPATH(odds_changes[0]):
+          fields = self.CELLS_XPATH(r)
+          if len(fields) != 3:
+            self.logger.debug(f"Skipping row {r} with only {len(fields)} fields; expected 3.")
+            continue
+
+          odds[p].append({
+            'issued_at': _parse_issued_at(year, self.TEXT_XPATH(fields[0])),
+            'odds': coerce_float(self.TEXT_XPATH(fields[1])),
+          })
+      else:
+        odds[p].append({
+          'issued_at': context.get('match_at'),
+          'odds': coerce_float(self.TEXT_XPATH(div)),
+        })
+
+    return self._make_odds_items(_merge_odds_series(odds, bookmaker, context))
+
+  def _make_odds_items(self, records):
+    items = []
+    if self.odds_storage in ('ticks', 'both'):
+      items += [MatchOddsItem(**r) for r in records]
+    if self.odds_storage in ('series', 'both') and records:
+      items.append(MatchOddsSeriesItem(**MatchOddsSeries.payload_from_ticks(records)))
+    return items
+
+
+
+# The 'DD.MM. HH:MM' timestamps of the odds changes
+ISSUED_AT_PATTERN = re.compile(r'(\d\d)\.(\d\d)\. (\d\d):(\d\d)')
+
+
+def _parse_issued_at(year, text):
+  """
+  Parse the timestamp of an odds change (which has no year) in the given year.
+
+  Timestamps in the site's fixed 'DD.MM. HH:MM' format are parsed directly, which is
+  several times faster than strptime; any other text falls back to strptime.
+  """
+  m = ISSUED_AT_PATTERN.fullmatch(text)
+  if m is None:
+    return datetime.datetime.strptime(f"{year}.{text}", "%Y.%d.%m. %H:%M")
+  (day, month, hour, minute) = m.groups()
+  return datetime.datetime(year, int(month), int(day), int(hour), int(minute))
+
+
+def _merge_odds_series(odds, bookmaker, context):
+  """
+  Merge the series of odds issued for each side of the line into a record per distinct
+  issued_at timestamp, with each side's odds forward filled.
+
+  The site lists each side's odds changes newest first, so each series is sorted by its
+  issued_at (which costs only a linear pass over an already ordered list) before the
+  timestamps of both sides are merged in a single pass.
+  """
+  sorted_odds = [
+    sorted(odds[0], key=lambda r: r['issued_at']),
+    sorted(odds[1], key=lambda r: r['issued_at']),
+  ]
+  issue_timestamps = []
+  for ts in heapq.merge(*[[o['issued_at'] for o in side] for side in sorted_odds]):
+    if not issue_timestamps or issue_timestamps[-1] != ts:
+      issue_timestamps.append(ts)
+
+  last_vals = [None, None]
+  k_last = [0, 0]
+  records = []
+  num_timestamps = len(issue_timestamps)
+  for idx, ts in enumerate(issue_timestamps, start=1):
+    # Increment the time index for each player. Since the odds for each side of the line
+    # maybe updated at different timestamps, this is a convoluted way of performing a
+    # full outer join & a forward fill on the series.
+    for p in range(len(sorted_odds)):
+      if sorted_odds[p][k_last[p]].get('issued_at') == ts:
+        last_vals[p] = sorted_odds[p][k_last[p]].get('odds')
+        k_last[p] = min(k_last[p] + 1, len(sorted_odds[p]) - 1)
+
+    record = {
+      'match_number': context['match_number'],
+      'issued_by': bookmaker,
+      'issued_at': ts,
+      'index': idx,
+      'index_rev': num_timestamps - (idx - 1),
+      'is_opening': (idx == 1) and (ts < context['match_at']), # opening must be issued strictkly before match time
+      'is_closing': (idx == num_timestamps),
+      'odds_p1': last_vals[0],
+      'odds_p2': last_vals[1],
+    }
+    records.append(record)
+
+  return records
@@ -0,0 +1,133 @@
+"""
+Parse pages on a pool of worker processes rather than on the reactor thread, such that
+parsing scales with the number of cores while the reactor keeps downloading.
+"""
+import logging
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlparse
+
+import scrapy
+from twisted.internet import defer
+
+from seeder.parsers import ParsedDocument
+
+logger = logging.getLogger(__name__)
+
+# The parsers of the worker process, by endpoint, as built by _init_worker
+_parsers = None
+
+
+def _init_worker(parser_specs, log_queue=None, log_level=logging.WARNING):
+  global _parsers
+  # Spawned workers have no logging configured, so their records are sent to the parent
+  if log_queue is not None:
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(log_level)
+  _parsers = {
+    endpoint: parser_cls(logger=logger, **kwargs)
+    for (endpoint, (parser_cls, kwargs)) in parser_specs.items()
+  }
+
+
+def parse_page(url, body, encoding=None, parse_items=True):
+  """
+  Parse a page with the worker's parser for its endpoint, as TennisExplorerSpider.parse
+  would, and return its (items, links). The items are returned to the spider's process
+  pickled.
+  """
+  parser = _parsers[urlparse(url).path]
+  response = scrapy.http.HtmlResponse(url, body=body, encoding=encoding)
+  document = ParsedDocument(response)
+  items = list(parser.parse_items(response, document=document)) if parse_items else []
+  links = list(parser.parse_links(response, document=document))
+  return (items, links)
+
+
+class _ParentHandler(logging.Handler):
+  """
+  Handle the log records of the worker processes with the loggers of the same names in this
+  process, i.e. with the handlers (e.g. scrapy's) configured in this process.
+  """
+
+  def emit(self, record):
+    logger = logging.getLogger(record.name)
+    if logger.isEnabledFor(record.levelno):
+      logger.handle(record)
+
+
+def start_workers(parser_specs, num_processes):
+  """
+  Return a ProcessPoolExecutor of num_processes spawned workers that parse pages (see
+  parse_page) with the parsers of parser_specs, and a started QueueListener that logs the
+  workers' records in this process, which is to be stopped once the executor is shut down.
+  """
+  context = multiprocessing.get_context('spawn')
+  log_queue = context.Queue()
+  listener = QueueListener(log_queue, _ParentHandler())
+  listener.start()
+  # Records below the level of every handler of this process are not sent
+  root = logging.getLogger()
+  log_level = max(root.getEffectiveLevel(), min((h.level for h in root.handlers), default=logging.WARNING))
+  executor = ProcessPoolExecutor(
+    max_workers=num_processes,
+    mp_context=context,
+    initializer=_init_worker,
+    initargs=(parser_specs, log_queue, log_level),
+  )
+  return (executor, listener)
+
+
+class ParsePool(object):
+  """
+  Parse pages on a pool of num_processes worker processes.
+
+  Each worker builds its own parsers once, from parser_specs: a dict of each endpoint's
+  (parser class, kwargs), where the kwargs must be picklable. Each call to submit returns
+  a Deferred that fires with the page's (items, links) once it has been parsed. At most
+  max_pending pages are queued or being parsed at once; later submissions wait, such that
+  the responses (& their bodies) in flight are bounded. The workers' log records (e.g. of
+  their parsers' errors) are logged in this process.
+  """
+
+  def __init__(self, parser_specs, num_processes=1, max_pending=None):
+    self.parser_specs = parser_specs
+    self.num_processes = num_processes
+    self.semaphore = defer.DeferredSemaphore(max_pending or 2 * num_processes)
+    self.executor = None
+    self.log_listener = None
+
+  def start(self):
+    if self.executor is None:
+      # Workers are spawned rather than forked from the (threaded) reactor's process
+      (self.executor, self.log_listener) = start_workers(self.parser_specs, self.num_processes)
+
+  def _submit(self, *args, **kwargs):
+    from twisted.internet import reactor
+    d = defer.Deferred()
+
+    def _fire(future):
+      if future.cancelled():
+        d.cancel()
+      elif future.exception() is not None:
+        d.errback(future.exception())
+      else:
+        d.callback(future.result())
+
+    future = self.executor.submit(parse_page, *args, **kwargs)
+    future.add_done_callback(lambda f: reactor.callFromThread(_fire, f))
+    return d
+
+  def submit(self, url, body, encoding=None, parse_items=True):
+    self.start()
+    return self.semaphore.run(self._submit, url, body, encoding=encoding, parse_items=parse_items)
+
+  def close(self):
+    if self.executor is not None:
+      self.executor.shutdown(wait=False, cancel_futures=True)
+      self.executor = None
+      self.log_listener.stop()
+      self.log_listener = None
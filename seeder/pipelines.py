@@ -1,26 +1,344 @@
+import datetime
 import logging
-from seeder.db import DatabaseMixin, default_engine, upsert_record
-from seeder.models import BaseModel
+import time
+import uuid
+
+from scrapy.exceptions import DropItem, NotConfigured
+
+from seeder.db import (
+  BulkLoadSettings,
+  DatabaseMixin,
+  KeyCache,
+  UpsertBuffer,
+  analyze,
+  create_indexes,
+  drop_indexes,
+  get_writer_pool,
+  secondary_indexes,
+  upsert_row,
+)
+from seeder.extensions import rows_upserted
+from seeder.middlewares import page_scraped
+from seeder.models import BaseModel, CrawledUrl, Match, MatchOdds, MatchOddsSeries, Player
 
 logger = logging.getLogger(__name__)
 
 
+def drop_backfill_indexes(engine):
+  """
+  Drop the secondary indexes of the DatabasePipeline's BULK_MODELS for a backfill,
+  returning those that were dropped.
+  """
+  return drop_indexes(engine, secondary_indexes(DatabasePipeline.BULK_MODELS))
+
+
+def rebuild_backfill_indexes(engine):
+  """
+  Rebuild the secondary indexes dropped for a backfill, and analyze their tables.
+  """
+  create_indexes(engine, secondary_indexes(DatabasePipeline.BULK_MODELS))
+  analyze(engine, DatabasePipeline.BULK_MODELS)
+
+
 class DatabasePipeline(DatabaseMixin):
+  """
+  Upsert the rows created by each item's make_rows_with_dependencies to the database.
+
+  Rows are built as plain column dicts and written with Core statements (see upsert_row
+  and upsert_dicts), such that no ORM instances are created on the write path.
+
+  The pipeline has 2 write modes:
+    - 'record': each record is upserted in its own transaction as its item is processed.
+    - 'bulk': records are buffered per model in an UpsertBuffer and upserted with
+      multi-row INSERT ... ON CONFLICT statements when the buffer is flushed, which
+      happens on size or time and when the spider is closed.
+
+  If key_cache_size is positive, the primary keys of existing Player and Match rows
+  are tracked in a KeyCache (preloaded when the spider is opened) that is used to skip
+  upserting skeleton dependency records whose rows already exist, and to upsert
+  records without first retrieving their rows.
+
+  If writer_threads is positive, items are written on the engine's shared WriterPool of
+  that many threads (see get_writer_pool) and process_item returns a Deferred, such that
+  the reactor thread never blocks on SQL. Once the pool holds max_pending writes, the
+  Deferred of an item only fires after a slot was freed and its write has run, so scrapy's
+  item backpressure throttles the crawl to the write speed.
 
-  def __init__(self, engine=default_engine, **kwargs):
+  If the pipeline has a crawler's signals, the rows_upserted signal is sent with the number
+  of rows & seconds of each upsert (of a record, or of a model's buffered records).
+
+  An item any of whose rows fails to be upserted is dropped (see DropItem). The body
+  fingerprint of a page whose items were all processed (see the page_scraped signal of
+  the UrlCacheMiddleware) is stored once its items are written: at once in 'record' mode,
+  or after the buffered rows in 'bulk' mode (see UpsertBuffer.add_after).
+
+  The pipeline has 2 load modes:
+    - 'incremental': all indexes are maintained while writing.
+    - 'backfill': the secondary indexes of the BULK_MODELS' tables are dropped and bulk
+      load connection settings (see BulkLoadSettings) are used while the spider is open;
+      the indexes are rebuilt and the tables analyzed when the spider is closed. Any
+      indexes left dropped by an interrupted backfill are rebuilt when the pipeline is next
+      opened. The indexes of other tables (e.g. the frontier's) are left alone.
+
+  If manage_indexes is False, the pipeline neither drops, rebuilds nor creates the indexes
+  in either load mode, e.g. in the shards of the backfill command, which drops the indexes
+  once before and rebuilds them once after all of its shards (see drop_backfill_indexes).
+  """
+
+  WRITE_MODES = ('record', 'bulk')
+  LOAD_MODES = ('incremental', 'backfill')
+  CACHED_MODELS = (Player, Match)
+  # The models of the tables written in bulk, whose secondary indexes the backfill drops
+  BULK_MODELS = (Player, Match, MatchOdds, MatchOddsSeries)
+
+  def __init__(self, engine=None, write_mode='record', flush_size=1000, flush_interval=5.0, key_cache_size=KeyCache.DEFAULT_MAX_SIZE, writer_threads=0, writer_max_pending=100, load_mode='incremental', manage_indexes=True, **kwargs):
     super().__init__(engine=engine, **kwargs)
+    if write_mode not in self.WRITE_MODES:
+      raise ValueError(f"Unknown write_mode '{write_mode}'; expected one of {self.WRITE_MODES}")
+    if load_mode not in self.LOAD_MODES:
+      raise ValueError(f"Unknown load_mode '{load_mode}'; expected one of {self.LOAD_MODES}")
+    self.write_mode = write_mode
+    self.load_mode = load_mode
+    self.manage_indexes = manage_indexes
+    self.bulk_load_settings = None
+    self.flush_size = flush_size
+    self.flush_interval = flush_interval
+    self.key_cache_size = key_cache_size
+    self.key_cache = None
+    self.buffer = None
+    self.num_skipped = 0
+    self.signals = None
+
+    self.writer_pool = None
+    if writer_threads > 0:
+      self.writer_pool = get_writer_pool(self.engine, num_threads=writer_threads, max_pending=writer_max_pending)
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    settings = crawler.settings
+    pipeline = cls(
+      write_mode=settings.get('SEEDER_DB_WRITE_MODE', 'record'),
+      flush_size=settings.getint('SEEDER_BULK_FLUSH_SIZE', 1000),
+      flush_interval=settings.getfloat('SEEDER_BULK_FLUSH_INTERVAL', 5.0),
+      key_cache_size=settings.getint('SEEDER_KEY_CACHE_SIZE', KeyCache.DEFAULT_MAX_SIZE),
+      writer_threads=settings.getint('SEEDER_DB_WRITER_THREADS', 0),
+      writer_max_pending=settings.getint('SEEDER_DB_WRITER_MAX_PENDING', 100),
+      load_mode=settings.get('SEEDER_LOAD_MODE', 'incremental'),
+      manage_indexes=settings.getbool('SEEDER_LOAD_MANAGE_INDEXES', True),
+    )
+    pipeline.signals = crawler.signals
+    crawler.signals.connect(pipeline.page_scraped, signal=page_scraped)
+    return pipeline
+
+  def page_scraped(self, url, fingerprint):
+    row = {'url_id': CrawledUrl.surrogate_key(url), 'url': url, 'body_fingerprint': fingerprint}
+    if self.buffer is not None:
+      self.buffer.add_after(CrawledUrl, row)
+    elif self.writer_pool is not None:
+      d = self.writer_pool.submit(upsert_row, self.sessionmaker, CrawledUrl, row)
+      d.addErrback(lambda f: logger.error(f"Encountered exception '{f.value}' when storing the fingerprint of '{url}'"))
+    else:
+      upsert_row(self.sessionmaker, CrawledUrl, row)
+
+  def _rows_upserted(self, model, num_rows, seconds):
+    if self.signals is not None:
+      self.signals.send_catch_log(signal=rows_upserted, model=model, num_rows=num_rows, seconds=seconds)
 
   def open_spider(self, spider):
     self.create_all(BaseModel)
+    if self.load_mode == 'backfill':
+      if self.manage_indexes:
+        dropped = drop_backfill_indexes(self.engine)
+        spider.logger.info(f"Dropped {len(dropped)} secondary indexes for the backfill.")
+      self.bulk_load_settings = BulkLoadSettings(self.engine)
+      self.bulk_load_settings.apply()
+    elif self.manage_indexes:
+      create_indexes(self.engine, secondary_indexes(self.BULK_MODELS))
+    if self.key_cache_size > 0:
+      self.key_cache = KeyCache(self.CACHED_MODELS, max_size=self.key_cache_size)
+      self.key_cache.preload(self.sessionmaker)
+    if self.write_mode == 'bulk':
+      self.buffer = UpsertBuffer(
+        self.sessionmaker,
+        flush_size=self.flush_size,
+        flush_interval=self.flush_interval,
+        key_cache=self.key_cache,
+        logger=spider.logger,
+        on_upsert=self._rows_upserted,
+      )
+
+  def close_spider(self, spider):
+    if self.writer_pool is None:
+      return self._close(spider)
+    # Wait for the items in flight to be written before the final flush
+    d = self.writer_pool.join()
+    d.addCallback(lambda _: self.writer_pool.submit(self._close, spider))
+    d.addCallback(lambda _: self.writer_pool.close())
+    return d
+
+  def _close(self, spider):
+    if self.buffer is not None:
+      num_written = self.buffer.flush()
+      spider.logger.info(f"Flushed {num_written} buffered database records on close.")
+    if self.key_cache is not None:
+      spider.logger.info(f"Skipped {self.num_skipped} skeleton records whose rows already existed.")
+    if self.bulk_load_settings is not None:
+      self.bulk_load_settings.remove()
+      if self.manage_indexes:
+        start = time.monotonic()
+        rebuild_backfill_indexes(self.engine)
+        spider.logger.info(f"Rebuilt secondary indexes and analyzed tables in {time.monotonic() - start:.1f}s.")
 
   def process_item(self, item, spider):
-    records = item.make_with_dependencies()
-    spider.logger.debug(f"Processing {len(records)} database records created for {type(item)}'")
-    for r in records:
+    if self.writer_pool is not None:
+      return self.writer_pool.submit(self._process_item, item, spider)
+    return self._process_item(item, spider)
+
+  def _process_item(self, item, spider):
+    rows = item.make_rows_with_dependencies()
+    spider.logger.debug(f"Processing {len(rows)} database records created for {type(item)}'")
+    num_failed = 0
+    for (k, (model, row)) in enumerate(rows):
       try:
-        success = upsert_record(self.sessionmaker, r)
+        # Skeleton dependencies only need to exist, so those already known to exist are skipped
+        is_dependency = k < len(rows) - 1
+        if is_dependency and self.key_cache is not None and self.key_cache.contains(model, row):
+          self.num_skipped += 1
+          continue
+        if self.buffer is not None:
+          self.buffer.add(model, row)
+          continue
+        exists = self.key_cache.exists(model, row) if self.key_cache is not None else None
+        start = time.monotonic()
+        success = upsert_row(self.sessionmaker, model, row, exists=exists)
+        self._rows_upserted(model, int(bool(success)), time.monotonic() - start)
         if not success:
-          raise ValueError(f"Failed to upsert record '{r}' created by item: {item}")
+          raise ValueError(f"Failed to upsert {model.__name__} row '{row}' created by item: {item}")
+        if self.key_cache is not None:
+          self.key_cache.add(model, row)
       except Exception as e:
+        num_failed += 1
         spider.logger.error(f"Encountered exception '{e}' when upserting {item}")
+    if num_failed:
+      raise DropItem(f"Failed to upsert {num_failed} of the {len(rows)} database records created for {item}")
+    return item
+
+
+class ColumnarFilePipeline(object):
+  """
+  Append the rows created by each item's make_rows_with_dependencies to partitioned
+  columnar files (see seeder.util.columnar), as an alternative to the DatabasePipeline
+  for large backfills that don't need row-level upserts.
+
+  Rows are buffered in memory per model and written as a row group once row_group_size
+  rows are buffered, and when the spider is closed. Each model's files are written below
+  {directory}/{tablename}/, with the matches, match_odds and match_odds_series files
+  partitioned by the date of their match, i.e. the match_at of the match's row as last
+  written by the pipeline. The odds (and skeleton match) rows of a match whose dated row
+  the pipeline has not written fall back to the date of their own issued_at, closing_at
+  (or match_at) column. The rows have the same surrogate keys as the database rows, and
+  are loaded into the database in chunks with, e.g.:
+
+    for rows in columnar.iter_rows(directory, Match):
+      upsert_dicts(sessionmaker, Match, rows)
+
+  Skeleton dependency rows are only written the first time their keys are seen (as
+  tracked by a KeyCache of at most key_cache_size keys per model), though a row's key
+  may still appear several times, e.g. as a skeleton and later as a full row.
+
+  This pipeline requires the optional pyarrow dependency.
+  """
+
+  MODELS = (Player, Match, MatchOdds, MatchOddsSeries)
+  # The columns of the dates by which each model's rows are partitioned if their match's
+  # date is not known
+  PARTITION_COLUMNS = {
+    Match: 'match_at',
+    MatchOdds: 'issued_at',
+    MatchOddsSeries: 'closing_at',
+  }
+
+  def __init__(self, directory, file_format='parquet', row_group_size=100000, compression='zstd', max_open_files=64, key_cache_size=KeyCache.DEFAULT_MAX_SIZE):
+    try:
+      from seeder.util import columnar
+    except ImportError as e:
+      raise NotConfigured(f"ColumnarFilePipeline requires pyarrow: {e}")
+    if file_format not in columnar.FORMATS:
+      raise ValueError(f"Unknown file_format '{file_format}'; expected one of {tuple(columnar.FORMATS)}")
+    self.columnar = columnar
+    self.directory = directory
+    self.file_format = file_format
+    self.row_group_size = row_group_size
+    self.compression = compression
+    self.max_open_files = max_open_files
+    self.key_cache_size = key_cache_size
+    self.key_cache = None
+    self.writers = {}
+    self.buffers = {}
+    self.partition_values = {}
+    self.match_dates = {}
+
+  @classmethod
+  def from_crawler(cls, crawler):
+    settings = crawler.settings
+    return cls(
+      directory=settings.get('SEEDER_COLUMNAR_DIR', 'private/columnar'),
+      file_format=settings.get('SEEDER_COLUMNAR_FORMAT', 'parquet'),
+      row_group_size=settings.getint('SEEDER_COLUMNAR_ROW_GROUP_SIZE', 100000),
+      compression=settings.get('SEEDER_COLUMNAR_COMPRESSION', 'zstd'),
+      key_cache_size=settings.getint('SEEDER_KEY_CACHE_SIZE', KeyCache.DEFAULT_MAX_SIZE),
+    )
+
+  def open_spider(self, spider):
+    # Prefix the part files of each crawl with its id, such that crawls never overwrite each other's files
+    prefix = f"part-{getattr(spider, 'crawl_id', None) or uuid.uuid4()}"
+    self.key_cache = KeyCache(self.MODELS, max_size=self.key_cache_size)
+    for model in self.MODELS:
+      self.buffers[model] = []
+      self.partition_values[model] = []
+      self.writers[model] = self.columnar.PartitionedFileWriter(
+        self.directory,
+        model,
+        file_format=self.file_format,
+        partition_column=self.PARTITION_COLUMNS.get(model),
+        compression=self.compression,
+        prefix=prefix,
+        max_open_files=self.max_open_files,
+      )
+
+  def close_spider(self, spider):
+    for model in self.MODELS:
+      self.flush(model)
+      self.writers[model].close()
+      spider.logger.info(f"Wrote {self.writers[model].num_rows} {model.__name__} rows to {self.writers[model].directory}")
+
+  def flush(self, model):
+    rows, self.buffers[model] = self.buffers[model], []
+    values, self.partition_values[model] = self.partition_values[model], []
+    if rows:
+      self.writers[model].write(rows, partition_values=values if model in self.PARTITION_COLUMNS else None)
+
+  def partition_value(self, model, row):
+    """
+    Return the datetime by whose date a row is partitioned: the date of its match, if known.
+    """
+    if model not in self.PARTITION_COLUMNS:
+      return None
+    if model is Match and row.get('match_at') is not None:
+      self.match_dates[row['match_id']] = row['match_at']
+    return self.match_dates.get(row.get('match_id')) or row.get(self.PARTITION_COLUMNS[model])
+
+  def process_item(self, item, spider):
+    rows = item.make_rows_with_dependencies()
+    now = datetime.datetime.utcnow()
+    for (k, (model, row)) in enumerate(rows):
+      is_dependency = k < len(rows) - 1
+      if is_dependency and self.key_cache.contains(model, row):
+        continue
+      self.key_cache.add(model, row)
+      # Set the column defaults that the database would have set on insert
+      self.buffers[model].append(dict(row, created_at=now, updated_at=now))
+      self.partition_values[model].append(self.partition_value(model, row))
+      if len(self.buffers[model]) >= self.row_group_size:
+        self.flush(model)
     return item
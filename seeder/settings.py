@@ -6,7 +6,6 @@ For more information, see: https://docs.scrapy.org/en/latest/topics/settings.htm
 import os
 import datetime
 import logging
-import sqlalchemy
 
 # ========================================================
 # Scrapy configuration settings
@@ -18,10 +17,16 @@ BOT_NAME = 'seederbot'
 SPIDER_MODULES = ['seeder.spiders']
 NEWSPIDER_MODULE = 'seeder.spiders'
 
+# The module of the project's scrapy commands, e.g. `scrapy restate`
+COMMANDS_MODULE = 'seeder.commands'
+
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
-# Configure maximum concurrent requests performed by Scrapy (default: 16)
+# Configure maximum concurrent requests performed by Scrapy (default: 16). The concurrency
+# of each endpoint's requests is limited by its download slot in
+# TennisExplorerSpider.ENDPOINT_PARSERS, which may be overridden in DOWNLOAD_SLOTS, e.g.
+#   DOWNLOAD_SLOTS = {'tennisexplorer.com/match-detail/': {'concurrency': 16, 'delay': 0, 'max_delay': 5.0}}
 DOWNLOAD_DELAY = 0
 CONCURRENT_REQUESTS = 16
 CONCURRENT_REQUESTS_PER_DOMAIN = 8
@@ -34,7 +39,9 @@ AUTOTHROTTLE_TARGET_CONCURRENCY = 2.0
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
+  'seeder.middlewares.FrontierMiddleware': 50,
   'seeder.middlewares.UrlCacheMiddleware': 543,
+  'seeder.middlewares.FinalizedMatchMiddleware': 544,
 }
 
 # Enable or disable downloader middlewares
@@ -44,7 +51,12 @@ DOWNLOADER_MIDDLEWARES = {
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
+# The AutoThrottle is replaced by the EndpointThrottle, which adapts the delay of each
+# endpoint's download slot (see TennisExplorerSpider.ENDPOINT_PARSERS) to its own latency.
 EXTENSIONS = {
+  'scrapy.extensions.throttle.AutoThrottle': None,
+  'seeder.extensions.EndpointThrottle': 0,
+  'seeder.extensions.CrawlMetrics': 0,
 }
 
 # Configure item pipelines.
@@ -62,7 +74,7 @@ ITEM_PIPELINES = {
 
 HTTPCACHE_ENABLED = True
 HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.DbmCacheStorage'
-HTTPCACHE_POLICY = 'scrapy.extensions.httpcache.DummyPolicy'
+HTTPCACHE_POLICY = 'seeder.httpcache.SettledPolicy'
 HTTPCACHE_EXPIRATION_SECS = 0 # if zero, don't expire
 HTTPCACHE_DIR = 'httpcache'
 HTTPCACHE_IGNORE_HTTP_CODES = [404]
@@ -70,6 +82,26 @@ HTTPCACHE_IGNORE_MISSING = False
 HTTPCACHE_GZIP = True
 HTTPCACHE_ALWAYS_STORE = True
 
+# Set the freshness of the cached pages under the seeder.httpcache.SettledPolicy: pages are
+# settled SEEDER_HTTPCACHE_SETTLE_DAYS days after the end of their date (the date of a
+# /results/ page or of a /match-detail/ page's match), and pages cached after they settled
+# are served from the cache forever. Unsettled pages (incl. all /next/ pages) are served from
+# the cache for their endpoint's ttl in seconds in SEEDER_HTTPCACHE_TTLS (if 0, they are
+# always refetched).
+SEEDER_HTTPCACHE_SETTLE_DAYS = 2
+SEEDER_HTTPCACHE_TTLS = {
+  '/results/': 0,
+  '/next/': 0,
+  '/match-detail/': 0,
+}
+
+# To store the cache in append-only segment files with an sqlite index (which parallel crawls,
+# `scrapy restate` and the parser benchmark can read concurrently), set
+# HTTPCACHE_STORAGE = 'seeder.httpcache.SegmentCacheStorage'. Each writer's segment is sealed
+# once it reaches SEEDER_HTTPCACHE_SEGMENT_BYTES, and sealed segments are compacted by
+# `scrapy compactcache`.
+SEEDER_HTTPCACHE_SEGMENT_BYTES = 256 * 2**20
+
 
 
 # ========================================================
@@ -84,19 +116,133 @@ SEEDER_DB_CONN_STR = 'sqlite:///private/seeder.db'
 
 SEEDER_SQLALCHEMY_ENGINE_ARGS = {
   'sqlite': {},
-
-  # Run with a single-threaded pool
-  # (http://docs.sqlalchemy.org/en/latest/core/pooling.html#sqlalchemy.pool.SingletonThreadPool)
   'mysql': {
     'connect_args': {
       "connect_timeout": 1,
     },
     'isolation_level': 'READ_COMMITTED',
-    'poolclass': sqlalchemy.pool.StaticPool,
-    'pool_recycle': 5 * 60,
   }
 }
 
+# Set the connection pool of server databases (e.g. mysql, postgresql), from which each
+# writer thread checks out its own connection
+# (https://docs.sqlalchemy.org/en/latest/core/pooling.html#sqlalchemy.pool.QueuePool):
+#   SEEDER_DB_POOL_SIZE:         the number of connections kept open in the pool.
+#   SEEDER_DB_POOL_MAX_OVERFLOW: the number of connections that may be opened beyond the pool size.
+#   SEEDER_DB_POOL_TIMEOUT:      the seconds to wait for a connection before raising an error.
+#   SEEDER_DB_POOL_PRE_PING:     test each connection's liveness when it is checked out.
+#   SEEDER_DB_POOL_RECYCLE:      the seconds after which connections are replaced (-1 to disable).
+# The pool should hold at least SEEDER_DB_WRITER_THREADS + 1 connections (for the writers
+# and the reactor thread). These settings are not applied to sqlite,
+# which keeps sqlalchemy's default pools and a single writer. Any pool arguments set in
+# SEEDER_SQLALCHEMY_ENGINE_ARGS take precedence.
+SEEDER_DB_POOL_SIZE = 5
+SEEDER_DB_POOL_MAX_OVERFLOW = 10
+SEEDER_DB_POOL_TIMEOUT = 30
+SEEDER_DB_POOL_PRE_PING = True
+SEEDER_DB_POOL_RECYCLE = 5 * 60
+
+# Set the engine with which the parsers extract items from pages:
+#   'bs4':  BeautifulSoup with python's html.parser.
+#   'lxml': the lxml tree built by the response's scrapy selector, which is much faster and
+#           produces the same items (as tested against the recorded test cassettes).
+SEEDER_PARSER_ENGINE = 'lxml'
+
+# Set the number of worker processes on which pages are parsed, such that parsing scales
+# with the number of cores rather than running on the reactor thread. At most
+# SEEDER_PARSE_MAX_PENDING pages are queued for or being parsed by the workers at once
+# (if 0, twice the number of processes). If SEEDER_PARSE_PROCESSES is 0, pages are parsed
+# in the spider's process.
+SEEDER_PARSE_PROCESSES = 0
+SEEDER_PARSE_MAX_PENDING = 0
+
+# Set how the MatchDetailParser stores the odds parsed from /match-detail/ pages:
+#   'ticks':  a match_odds row per odds change (the default).
+#   'series': a compact match_odds_series row per bookmaker & match, with packed arrays
+#             of the odds changes (see seeder.models.MatchOddsSeries).
+#   'both':   both of the above.
+SEEDER_ODDS_STORAGE = 'ticks'
+
+# Set the write mode of the seeder.pipelines.DatabasePipeline:
+#   'record': upsert each record in its own transaction as soon as its item is processed.
+#   'bulk':   buffer records in memory and upsert them per model with multi-row
+#             INSERT ... ON CONFLICT DO UPDATE (or ON DUPLICATE KEY UPDATE) statements
+#             whenever SEEDER_BULK_FLUSH_SIZE records are buffered or
+#             SEEDER_BULK_FLUSH_INTERVAL seconds have passed, and when the spider closes.
+SEEDER_DB_WRITE_MODE = 'record'
+SEEDER_BULK_FLUSH_SIZE = 1000
+SEEDER_BULK_FLUSH_INTERVAL = 5.0
+
+# Set the maximum number of primary keys per model that the DatabasePipeline (players &
+# matches) and the ColumnarFilePipeline (every model it writes) keep in memory to skip
+# writing skeleton records for rows already known to exist. The DatabasePipeline preloads
+# the keys from the database when the spider is opened. If set to 0, no keys are cached
+# and every skeleton record is written. Both pipelines (and the restate command) fall back
+# to the same size, KeyCache.DEFAULT_MAX_SIZE, if this setting is unset.
+SEEDER_KEY_CACHE_SIZE = 250000
+
+# Set the load mode of the DatabasePipeline:
+#   'incremental': maintain every index while writing.
+#   'backfill':    drop the secondary indexes of the players, matches & odds tables and use bulk
+#                  load connection settings (e.g. sqlite's write-ahead log with synchronous=OFF and
+#                  a larger page cache) while the spider is open, then rebuild the indexes and
+#                  ANALYZE the tables when it closes.
+#                  This is intended for large backfills, ideally with SEEDER_DB_WRITE_MODE='bulk'.
+SEEDER_LOAD_MODE = 'incremental'
+
+# If False, the DatabasePipeline leaves the secondary indexes to whoever runs it in
+# 'backfill' load mode, e.g. the backfill command drops them once before its shards' crawls
+# and rebuilds them once they have all finished, and sets this to False for each shard.
+SEEDER_LOAD_MANAGE_INDEXES = True
+
+# Set the output of the seeder.pipelines.ColumnarFilePipeline, which may be enabled in
+# ITEM_PIPELINES in place of the DatabasePipeline to write append-only columnar files for
+# large backfills (and requires pyarrow):
+#   SEEDER_COLUMNAR_DIR:            the directory below which each table's files are written.
+#   SEEDER_COLUMNAR_FORMAT:         'parquet' or 'arrow' (the arrow IPC file format).
+#   SEEDER_COLUMNAR_ROW_GROUP_SIZE: the number of rows per model buffered in memory per row group.
+#   SEEDER_COLUMNAR_COMPRESSION:    the compression codec, e.g. 'zstd', 'lz4' or None.
+SEEDER_COLUMNAR_DIR = 'private/columnar'
+SEEDER_COLUMNAR_FORMAT = 'parquet'
+SEEDER_COLUMNAR_ROW_GROUP_SIZE = 100000
+SEEDER_COLUMNAR_COMPRESSION = 'zstd'
+
+# Set the number of background threads used to write items (DatabasePipeline) and crawl
+# metadata (UrlCacheMiddleware) to the database, such that the reactor thread never blocks
+# on SQL. Both share the same threads, of which at most SEEDER_DB_WRITER_MAX_PENDING writes
+# may be queued or running at once; further writes wait (without blocking the reactor) for
+# a write to finish, and the crawl is throttled by the items waiting for their writes.
+# If set to 0, writes are made synchronously on the reactor thread.
+# Nb sqlite supports a single writer only, so at most 1 thread is used for sqlite.
+SEEDER_DB_WRITER_THREADS = 0
+SEEDER_DB_WRITER_MAX_PENDING = 100
+
+# Set the interval in seconds at which the UrlCacheMiddleware flushes its buffered crawl
+# metadata (crawled_urls rows) to the database in bulk. The buffer is also flushed once it
+# holds SEEDER_URL_CACHE_FLUSH_SIZE rows, when the spider is idle, and when it is closed.
+# If set to 0, each url's metadata is written immediately when its response is processed.
+SEEDER_URL_CACHE_FLUSH_INTERVAL = 10.0
+SEEDER_URL_CACHE_FLUSH_SIZE = 1000
+
+# Set whether to skip requests to the /match-detail/ pages of matches that are finalized in
+# the database, i.e. those that have a result, a surface, and a closing line issued more than
+# SEEDER_MATCH_SETTLE_DAYS days ago. Finalized matches are loaded once when the spider opens.
+SEEDER_SKIP_FINALIZED_MATCHES = False
+SEEDER_MATCH_SETTLE_DAYS = 2
+
+# Set whether to store a fingerprint (hash) of each crawled page's html in the crawled_urls
+# table, and skip parsing items from pages whose fingerprint is unchanged since they were last
+# crawled. Links are still parsed from unchanged pages. Before hashing, fragments of the html
+# matching any of the SEEDER_FINGERPRINT_VOLATILE_PATTERNS regexes are removed, since these
+# change between requests without a change in the page's data. A page's fingerprint is only
+# stored by the DatabasePipeline once all of the page's items were written.
+SEEDER_FINGERPRINT_ENABLED = False
+SEEDER_FINGERPRINT_VOLATILE_PATTERNS = [
+  r'<script\b.*?</script>',
+  r'<style\b.*?</style>',
+  r'<!--.*?-->',
+]
+
 # Set seeder endpoints to exclude from crawling. Adding an entry here controls whether the
 # spider will make further requessts for certain endpoints, e.g. '/match-detail/'.
 # If you don't want to crawl these (e.g. to speed up a specific crawl), they can be removed.
@@ -116,3 +262,37 @@ SEEDER_START_WATERMARK = None
 # Set the latest date for which the /results/ pages should be crawled
 # If set to None, this will default to today + 7 days
 SEEDER_STOP_WATERMARK = None
+
+# Set how the /results/ pages of the watermark span are crawled:
+#   'walk':   request the page of SEEDER_START_DATE, and follow each page's previous/next
+#             day links, such that the pages are fetched one after another.
+#   'fanout': request the page of every date in the span up front (lazily, as the scheduler
+#             has capacity), such that the pages download in parallel up to the
+#             CONCURRENT_REQUESTS. The previous/next day links are then not followed.
+SEEDER_CRAWL_MODE = 'walk'
+
+# To share the crawl's requests with other worker processes through a frontier table in the
+# seeder database, set SCHEDULER = 'seeder.frontier.FrontierScheduler'. Workers crawling the
+# same SEEDER_FRONTIER_QUEUE (default: the spider's name) claim batches of
+# SEEDER_FRONTIER_BATCH_SIZE requests (if 0, CONCURRENT_REQUESTS) with leases of
+# SEEDER_FRONTIER_LEASE_SECS seconds, which they renew while they hold them. The requests
+# of expired leases, and those whose download failed, are claimed again, up to
+# SEEDER_FRONTIER_MAX_ATTEMPTS times. Enqueued requests are pushed (and processed requests
+# marked done, and failed ones released) every SEEDER_FRONTIER_FLUSH_INTERVAL seconds, or
+# once SEEDER_FRONTIER_FLUSH_SIZE are buffered.
+SEEDER_FRONTIER_QUEUE = None
+SEEDER_FRONTIER_BATCH_SIZE = 0
+SEEDER_FRONTIER_LEASE_SECS = 300
+SEEDER_FRONTIER_MAX_ATTEMPTS = 3
+SEEDER_FRONTIER_FLUSH_INTERVAL = 1.0
+SEEDER_FRONTIER_FLUSH_SIZE = 500
+
+# If SEEDER_METRICS_ENABLED, the CrawlMetrics extension records histograms of the download
+# latency, parse time, items & links of each endpoint's pages, the HTTP cache hits & misses of
+# each endpoint, and the database upsert time & rows of each model. They are exported every
+# SEEDER_METRICS_INTERVAL seconds (and when the spider is closed) to the crawl's stats
+# (under seeder/metrics/) and, if SEEDER_METRICS_TEXTFILE is set, to that file in the
+# Prometheus text format (e.g. in the directory of the node exporter's textfile collector).
+SEEDER_METRICS_ENABLED = True
+SEEDER_METRICS_TEXTFILE = None
+SEEDER_METRICS_INTERVAL = 60
@@ -2,6 +2,7 @@ from copy import deepcopy
 import logging
 import os
 import re
+import time
 import uuid
 
 from datetime import MINYEAR, date, datetime, timedelta
@@ -10,10 +11,15 @@ from urllib.parse import urlparse, parse_qs
 
 from bs4 import BeautifulSoup
 import scrapy
+from scrapy.utils.defer import maybe_deferred_to_future
 
+from seeder.extensions import page_parsed
 from seeder.items import MatchItem
+from seeder.parsers import ParsedDocument
+from seeder.parsers.offload import ParsePool
 from seeder.parsers.match_result_parser import MatchResultParser
 from seeder.parsers.match_detail_parser import MatchDetailParser
+from seeder.util.fingerprint import UNCHANGED_META_KEY
 from seeder.util.urls import update_query
 
 logger = logging.getLogger(__name__)
@@ -21,31 +27,49 @@ logger = logging.getLogger(__name__)
 
 class TennisExplorerSpider(scrapy.Spider):
 
+  # The requests of each endpoint are downloaded in a download slot of their own (see the
+  # DOWNLOAD_SLOTS setting), with its own concurrency & (start) delay, such that the cheap
+  # listing pages are not starved by the heavy /match-detail/ pages. Under the AutoThrottle,
+  # the delay of each slot adapts to its own latency (see seeder.extensions.EndpointThrottle),
+  # aiming for the slot's target_concurrency within [min_delay, max_delay]. Together, the
+  # slots stay within the budget of the single per-domain slot they replace: their
+  # concurrencies sum to CONCURRENT_REQUESTS_PER_DOMAIN (8), their target concurrencies to
+  # AUTOTHROTTLE_TARGET_CONCURRENCY (2.0), and they start at AUTOTHROTTLE_START_DELAY (1.0).
   ENDPOINT_PARSERS = {
     '/results/': {
       'parser': MatchResultParser,
       'parser_kwargs': {},
       'request_kwargs': {'priority': 1},
+      'download_slot': {'concurrency': 2, 'delay': 1.0, 'target_concurrency': 0.5},
     },
     '/next/': {
       'parser': MatchResultParser,
       'parser_kwargs': {},
       'request_kwargs': {'priority': 1},
+      'download_slot': {'concurrency': 1, 'delay': 1.0, 'target_concurrency': 0.25},
     },
     '/match-detail/': {
       'parser': MatchDetailParser,
       'parser_kwargs': {},
       'request_kwargs': {'priority': 0},
+      'download_slot': {'concurrency': 5, 'delay': 1.0, 'target_concurrency': 1.25},
     },
   }
   
+  # 'walk': start from the /results/ page of the start_date, and follow its previous/next day links
+  # 'fanout': request the /results/ page of every date in the watermark span up front
+  CRAWL_MODES = ('walk', 'fanout')
+
   default_start_watermark_offset = 2
   default_stop_watermark_offset = 3
   name = 'tennisexplorer'
   allowed_domains = ['tennisexplorer.com']
 
-  def __init__(self, *args, start_date=None, start_watermark=None, stop_watermark=None, exclude_endpoints=None, **kwargs):
+  def __init__(self, *args, start_date=None, start_watermark=None, stop_watermark=None, exclude_endpoints=None, odds_storage='ticks', parser_engine='lxml', parse_processes=0, parse_max_pending=None, crawl_mode='walk', **kwargs):
     super().__init__(*args, **kwargs)
+    if crawl_mode not in self.CRAWL_MODES:
+      raise ValueError(f"Unknown crawl mode '{crawl_mode}', expected one of {self.CRAWL_MODES}")
+    self.crawl_mode = crawl_mode
     self.crawl_id = uuid.uuid4()
     today = datetime.fromordinal(date.today().toordinal())
     self.start_watermark = (
@@ -61,16 +85,43 @@ class TennisExplorerSpider(scrapy.Spider):
     assert self.start_date >= self.start_watermark
 
     ctx = {
-      'logger': self.logger,
       'start_watermark': self.start_watermark,
       'stop_watermark': self.stop_watermark,
+      'engine': parser_engine,
     }
-    self.parsers = {
-      endpoint: config['parser'](**ctx, **config.get('parser_kwargs', {})) 
+    endpoint_kwargs = {
+      '/match-detail/': {'odds_storage': odds_storage},
+    }
+    # The (parser class, kwargs) of each endpoint, from which the parsers of worker processes are built
+    self.parser_specs = {
+      endpoint: (config['parser'], {**ctx, **config.get('parser_kwargs', {}), **endpoint_kwargs.get(endpoint, {})})
       for (endpoint, config) in self.ENDPOINT_PARSERS.items()
       if endpoint not in (exclude_endpoints or set())
     }
-    self.logger.info(f"Running {type(self)} spider over watermark span [{self.start_watermark}, {self.stop_watermark}] starting from {self.start_date}.")
+    self.parsers = {
+      endpoint: parser_cls(logger=self.logger, **kwargs)
+      for (endpoint, (parser_cls, kwargs)) in self.parser_specs.items()
+    }
+    # If parse_processes is positive, pages are parsed on a pool of worker processes
+    self.parse_pool = None
+    if parse_processes > 0:
+      self.parse_pool = ParsePool(self.parser_specs, num_processes=parse_processes, max_pending=parse_max_pending)
+    self.logger.info(f"Running {type(self)} spider ({self.crawl_mode} mode) over watermark span [{self.start_watermark}, {self.stop_watermark}] starting from {self.start_date}.")
+
+  @classmethod
+  def download_slot(cls, endpoint):
+    return f'{cls.allowed_domains[0]}{endpoint}'
+
+  @classmethod
+  def update_settings(cls, settings):
+    super().update_settings(settings)
+    # The endpoints' download slots, unless overridden in the DOWNLOAD_SLOTS setting
+    slots = {
+      cls.download_slot(endpoint): config['download_slot']
+      for (endpoint, config) in cls.ENDPOINT_PARSERS.items()
+      if 'download_slot' in config
+    }
+    settings.set('DOWNLOAD_SLOTS', {**slots, **settings.getdict('DOWNLOAD_SLOTS')}, priority='spider')
 
   @classmethod
   def from_crawler(cls, crawler, *args, **kwargs):
@@ -92,40 +143,139 @@ class TennisExplorerSpider(scrapy.Spider):
       start_watermark=_parse_datetime(crawler.settings.get('SEEDER_START_WATERMARK')),
       stop_watermark=_parse_datetime(crawler.settings.get('SEEDER_STOP_WATERMARK')),
       exclude_endpoints=crawler.settings.getlist('SEEDER_EXCLUDE_ENDPOINTS'),
+      odds_storage=crawler.settings.get('SEEDER_ODDS_STORAGE', 'ticks'),
+      parser_engine=crawler.settings.get('SEEDER_PARSER_ENGINE', 'lxml'),
+      parse_processes=crawler.settings.getint('SEEDER_PARSE_PROCESSES', 0),
+      parse_max_pending=crawler.settings.getint('SEEDER_PARSE_MAX_PENDING', 0) or None,
+      crawl_mode=crawler.settings.get('SEEDER_CRAWL_MODE', 'walk'),
       **kwargs
     )
     return spider
 
-  def start_requests(self):
-    url = "https://www.tennisexplorer.com/results/?type=all&year={year}&month={month}&day={day}&timezone=+0".format(
-      year=self.start_date.strftime('%Y'),
-      month=self.start_date.strftime('%m'),
-      day=self.start_date.strftime('%d'),
+  def results_url(self, day):
+    return "https://www.tennisexplorer.com/results/?type=all&year={year}&month={month}&day={day}&timezone=+0".format(
+      year=day.strftime('%Y'),
+      month=day.strftime('%m'),
+      day=day.strftime('%d'),
     )
-    yield scrapy.Request(url, self.parse)
+
+  def fanout_dates(self):
+    """
+    Yield each date of the watermark span, in the order the walk would reach them: from the
+    start_date forwards to the stop watermark, then backwards to the start watermark.
+    """
+    day = self.start_date
+    while day <= self.stop_watermark:
+      yield day
+      day += timedelta(days=1)
+    day = self.start_date - timedelta(days=1)
+    while day >= self.start_watermark:
+      yield day
+      day -= timedelta(days=1)
+
+  def make_request(self, url):
+    """
+    Return the request of a url, with the request kwargs & download slot of its endpoint.
+    """
+    endpoint = urlparse(url).path
+    config = self.ENDPOINT_PARSERS.get(endpoint, {})
+    meta = {'download_slot': self.download_slot(endpoint)} if 'download_slot' in config else None
+    return scrapy.Request(url, self.parse, meta=meta, **config.get('request_kwargs', {}))
+
+  async def start(self):
+    # Scrapy >= 2.13 no longer calls start_requests() by default
+    for request in self.start_requests():
+      yield request
+
+  def start_requests(self):
+    if self.crawl_mode == 'walk':
+      yield self.make_request(self.results_url(self.start_date))
+      return
+    # The requests are generated lazily, as scrapy's scheduler has capacity for them
+    for day in self.fanout_dates():
+      yield self.make_request(self.results_url(day))
+
+  def _is_unchanged(self, response):
+    """
+    Return whether the response was flagged by the UrlCacheMiddleware as having the same
+    content fingerprint as when its url was last crawled.
+    """
+    return (response.request is not None) and response.meta.get(UNCHANGED_META_KEY, False)
+
+  def closed(self, reason):
+    if self.parse_pool is not None:
+      self.parse_pool.close()
 
   def parse(self, response):
     """
     Parsing responses into further requests or items.
 
     This method is an entrypoint to route responses to respective parse methods
-    based on the url path, but doesn't do any parsing itself.
+    based on the url path, but doesn't do any parsing itself. If the spider has a
+    parse pool, the response is parsed on a worker process.
     """
     url = urlparse(response.url)
     parser = self.parsers.get(url.path) 
     if not parser:
       self.logger.debug(
         f"{self.name.title()} spider got response for '{url.path}' but has no parser for this endpoint.")
-      return
+      return []
+
+    # Items have already been processed from pages whose content is unchanged since last crawled,
+    # but links are still parsed since their targets may have changed.
+    parse_items = True
+    if self._is_unchanged(response):
+      self.logger.debug(f"Skipping items from '{response.url}' since its content is unchanged.")
+      if hasattr(self, 'crawler'):
+        self.crawler.stats.inc_value('seeder/fingerprint/skip', spider=self)
+      parse_items = False
+
+    if self.parse_pool is not None:
+      return self._parse_offloaded(response, parse_items)
+    return self._parse(response, parser, parse_items)
 
-    for item in parser.parse_items(response):
+  def _page_parsed(self, response, parse_seconds, items, links):
+    if hasattr(self, 'crawler'):
+      self.crawler.signals.send_catch_log(
+        signal=page_parsed,
+        response=response,
+        parse_seconds=parse_seconds,
+        num_items=len(items),
+        num_links=len(links),
+      )
+
+  def _parse(self, response, parser, parse_items):
+    start = time.perf_counter()
+    # The response is parsed once, and its parsed document shared by the parser's methods
+    document = ParsedDocument(response)
+    items = list(parser.parse_items(response, document=document)) if parse_items else []
+    links = list(parser.parse_links(response, document=document))
+    self._page_parsed(response, time.perf_counter() - start, items, links)
+    for item in items:
+      yield item
+    yield from self._requests(response, links)
+
+  async def _parse_offloaded(self, response, parse_items):
+    start = time.perf_counter()
+    d = self.parse_pool.submit(response.url, response.body, encoding=response.encoding, parse_items=parse_items)
+    (items, links) = await maybe_deferred_to_future(d)
+    # The parse time of an offloaded page includes its wait for a worker process
+    self._page_parsed(response, time.perf_counter() - start, items, links)
+    for item in items:
       yield item
+    for request in self._requests(response, links):
+      yield request
 
-    for href in parser.parse_links(response):
+  def _requests(self, response, links):
+    for href in links:
       endpoint = urlparse(href).path
       if endpoint not in self.parsers:
         self.logger.debug(f"{self.name.title()} spider has no parser for '{endpoint}': SKIPPING '{href}'")
         continue
-      request_kwargs = self.ENDPOINT_PARSERS.get(endpoint, {}).get('request_kwargs', {})
+      if self.crawl_mode == 'fanout' and endpoint == '/results/':
+        # The previous/next day links (within the watermark span) were already requested up front
+        if hasattr(self, 'crawler'):
+          self.crawler.stats.inc_value('seeder/fanout/nav_link_skip', spider=self)
+        continue
       url = update_query(response.urljoin(href), {'timezone': '+0'}) # UTC timestamps only
-      yield scrapy.Request(url, self.parse, **request_kwargs)
+      yield self.make_request(url)
@@ -0,0 +1,222 @@
+"""
+Write and read the rows of the seeder.models tables as partitioned columnar files.
+
+Each model's rows are written below {directory}/{tablename}/, optionally partitioned
+into hive-style date=YYYY-MM-DD subdirectories by the date of a datetime column (or of
+datetimes given with the rows). The rows are read back in record batches (see iter_rows).
+Files are append-only: each writer creates new part files and never rewrites existing ones.
+This module requires the optional pyarrow dependency.
+"""
+import enum
+import os
+import uuid
+
+from collections import OrderedDict
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+import sqlalchemy
+from sqlalchemy_utils import UUIDType
+
+FORMATS = {
+  'parquet': '.parquet',
+  'arrow': '.arrow',
+}
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def arrow_type(column_type):
+  """
+  Return the arrow type that stores the values of a sqlalchemy column type.
+  """
+  if isinstance(column_type, UUIDType):
+    return pyarrow.binary(16)
+  # Enums are stored by name, as sqlalchemy does; nb Enum is a subclass of String
+  if isinstance(column_type, sqlalchemy.Enum):
+    return pyarrow.string()
+  if isinstance(column_type, sqlalchemy.Boolean):
+    return pyarrow.bool_()
+  if isinstance(column_type, sqlalchemy.Integer):
+    return pyarrow.int64()
+  if isinstance(column_type, sqlalchemy.Float):
+    return pyarrow.float64()
+  if isinstance(column_type, sqlalchemy.DateTime):
+    return pyarrow.timestamp('us')
+  if isinstance(column_type, sqlalchemy.String):
+    return pyarrow.string()
+  if isinstance(column_type, sqlalchemy.LargeBinary):
+    return pyarrow.binary()
+  raise ValueError(f"No arrow type is defined for column type {column_type}")
+
+
+def arrow_schema(model):
+  return pyarrow.schema([
+    pyarrow.field(c.name, arrow_type(c.type), nullable=not c.primary_key)
+    for c in model.__table__.columns
+  ])
+
+
+def to_arrow_value(value):
+  if isinstance(value, uuid.UUID):
+    return value.bytes
+  if isinstance(value, enum.Enum):
+    return value.name
+  return value
+
+
+def from_arrow_value(column, value):
+  if value is None:
+    return None
+  if isinstance(column.type, UUIDType):
+    return uuid.UUID(bytes=value)
+  if isinstance(column.type, sqlalchemy.Enum) and column.type.enum_class is not None:
+    return column.type.enum_class[value]
+  return value
+
+
+def to_table(schema, rows):
+  """
+  Build an arrow table from dictionary-like rows, with nulls for any missing columns.
+  """
+  return pyarrow.Table.from_pydict({
+    name: [to_arrow_value(r.get(name)) for r in rows]
+    for name in schema.names
+  }, schema=schema)
+
+
+def partition_name(value):
+  if value is None:
+    return f'date={NULL_PARTITION}'
+  return f'date={value.date().isoformat()}'
+
+
+class PartitionedFileWriter(object):
+  """
+  Append the rows of a model to columnar files, partitioned by the date of partition_column.
+
+  Each call to write appends one row group (parquet) or record batch (arrow) per partition
+  to the partition's open file. At most max_open_files are kept open at once; a partition
+  whose file was closed continues in a new part file when it is next written.
+  """
+
+  def __init__(self, directory, model, file_format='parquet', partition_column=None, compression='zstd', prefix='part', max_open_files=64):
+    if file_format not in FORMATS:
+      raise ValueError(f"Unknown file_format '{file_format}'; expected one of {tuple(FORMATS)}")
+    self.directory = os.path.join(directory, model.__tablename__)
+    self.model = model
+    self.file_format = file_format
+    self.partition_column = partition_column
+    self.compression = compression
+    self.prefix = prefix
+    self.max_open_files = max_open_files
+    self.schema = arrow_schema(model)
+    self.writers = OrderedDict()
+    self.num_parts = {}
+    self.num_rows = 0
+
+  def _path(self, partition):
+    directory = self.directory if partition is None else os.path.join(self.directory, partition)
+    os.makedirs(directory, exist_ok=True)
+    part = self.num_parts.get(partition, 0)
+    self.num_parts[partition] = part + 1
+    return os.path.join(directory, f'{self.prefix}-{part:05d}{FORMATS[self.file_format]}')
+
+  def _open(self, partition):
+    path = self._path(partition)
+    if self.file_format == 'parquet':
+      return pyarrow.parquet.ParquetWriter(path, self.schema, compression=self.compression)
+    options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+    return pyarrow.ipc.new_file(path, self.schema, options=options)
+
+  def _writer(self, partition):
+    writer = self.writers.get(partition)
+    if writer is None:
+      while len(self.writers) >= self.max_open_files:
+        (_, lru) = self.writers.popitem(last=False)
+        lru.close()
+      writer = self.writers[partition] = self._open(partition)
+    self.writers.move_to_end(partition)
+    return writer
+
+  def write(self, rows, partition_values=None):
+    """
+    Append the rows, partitioned by the date of their partition_column or, if given, of
+    their partition_values (e.g. of a column of another model's rows).
+    """
+    if partition_values is None and self.partition_column:
+      partition_values = [row.get(self.partition_column) for row in rows]
+    partitions = {}
+    for (k, row) in enumerate(rows):
+      key = partition_name(partition_values[k]) if partition_values is not None else None
+      partitions.setdefault(key, []).append(row)
+    for (partition, partition_rows) in partitions.items():
+      self._writer(partition).write_table(to_table(self.schema, partition_rows))
+    self.num_rows += len(rows)
+
+  def close(self):
+    while self.writers:
+      (_, writer) = self.writers.popitem(last=False)
+      writer.close()
+
+
+def _files(directory, model):
+  root = os.path.join(directory, model.__tablename__)
+  for (path, _, filenames) in sorted(os.walk(root)):
+    for filename in sorted(filenames):
+      if filename.endswith(tuple(FORMATS.values())):
+        yield os.path.join(path, filename)
+
+
+def read_table(directory, model):
+  """
+  Read all rows of a model written below directory into a single arrow table.
+  """
+  tables = []
+  for filepath in _files(directory, model):
+    if filepath.endswith(FORMATS['parquet']):
+      tables.append(pyarrow.parquet.read_table(filepath, schema=arrow_schema(model)))
+    else:
+      with pyarrow.ipc.open_file(filepath) as reader:
+        tables.append(reader.read_all())
+  if not tables:
+    return arrow_schema(model).empty_table()
+  return pyarrow.concat_tables(tables)
+
+
+def iter_batches(directory, model, batch_size=65536):
+  """
+  Yield the rows of a model written below directory as arrow record batches of at most
+  batch_size rows, reading one file's row group (or record batch) at a time.
+  """
+  for filepath in _files(directory, model):
+    if filepath.endswith(FORMATS['parquet']):
+      yield from pyarrow.parquet.ParquetFile(filepath).iter_batches(batch_size=batch_size)
+      continue
+    with pyarrow.ipc.open_file(filepath) as reader:
+      for k in range(reader.num_record_batches):
+        batch = reader.get_batch(k)
+        for offset in range(0, batch.num_rows, batch_size):
+          yield batch.slice(offset, batch_size)
+
+
+def iter_rows(directory, model, batch_size=65536):
+  """
+  Yield the rows of a model written below directory in lists of at most batch_size dicts
+  of their non-null column values, e.g. to bulk load the rows into the database in chunks
+  with seeder.db.upsert_dicts, without reading all of them into memory at once.
+  """
+  columns = {c.name: c for c in model.__table__.columns}
+  for batch in iter_batches(directory, model, batch_size=batch_size):
+    yield [
+      {k: from_arrow_value(columns[k], v) for (k, v) in row.items() if v is not None}
+      for row in batch.to_pylist()
+    ]
+
+
+def read_rows(directory, model):
+  """
+  Read all rows of a model written below directory as dicts of their non-null column
+  values (see iter_rows, which reads them in chunks).
+  """
+  return [row for rows in iter_rows(directory, model) for row in rows]
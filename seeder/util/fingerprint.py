@@ -0,0 +1,36 @@
+import functools
+import hashlib
+import re
+
+# Request meta keys set by the UrlCacheMiddleware for each response it fingerprints
+FINGERPRINT_META_KEY = 'seeder_body_fingerprint'
+UNCHANGED_META_KEY = 'seeder_body_unchanged'
+
+# Fragments of tennisexplorer.com pages that change between requests without any change in
+# the page's data, e.g. ad & tracking scripts, stylesheets and comments.
+VOLATILE_PATTERNS = [
+  rb'<script\b.*?</script>',
+  rb'<style\b.*?</style>',
+  rb'<!--.*?-->',
+]
+
+@functools.lru_cache(maxsize=8)
+def _compile(patterns):
+  return re.compile(b'|'.join(patterns), flags=re.S | re.I)
+
+def normalize_body(body, patterns=VOLATILE_PATTERNS):
+  """
+  Remove the volatile fragments matching any of the regex patterns from an html body,
+  and collapse its whitespace.
+  """
+  if patterns:
+    body = _compile(tuple(patterns)).sub(b'', body)
+  return re.sub(rb'\s+', b' ', body).strip()
+
+def fingerprint_body(body, patterns=VOLATILE_PATTERNS, version=None):
+  """
+  Return a hex digest of the normalized html body, salted with the version (if any) of the
+  parsers, such that a page's fingerprint changes when the items parsed from it may change.
+  """
+  salt = f'{version}\n'.encode() if version is not None else b''
+  return hashlib.sha1(salt + normalize_body(body, patterns)).hexdigest()
@@ -0,0 +1,159 @@
+"""
+Thread-safe histograms & counters with labels, rendered in the Prometheus text exposition
+format (e.g. for the textfile collector of the node exporter).
+"""
+import bisect
+import math
+import os
+import threading
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Histogram(object):
+  """
+  The count of observations in each of the (upper inclusive) buckets, with their sum.
+  """
+
+  def __init__(self, buckets):
+    self.buckets = tuple(sorted(buckets))
+    # The last count is of the observations above the largest bucket (+Inf)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    with self.lock:
+      self.counts[bisect.bisect_left(self.buckets, value)] += 1
+      self.count += 1
+      self.sum += value
+
+  def cumulative_counts(self):
+    with self.lock:
+      counts = list(self.counts)
+    total = 0
+    cumulative = []
+    for count in counts:
+      total += count
+      cumulative.append(total)
+    return cumulative
+
+  def quantile(self, q):
+    """
+    Estimate the q-quantile by linear interpolation within its bucket (as Prometheus'
+    histogram_quantile), or return None if there are no observations.
+    """
+    cumulative = self.cumulative_counts()
+    if cumulative[-1] == 0:
+      return None
+    rank = q * cumulative[-1]
+    k = bisect.bisect_left(cumulative, rank)
+    if k == len(self.buckets):
+      return self.buckets[-1]
+    (lower, below) = (self.buckets[k - 1], cumulative[k - 1]) if k > 0 else (min(0, self.buckets[0]), 0)
+    in_bucket = cumulative[k] - below
+    return lower + (self.buckets[k] - lower) * ((rank - below) / in_bucket if in_bucket else 1.0)
+
+  def summary(self):
+    """
+    Return a dict of the count, sum, mean & estimated p50/p90/p99 of the observations.
+    """
+    with self.lock:
+      (count, total) = (self.count, self.sum)
+    rounded = lambda v: None if v is None else round(v, 6)
+    return {
+      'count': count,
+      'sum': round(total, 6),
+      'mean': rounded(total / count if count else None),
+      'p50': rounded(self.quantile(0.5)),
+      'p90': rounded(self.quantile(0.9)),
+      'p99': rounded(self.quantile(0.99)),
+    }
+
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{' + ','.join(f'{k}="{escape(v)}"' for (k, v) in labels) + '}'
+
+
+def _format_value(value):
+  if math.isinf(value):
+    return '+Inf' if value > 0 else '-Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricRegistry(object):
+  """
+  A registry of named histograms & counters, each with a series per set of label values.
+  """
+
+  def __init__(self):
+    self.metrics = {}
+    self.lock = threading.Lock()
+
+  def histogram(self, name, documentation, buckets):
+    self.metrics[name] = {'type': 'histogram', 'help': documentation, 'buckets': buckets, 'series': {}}
+
+  def counter(self, name, documentation):
+    self.metrics[name] = {'type': 'counter', 'help': documentation, 'series': {}}
+
+  def observe(self, name, value, **labels):
+    metric = self.metrics[name]
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      histogram = metric['series'].get(key)
+      if histogram is None:
+        histogram = metric['series'][key] = Histogram(metric['buckets'])
+    histogram.observe(value)
+
+  def inc(self, name, value=1, **labels):
+    series = self.metrics[name]['series']
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      series[key] = series.get(key, 0) + value
+
+  def series(self, name):
+    """
+    Return a dict of the series (Histogram or counter value) of a metric by their labels.
+    """
+    with self.lock:
+      return dict(self.metrics[name]['series'])
+
+  def to_prometheus(self, const_labels=None):
+    """
+    Render the metrics in the Prometheus text exposition format, with the const_labels
+    (a dict) added to every series.
+    """
+    const = tuple(sorted((const_labels or {}).items()))
+    lines = []
+    for (name, metric) in self.metrics.items():
+      lines.append(f"# HELP {name} {metric['help']}")
+      lines.append(f"# TYPE {name} {metric['type']}")
+      for (key, value) in sorted(self.series(name).items()):
+        labels = const + key
+        if metric['type'] == 'counter':
+          lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+          continue
+        bounds = list(value.buckets) + [math.inf]
+        for (bound, count) in zip(bounds, value.cumulative_counts()):
+          lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(float(bound))),))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+    return '\n'.join(lines) + '\n'
+
+  def write_textfile(self, path, const_labels=None):
+    """
+    Write the metrics to a file atomically (as the textfile collector requires), by
+    writing a temporary file that then replaces it.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write(self.to_prometheus(const_labels))
+    os.replace(tmp_path, path)
@@ -0,0 +1,42 @@
+"""
+Pack and unpack series of timestamps & floats as little-endian binary arrays.
+"""
+import array
+import datetime
+import math
+import sys
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _pack(typecode, values):
+  a = array.array(typecode, values)
+  if sys.byteorder != 'little':
+    a.byteswap()
+  return a.tobytes()
+
+def _unpack(typecode, data):
+  a = array.array(typecode)
+  a.frombytes(data)
+  if sys.byteorder != 'little':
+    a.byteswap()
+  return a
+
+def pack_timestamps(timestamps):
+  """
+  Pack naive datetimes as int64 microseconds since the epoch.
+  """
+  return _pack('q', [(ts - EPOCH) // MICROSECOND for ts in timestamps])
+
+def unpack_timestamps(data):
+  return [EPOCH + us * MICROSECOND for us in _unpack('q', data)]
+
+def pack_floats(values):
+  """
+  Pack floats as float64, with None packed as NaN.
+  """
+  return _pack('d', [math.nan if v is None else v for v in values])
+
+def unpack_floats(data):
+  return [None if math.isnan(v) else v for v in _unpack('d', data)]
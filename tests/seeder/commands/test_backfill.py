@@ -0,0 +1,128 @@
+import datetime
+import os
+
+import pytest
+import scrapy
+import sqlalchemy
+from scrapy.settings import Settings
+
+from seeder.commands.backfill import backfill, plan_shards, run_shard, shard_cache_dir
+from seeder.models import Crawl, Match
+from seeder.pipelines import drop_backfill_indexes, rebuild_backfill_indexes
+from tests.seeder.parsers.test_match_result_parser import CASSETTE_DIR, cassette_responses
+
+
+class CassetteDownloaderMiddleware(object):
+  """
+  Serve the recorded /results/ page (of 2 matches) for every request, in place of the network.
+  """
+
+  def __init__(self):
+    [response] = cassette_responses(os.path.join(CASSETTE_DIR, 'TestMatchResultParser.test_parse_links.yaml'))
+    self.body = response.body
+
+  def process_request(self, request, spider):
+    return scrapy.http.HtmlResponse(request.url, body=self.body, request=request)
+
+
+def _crawl(overrides, start_watermark, stop_watermark, log_file=None):
+  # Fail the first attempt of the shard starting at overrides['FAIL_DATE'], and every attempt
+  # of the shard starting at overrides['ALWAYS_FAIL_DATE']
+  marker = os.path.join(overrides['DIR'], start_watermark.date().isoformat())
+  if start_watermark == overrides['ALWAYS_FAIL_DATE']:
+    raise SystemExit(1)
+  if start_watermark == overrides['FAIL_DATE'] and not os.path.exists(marker):
+    open(marker, 'w').close()
+    raise SystemExit(1)
+  with open(marker, 'w') as f:
+    f.write(stop_watermark.date().isoformat())
+
+
+def _crawl_cache_dir(overrides, start_watermark, stop_watermark, log_file=None):
+  with open(os.path.join(overrides['DIR'], start_watermark.date().isoformat()), 'w') as f:
+    f.write(overrides['HTTPCACHE_DIR'])
+
+
+def test_plan_shards():
+  start = datetime.datetime(2022, 1, 1)
+  shards = plan_shards(start, datetime.datetime(2022, 1, 10), 3)
+  assert shards == [
+    (start, datetime.datetime(2022, 1, 4)),
+    (datetime.datetime(2022, 1, 5), datetime.datetime(2022, 1, 7)),
+    (datetime.datetime(2022, 1, 8), datetime.datetime(2022, 1, 10)),
+  ]
+  # No more shards than days
+  assert plan_shards(start, start, 4) == [(start, start)]
+
+
+def test_backfill_retries_failed_shards(tmp_path):
+  shards = plan_shards(datetime.datetime(2022, 1, 1), datetime.datetime(2022, 1, 6), 3)
+  overrides = {
+    'DIR': str(tmp_path),
+    'FAIL_DATE': datetime.datetime(2022, 1, 3),
+    'ALWAYS_FAIL_DATE': datetime.datetime(2022, 1, 5),
+  }
+  shards = backfill(shards, overrides=overrides, processes=2, retries=1, target=_crawl, poll_interval=0.05)
+
+  assert [(s.status, s.attempts) for s in shards] == [('finished', 1), ('finished', 2), ('failed', 2)]
+  assert (tmp_path / '2022-01-01').read_text() == '2022-01-02'
+  assert (tmp_path / '2022-01-03').read_text() == '2022-01-04'
+
+
+def test_shard_cache_dir():
+  settings = Settings({'HTTPCACHE_ENABLED': True, 'HTTPCACHE_DIR': 'httpcache', 'HTTPCACHE_STORAGE': 'scrapy.extensions.httpcache.DbmCacheStorage'})
+  assert shard_cache_dir(settings, processes=2) == 'httpcache'
+  assert shard_cache_dir(settings, processes=1) is None
+  # The SegmentCacheStorage supports several writers
+  settings.set('HTTPCACHE_STORAGE', 'seeder.httpcache.SegmentCacheStorage')
+  assert shard_cache_dir(settings, processes=2) is None
+  settings.set('HTTPCACHE_STORAGE', 'scrapy.extensions.httpcache.DbmCacheStorage')
+  settings.set('HTTPCACHE_ENABLED', False)
+  assert shard_cache_dir(settings, processes=2) is None
+
+
+def test_backfill_caches_each_shard_separately(tmp_path):
+  shards = plan_shards(datetime.datetime(2022, 1, 1), datetime.datetime(2022, 1, 4), 2)
+  overrides = {'DIR': str(tmp_path), 'HTTPCACHE_DIR': 'httpcache'}
+  shards = backfill(shards, overrides=overrides, processes=2, cache_dir='httpcache', target=_crawl_cache_dir, poll_interval=0.05)
+
+  assert [s.status for s in shards] == ['finished', 'finished']
+  assert (tmp_path / '2022-01-01').read_text() == os.path.join('httpcache', 'shard-0')
+  assert (tmp_path / '2022-01-03').read_text() == os.path.join('httpcache', 'shard-1')
+  # The shards' overrides are copies of the command's
+  assert overrides['HTTPCACHE_DIR'] == 'httpcache'
+
+
+def test_backfill_runs_shard_crawls(tmp_path, monkeypatch):
+  # Scrapy's crawlers load its remote control extension, which requires aiohttp
+  pytest.importorskip('aiohttp')
+  conn_str = f"sqlite:///{tmp_path / 'seeder.db'}"
+  # The shards' processes inherit the environment
+  monkeypatch.setenv('SEEDER_DB_CONN_STR', conn_str)
+  engine = sqlalchemy.create_engine(conn_str)
+  overrides = {
+    'DOWNLOADER_MIDDLEWARES': {f'{__name__}.CassetteDownloaderMiddleware': 1},
+    'HTTPCACHE_ENABLED': False,
+    'TELNETCONSOLE_ENABLED': False,
+    'REMOTE_CONTROL_ENABLED': False,
+    'SEEDER_CRAWL_MODE': 'fanout',
+    'SEEDER_EXCLUDE_ENDPOINTS': ['/next/', '/match-detail/'],
+    'SEEDER_LOAD_MODE': 'backfill',
+    'SEEDER_LOAD_MANAGE_INDEXES': False,
+  }
+  shards = plan_shards(datetime.datetime(2022, 1, 1), datetime.datetime(2022, 1, 4), 2)
+  shards = backfill(shards, overrides=overrides, processes=2, retries=0, log_dir=str(tmp_path / 'logs'), target=run_shard, poll_interval=0.1)
+
+  assert [s.status for s in shards] == ['finished', 'finished']
+  assert sorted(os.listdir(tmp_path / 'logs')) == ['shard-0-1.log', 'shard-1-1.log']
+  with sqlalchemy.orm.Session(engine) as session:
+    assert session.query(Crawl).count() == 2
+    # The recorded page's 2 matches (whose dates are those of the requested pages)
+    assert session.query(Match).count() == 2
+  # The shards left the indexes to the backfill command
+  index_names = lambda: {i['name'] for i in sqlalchemy.inspect(engine).get_indexes('matches')}
+  assert index_names()
+  drop_backfill_indexes(engine)
+  assert index_names() == set()
+  rebuild_backfill_indexes(engine)
+  assert 'ix_matches_match_at' in index_names()
@@ -0,0 +1,70 @@
+import datetime
+import dbm
+import os
+import pickle
+import time
+
+import pytest
+import sqlalchemy
+
+from seeder.commands.restate import restate
+from seeder.models import Match, MatchOdds
+from seeder.pipelines import DatabasePipeline
+from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+from tests.seeder.parsers.test_match_result_parser import CASSETTE_DIR, cassette_responses
+
+DETAIL_URL = 'https://www.tennisexplorer.com/match-detail/?id={}&timezone=+0'
+
+
+@pytest.fixture
+def cache(tmp_path):
+  """
+  An HTTP cache of a /results/ page, the /match-detail/ page of a match it links to
+  (55469), and the /match-detail/ page of a match it doesn't link to (2121735).
+  """
+  [results] = cassette_responses(os.path.join(CASSETTE_DIR, 'TestMatchResultParser.test_parse_items.yaml'))
+  [detail] = cassette_responses(os.path.join(CASSETTE_DIR, 'TestMatchDetailParser.test_parse_moneyline_odds_items.yaml'))
+  responses = [results, detail.replace(url=DETAIL_URL.format(55469)), detail.replace(url=DETAIL_URL.format(2121735))]
+  path = str(tmp_path / 'tennisexplorer.db')
+  with dbm.open(path, 'c') as db:
+    for (k, response) in enumerate(responses):
+      db[f'{k}_data'] = pickle.dumps(response.to_dict(), protocol=4)
+      db[f'{k}_time'] = str(time.time())
+  return path
+
+
+def _restate(cache, engine, **kwargs):
+  spider = TennisExplorerSpider(parser_engine='lxml')
+  sink = DatabasePipeline(engine=engine, write_mode='bulk', flush_interval=None)
+  return restate(cache, spider, sink, **kwargs)
+
+
+def _odds_match_numbers(engine):
+  stmt = sqlalchemy.select(Match.match_number).join(MatchOdds, MatchOdds.match_id == Match.match_id).distinct()
+  with sqlalchemy.orm.Session(engine) as session:
+    return set(session.execute(stmt).scalars().all())
+
+
+@pytest.mark.parametrize('processes', [0, 1])
+def test_restate(cache, processes):
+  engine = sqlalchemy.create_engine('sqlite://')
+  stats = _restate(cache, engine, processes=processes)
+
+  assert stats['/results/'] == {'pages': 1, 'items': 2}
+  assert stats['/match-detail/']['pages'] == 2
+  assert 'errors' not in stats['/match-detail/']
+  assert _odds_match_numbers(engine) == {55469, 2121735}
+
+
+def test_restate_date_range(cache):
+  engine = sqlalchemy.create_engine('sqlite://')
+  day = datetime.datetime(2000, 3, 19)
+  stats = _restate(cache, engine, start_date=day, stop_date=day)
+
+  # Only the /match-detail/ pages linked from the restated /results/ pages are restated
+  assert stats['/results/']['pages'] == 1
+  assert stats['/match-detail/']['pages'] == 1
+  assert _odds_match_numbers(engine) == {55469}
+
+  later = datetime.datetime(2000, 3, 20)
+  assert _restate(cache, sqlalchemy.create_engine('sqlite://'), start_date=later, stop_date=later) == {}
@@ -1,4 +1,5 @@
 import datetime
+import os
 import requests
 
 from unittest import mock
@@ -6,9 +7,10 @@ import pytest
 
 import scrapy
 
-from seeder.items import MatchOddsItem, MatchItem
-from seeder.models import MatchSurface
-from seeder.parsers.match_detail_parser import MatchDetailParser
+from seeder.items import MatchOddsItem, MatchOddsSeriesItem, MatchItem
+from seeder.models import MatchOddsSeries, MatchSurface
+from seeder.parsers.match_detail_parser import MatchDetailParser, _parse_issued_at
+from tests.seeder.parsers.test_match_result_parser import CASSETTE_DIR, cassette_responses
 
 
 class TestMatchDetailParser:
@@ -71,6 +73,14 @@ class TestMatchDetailParser:
     key = lambda r: (r['match_number'], r['issued_by'], r['issued_at'])
     assert sorted(actual_records, key=key) == sorted(expected_records, key=key)
 
+    # The expanded odds series of each bookmaker must reproduce its ticks exactly
+    ticks = [dict(r) for r in parser._parse_moneyline_odds_items(response)]
+    series = MatchDetailParser(odds_storage='series')._parse_moneyline_odds_items(response)
+    assert all(isinstance(s, MatchOddsSeriesItem) for s in series)
+    assert len(series) == len(set(t['issued_by'] for t in ticks))
+    expanded = [t for s in series for t in MatchOddsSeries.expand(s)]
+    assert sorted(expanded, key=key) == sorted(ticks, key=key)
+
   @pytest.mark.vcr()
   def test_parse_match_items(self):
     url = "https://www.tennisexplorer.com/match-detail/?id=2121735&timezone=+0"
@@ -87,3 +97,66 @@ class TestMatchDetailParser:
     }]
     key = lambda r: r['match_number']
     assert sorted(actual_records, key=key) == sorted(expected_records, key=key)
+
+
+
+class TestMatchDetailParserEngines:
+
+  def _parse(self, response, engine, **kwargs):
+    parser = MatchDetailParser(logger=mock.MagicMock(), engine=engine, **kwargs)
+    return [dict(item) for item in parser.parse_items(response)], parser.logger
+
+  @pytest.mark.parametrize('cassette', [
+    'TestMatchDetailParser.test_parse_match_items.yaml',
+    'TestMatchDetailParser.test_parse_moneyline_odds_items.yaml',
+  ])
+  @pytest.mark.parametrize('odds_storage', MatchDetailParser.ODDS_STORAGES)
+  def test_cassette_parity(self, cassette, odds_storage):
+    for response in cassette_responses(os.path.join(CASSETTE_DIR, cassette)):
+      (expected, _) = self._parse(response, 'bs4', odds_storage=odds_storage)
+      (actual, _) = self._parse(response, 'lxml', odds_storage=odds_storage)
+      assert len(expected) > 1
+      assert actual == expected
+
+  def test_edge_case_parity(self):
+    # Unsorted & duplicated odds changes, a single closing line, and a row missing a column
+    body = b"""<html><body>
+      <div id="center"><div class="box"><span class="upper">19.06.2022</span>, 14:25, <a href="/t/">T</a>, 1R, clay</div></div>
+      <table id="oddsMenu-1-data"><tbody>
+        <tr class="one"><td class="first"><span class="t">book1</span></td>
+          <td><div class="odds-in">1.9<div class="odds-change-div"><table>
+            <tr><td colspan="3">Opening odds</td></tr>
+            <tr><td>19.06. 09:10</td><td>1.90</td><td>-0.1</td></tr>
+            <tr><td>19.06. 04:34</td><td>2.00</td><td></td></tr>
+            <tr><td>19.06. 09:10</td><td>1.85</td><td>-0.05</td></tr>
+            <tr><td>1.6. 9:10</td><td>2.10</td><td></td></tr>
+          </table></div></div></td>
+          <td><div class="odds-in">2.0<div class="odds-change-div"><table>
+            <tr><td>19.06. 08:00</td><td>1.95</td><td></td></tr>
+            <tr><td>19.06. 12:00</td><td><b>2.05</b></td><td></td></tr>
+          </table></div></div></td></tr>
+        <tr class="two"><td><span class="t">book2</span></td>
+          <td><div class="odds-in"><!-- closing -->1.50</div></td><td><div class="odds-in">2.50</div></td></tr>
+        <tr class="one"><td><span class="t">book3</span></td><td><div class="odds-in">1.50</div></td></tr>
+      </tbody></table>
+    </body></html>"""
+    url = "https://www.tennisexplorer.com/match-detail/?id=1&timezone=+0"
+    response = scrapy.http.HtmlResponse(url, body=body)
+    (expected, expected_logger) = self._parse(response, 'bs4', odds_storage='both')
+    (actual, actual_logger) = self._parse(response, 'lxml', odds_storage='both')
+    assert actual == expected
+    assert set(r.get('issued_by') for r in actual) == {'book1', 'book2', None}
+    assert expected_logger.error.call_count == actual_logger.error.call_count == 1
+
+  def test_parse_issued_at(self):
+    assert _parse_issued_at(2022, '19.06. 09:10') == datetime.datetime(2022, 6, 19, 9, 10)
+    # Falls back to strptime for timestamps in any other format
+    assert _parse_issued_at(2022, '1.6. 9:10') == datetime.datetime(2022, 6, 1, 9, 10)
+    with pytest.raises(ValueError):
+      _parse_issued_at(2022, '31.06. 09:10')
+    with pytest.raises(ValueError):
+      _parse_issued_at(2022, '19.06. 24:00')
+
+  def test_unknown_engine(self):
+    with pytest.raises(ValueError):
+      MatchDetailParser(engine='regex')
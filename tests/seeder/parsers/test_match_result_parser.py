@@ -1,11 +1,13 @@
 import os
 import datetime
+import gzip
 import requests
 
 from unittest import mock
 import pytest
 
 import scrapy
+import yaml
 
 from seeder.models import PlayerType
 from seeder.items import MatchItem
@@ -113,3 +115,82 @@ class TestMatchResultParser:
       "/match-detail/?id=55500",
     ]
     assert sorted(actual) == sorted(expected)
+
+
+CASSETTE_DIR = os.path.join(os.path.dirname(__file__), 'cassettes')
+
+
+def cassette_responses(path):
+  """
+  Return an HtmlResponse for each recorded interaction of a VCR cassette.
+  """
+  with open(path) as f:
+    cassette = yaml.safe_load(f)
+  responses = []
+  for interaction in cassette['interactions']:
+    recorded = interaction['response']
+    body = recorded['body']['string']
+    if 'gzip' in recorded['headers'].get('Content-Encoding', []):
+      body = gzip.decompress(body)
+    responses.append(scrapy.http.HtmlResponse(interaction['request']['uri'], body=body))
+  return responses
+
+
+class TestMatchResultParserEngines:
+
+  START = datetime.datetime(1990, 1, 1)
+  STOP = datetime.datetime(2030, 1, 1)
+
+  def _parse(self, response, engine):
+    parser = MatchResultParser(start_watermark=self.START, stop_watermark=self.STOP, logger=mock.MagicMock(), engine=engine)
+    return [dict(item) for item in parser.parse_items(response)], parser.logger
+
+  def _parse_links(self, response, engine):
+    return MatchResultParser(start_watermark=self.START, stop_watermark=self.STOP, engine=engine).parse_links(response)
+
+  @pytest.mark.parametrize('cassette', sorted(os.listdir(CASSETTE_DIR)))
+  def test_cassette_parity(self, cassette):
+    for response in cassette_responses(os.path.join(CASSETTE_DIR, cassette)):
+      is_results_page = '/results/' in response.url
+      if not is_results_page:
+        # Parse the tables of any other page, e.g. /match-detail/, as if it were a results page
+        response = response.replace(url="https://www.tennisexplorer.com/results/?type=all&year=2022&month=06&day=19")
+      (expected, _) = self._parse(response, 'bs4')
+      (actual, _) = self._parse(response, 'lxml')
+      assert actual == expected
+      (expected_links, actual_links) = (self._parse_links(response, engine) for engine in ('bs4', 'lxml'))
+      assert actual_links == expected_links
+      if is_results_page:
+        assert len(actual) > 0
+        assert any('/match-detail/' in link for link in actual_links)
+
+  def test_edge_case_parity(self):
+    # Rows with empty cells, a comment, a tournament without a link and (r3) a cell with a leading tag
+    body = b"""<html><body><table class="result flags">
+      <tr class="head flags"><td class="t-name"><span>ITF M15 (Futures)</span></td></tr>
+      <tr id="r1" class="one"><td class="first time">10:00</td><td class="t-name"><a href="/player/a/">A</a></td>
+        <td class="result">2</td><td class="score">6</td><td class="score"></td>
+        <td class="coursew"><!-- 1.5 --></td><td class="course">2.5</td><td><a href="/match-detail/?id=1">info</a></td></tr>
+      <tr id="r1b" class="one"><td class="t-name"><a href="/player/b/">B</a></td>
+        <td class="result">0</td><td class="score">4</td><td class="score">
+        </td></tr>
+      <tr id="r2" class="two extra"><td class="first time">12:30</td><td class="t-name"><a href="/player/c/">C</a></td>
+        <td class="result">1</td><td class="score">6</td><td><a href="/match-detail/?id=2">info</a></td></tr>
+      <tr id="r2b" class="two"><td class="t-name">D</td><td class="result">0</td><td class="score"></td></tr>
+      <tr id="r3" class="one"><td class="first time"><b>14:00</b></td><td class="t-name"><a href="/player/e/">E</a></td>
+        <td><a href="/match-detail/?id=3">info</a></td></tr>
+      <tr id="r3b" class="one"><td class="t-name"><a href="/player/f/">F</a></td></tr>
+    </table></body></html>"""
+    url = "https://www.tennisexplorer.com/results/?type=all&year=2022&month=06&day=19&timezone=+0"
+    response = scrapy.http.HtmlResponse(url, body=body)
+    (expected, expected_logger) = self._parse(response, 'bs4')
+    (actual, actual_logger) = self._parse(response, 'lxml')
+    assert actual == expected
+    assert [item['match_number'] for item in actual] == [1, 2]
+    assert actual[0]['avg_odds_p1'] == 1.5
+    assert actual[0]['score2_p1'] is None
+    assert actual_logger.error.call_count == expected_logger.error.call_count == 1
+
+  def test_unknown_engine(self):
+    with pytest.raises(ValueError):
+      MatchResultParser(start_watermark=self.START, stop_watermark=self.STOP, engine='regex')
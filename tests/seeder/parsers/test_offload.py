@@ -0,0 +1,92 @@
+import datetime
+import logging
+import os
+import time
+
+import pytest
+
+from seeder.parsers import ParsedDocument
+from seeder.parsers.match_detail_parser import MatchDetailParser
+from seeder.parsers.match_result_parser import MatchResultParser
+from seeder.parsers.offload import ParsePool, _init_worker, parse_page
+from tests.seeder.parsers.test_match_result_parser import CASSETTE_DIR, cassette_responses
+from tests.seeder.test_db import wait
+
+PARSER_SPECS = {
+  '/results/': (MatchResultParser, {
+    'start_watermark': datetime.datetime(1990, 1, 1),
+    'stop_watermark': datetime.datetime(2030, 1, 1),
+    'engine': 'lxml',
+  }),
+  '/match-detail/': (MatchDetailParser, {'engine': 'lxml', 'odds_storage': 'both'}),
+}
+
+
+@pytest.fixture
+def responses():
+  return (
+    cassette_responses(os.path.join(CASSETTE_DIR, 'TestMatchResultParser.test_parse_items.yaml'))
+    + cassette_responses(os.path.join(CASSETTE_DIR, 'TestMatchDetailParser.test_parse_moneyline_odds_items.yaml'))
+  )
+
+
+def _parse_in_process(response):
+  (parser_cls, kwargs) = PARSER_SPECS[response.url.split('tennisexplorer.com')[-1].split('?')[0]]
+  parser = parser_cls(**kwargs)
+  document = ParsedDocument(response)
+  return (list(parser.parse_items(response, document=document)), list(parser.parse_links(response, document=document)))
+
+
+def test_parse_page(responses):
+  _init_worker(PARSER_SPECS)
+  for response in responses:
+    (items, links) = parse_page(response.url, response.body, encoding=response.encoding)
+    assert (items, links) == _parse_in_process(response)
+    assert len(items) > 0
+
+    (items, links) = parse_page(response.url, response.body, encoding=response.encoding, parse_items=False)
+    assert items == []
+    assert links == _parse_in_process(response)[1]
+
+
+def test_parse_pool(responses):
+  pool = ParsePool(PARSER_SPECS, num_processes=2, max_pending=1)
+  try:
+    deferreds = [pool.submit(r.url, r.body, encoding=r.encoding) for r in responses]
+    for (response, d) in zip(responses, deferreds):
+      assert wait(d, timeout=60) == _parse_in_process(response)
+  finally:
+    pool.close()
+
+
+class ErrorParser(object):
+  """
+  A parser that logs an error for every page.
+  """
+
+  def __init__(self, logger=None):
+    self.logger = logger
+
+  def parse_items(self, response, document=None):
+    self.logger.error(f"Could not parse '{response.url}'")
+    return []
+
+  def parse_links(self, response, document=None):
+    return []
+
+
+def test_parse_pool_forwards_worker_logs(caplog):
+  url = 'https://www.tennisexplorer.com/results/?type=all&year=2022&month=06&day=19'
+  pool = ParsePool({'/results/': (ErrorParser, {})}, num_processes=1)
+  try:
+    with caplog.at_level(logging.INFO):
+      assert wait(pool.submit(url, b'<html></html>'), timeout=60) == ([], [])
+      # The record is logged in this process by the pool's listener thread
+      start = time.monotonic()
+      while not caplog.records and time.monotonic() - start < 10:
+        time.sleep(0.05)
+  finally:
+    pool.close()
+  [record] = [r for r in caplog.records if r.name == 'seeder.parsers.offload']
+  assert (record.levelno, record.getMessage()) == (logging.ERROR, f"Could not parse '{url}'")
+  assert record.processName != 'MainProcess'
@@ -0,0 +1,49 @@
+import datetime
+
+from unittest import mock
+
+import pytest
+import scrapy
+
+from seeder import parsers
+from seeder.parsers import ParsedDocument
+from seeder.parsers.match_result_parser import MatchResultParser
+
+
+BODY = b"""
+<html><body>
+  <div id="center"><div class="box"><span class="upper">19.06.2022</span>, 14:25, Round, Grass</div></div>
+  <ul><li class="dNav"><a href="/results/?type=all&year=2022&month=06&day=18">previous day</a></li></ul>
+  <table class="result"><tr><td><a href="/match-detail/?id=1">info</a></td></tr></table>
+</body></html>
+"""
+
+
+class TestParsedDocument:
+
+  def _response(self):
+    url = "https://www.tennisexplorer.com/results/?type=all&year=2022&month=06&day=19&timezone=+0"
+    return scrapy.http.HtmlResponse(url, body=BODY)
+
+  def test_trees_are_built_once(self):
+    document = ParsedDocument(self._response())
+    assert document.soup is document.soup
+    header = document.xpath('//*[@id="center"]/div[1]')
+    assert document.xpath('//*[@id="center"]/div[1]') is header
+    assert header.xpath('./span/text()').get() == '19.06.2022'
+
+  @pytest.mark.parametrize('engine', ['bs4', 'lxml'])
+  def test_parser_methods_share_the_document(self, engine):
+    response = self._response()
+    parser = MatchResultParser(
+      start_watermark=datetime.datetime(2022, 1, 1),
+      stop_watermark=datetime.datetime(2022, 12, 31),
+      engine=engine,
+    )
+    with mock.patch.object(parsers, 'BeautifulSoup', wraps=parsers.BeautifulSoup) as soup:
+      document = ParsedDocument(response)
+      parser.parse_items(response, document=document)
+      links = parser.parse_links(response, document=document)
+    # The lxml engine never builds the soup
+    assert soup.call_count == (1 if engine == 'bs4' else 0)
+    assert links == ['/results/?type=all&year=2022&month=06&day=18', '/match-detail/?id=1']
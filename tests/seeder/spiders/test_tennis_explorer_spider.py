@@ -1,11 +1,19 @@
 import datetime
+import os
 
 from unittest import mock
 import pytest
 
 import scrapy
+from twisted.internet import defer
 
+from seeder import settings
+from seeder.extensions import page_parsed
+from seeder.items import MatchItem
 from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+from seeder.util.fingerprint import UNCHANGED_META_KEY
+from tests.seeder.parsers.test_match_result_parser import CASSETTE_DIR, cassette_responses
+from tests.seeder.test_db import wait
 
 MODULE = 'seeder.spiders.tennis_explorer_spider'
 
@@ -33,3 +41,109 @@ class TestTennisExplorerSpider:
           today + datetime.timedelta(days=TennisExplorerSpider.default_stop_watermark_offset)
         ),
       })
+
+  @pytest.mark.parametrize('is_unchanged', [False, True])
+  def test_parse_skips_items_of_unchanged_pages(self, is_unchanged):
+    spider = TennisExplorerSpider()
+    item = MatchItem(match_number=1)
+    parser = mock.MagicMock()
+    parser.parse_items.return_value = [item]
+    parser.parse_links.return_value = ['/match-detail/?id=1']
+    spider.parsers['/results/'] = parser
+
+    url = "https://www.tennisexplorer.com/results/?type=all&year=2000&month=01&day=01"
+    request = scrapy.Request(url, meta={UNCHANGED_META_KEY: is_unchanged})
+    response = scrapy.http.HtmlResponse(url, body=b'', request=request)
+    output = list(spider.parse(response))
+
+    assert [o for o in output if isinstance(o, MatchItem)] == ([] if is_unchanged else [item])
+    assert [o.url for o in output if isinstance(o, scrapy.Request)] == [
+      "https://www.tennisexplorer.com/match-detail/?id=1&timezone=+0",
+    ]
+
+  def test_parse_offloaded(self):
+    kwargs = {
+      'start_watermark': datetime.datetime(1990, 1, 1),
+      'stop_watermark': datetime.datetime(2030, 1, 1),
+      'parser_engine': 'lxml',
+    }
+    [response] = cassette_responses(os.path.join(CASSETTE_DIR, 'TestMatchResultParser.test_parse_items.yaml'))
+    expected = list(TennisExplorerSpider(**kwargs).parse(response))
+
+    spider = TennisExplorerSpider(parse_processes=1, **kwargs)
+    async def _collect():
+      return [o async for o in spider.parse(response)]
+    try:
+      actual = wait(defer.ensureDeferred(_collect()), timeout=60)
+    finally:
+      spider.closed('finished')
+
+    assert [dict(o) for o in actual if isinstance(o, MatchItem)] == [dict(o) for o in expected if isinstance(o, MatchItem)]
+    assert [o.url for o in actual if isinstance(o, scrapy.Request)] == [o.url for o in expected if isinstance(o, scrapy.Request)]
+    assert len(actual) == len(expected) > 0
+
+  def test_start_requests_fanout(self):
+    spider = TennisExplorerSpider(
+      start_date=datetime.datetime(2022, 6, 3),
+      start_watermark=datetime.datetime(2022, 6, 1),
+      stop_watermark=datetime.datetime(2022, 6, 5),
+      crawl_mode='fanout',
+    )
+    requests = spider.start_requests()
+    assert not isinstance(requests, list)
+    assert [r.url for r in requests] == [
+      f"https://www.tennisexplorer.com/results/?type=all&year=2022&month=06&day={day:02d}&timezone=+0"
+      for day in (3, 4, 5, 2, 1)
+    ]
+    with pytest.raises(ValueError):
+      TennisExplorerSpider(crawl_mode='bfs')
+
+  @pytest.mark.parametrize('crawl_mode', ['walk', 'fanout'])
+  def test_parse_nav_links(self, crawl_mode):
+    spider = TennisExplorerSpider(crawl_mode=crawl_mode)
+    parser = mock.MagicMock()
+    parser.parse_items.return_value = []
+    parser.parse_links.return_value = ['/results/?type=all&year=2000&month=01&day=02', '/match-detail/?id=1']
+    spider.parsers['/results/'] = parser
+
+    url = "https://www.tennisexplorer.com/results/?type=all&year=2000&month=01&day=01"
+    response = scrapy.http.HtmlResponse(url, body=b'', request=scrapy.Request(url))
+    urls = [o.url for o in spider.parse(response)]
+    assert urls == (["https://www.tennisexplorer.com/results/?type=all&year=2000&month=01&day=02&timezone=+0"] if crawl_mode == 'walk' else []) + [
+      "https://www.tennisexplorer.com/match-detail/?id=1&timezone=+0",
+    ]
+
+  def test_download_slots(self):
+    settings = scrapy.settings.Settings({'DOWNLOAD_SLOTS': {'tennisexplorer.com/next/': {'concurrency': 1}}})
+    TennisExplorerSpider.update_settings(settings)
+    slots = settings.getdict('DOWNLOAD_SLOTS')
+    assert slots['tennisexplorer.com/match-detail/'] == TennisExplorerSpider.ENDPOINT_PARSERS['/match-detail/']['download_slot']
+    assert slots['tennisexplorer.com/next/'] == {'concurrency': 1}
+
+    spider = TennisExplorerSpider()
+    [start] = spider.start_requests()
+    assert start.meta['download_slot'] == 'tennisexplorer.com/results/'
+    request = spider.make_request("https://www.tennisexplorer.com/match-detail/?id=1")
+    assert (request.meta['download_slot'], request.priority) == ('tennisexplorer.com/match-detail/', 0)
+
+  def test_download_slots_budget(self):
+    # The endpoints' slots stay within the load of the per-domain slot they replace
+    slots = [config['download_slot'] for config in TennisExplorerSpider.ENDPOINT_PARSERS.values()]
+    assert sum(slot['concurrency'] for slot in slots) <= settings.CONCURRENT_REQUESTS_PER_DOMAIN
+    assert sum(slot['target_concurrency'] for slot in slots) <= settings.AUTOTHROTTLE_TARGET_CONCURRENCY
+    assert min(slot['delay'] for slot in slots) >= settings.AUTOTHROTTLE_START_DELAY
+
+  def test_parse_sends_page_parsed(self):
+    spider = TennisExplorerSpider()
+    spider.crawler = mock.Mock()
+    parser = mock.MagicMock()
+    parser.parse_items.return_value = [MatchItem(match_number=1)]
+    parser.parse_links.return_value = ['/match-detail/?id=1', '/match-detail/?id=2']
+    spider.parsers['/results/'] = parser
+
+    url = "https://www.tennisexplorer.com/results/?type=all&year=2000&month=01&day=01"
+    response = scrapy.http.HtmlResponse(url, body=b'', request=scrapy.Request(url))
+    assert len(list(spider.parse(response))) == 3
+    [(_, kwargs)] = spider.crawler.signals.send_catch_log.call_args_list
+    assert (kwargs['signal'], kwargs['response'], kwargs['num_items'], kwargs['num_links']) == (page_parsed, response, 1, 2)
+    assert kwargs['parse_seconds'] >= 0
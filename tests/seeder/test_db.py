@@ -0,0 +1,309 @@
+import datetime
+import threading
+import time
+
+from unittest import mock
+import pytest
+import sqlalchemy
+from scrapy.settings import Settings
+from twisted.internet import reactor
+
+from seeder.db import DatabaseMixin, KeyCache, UpsertBuffer, WriterPool, create_all, create_indexes, drop_indexes, get_engine, get_writer_pool, pool_args, secondary_indexes, upsert_dict, upsert_dicts, upsert_row
+from seeder.models import BaseModel, Match, Player, PlayerType
+
+
+@pytest.fixture
+def sessionmaker():
+  engine = sqlalchemy.create_engine('sqlite://')
+  BaseModel.metadata.create_all(engine)
+  return sqlalchemy.orm.sessionmaker(bind=engine)
+
+
+def wait(d, timeout=5.0):
+  """
+  Iterate the (unstarted) reactor until the deferred d has fired, and return its result.
+  """
+  results = []
+  d.addBoth(results.append)
+  start = time.monotonic()
+  while not results and (time.monotonic() - start) < timeout:
+    reactor.iterate(0.01)
+  assert results, f"Deferred {d} did not fire within {timeout} seconds"
+  return results[0]
+
+
+def _rows(sessionmaker, model):
+  with sessionmaker() as session:
+    return {
+      r.to_partial_dict()[model.__table__.primary_key.columns[0].name]: r.to_partial_dict()
+      for r in session.query(model).all()
+    }
+
+
+class TestGetEngine:
+
+  def test_engine_is_cached_per_conn_str(self, tmp_path):
+    conn_str = f"sqlite:///{tmp_path / 'a.db'}"
+    engine = get_engine(conn_str)
+    assert get_engine(conn_str) is engine
+    assert get_engine(f"sqlite:///{tmp_path / 'b.db'}") is not engine
+    assert get_engine(conn_str, echo=True) is not engine
+
+  def test_default_engine_is_lazy(self, monkeypatch, tmp_path):
+    conn_str = f"sqlite:///{tmp_path / 'seeder.db'}"
+    monkeypatch.setenv('SEEDER_DB_CONN_STR', conn_str)
+    mixin = DatabaseMixin()
+    assert mixin._engine is None
+    assert mixin.engine is get_engine(conn_str)
+
+  def test_pool_args(self):
+    settings = Settings({'SEEDER_DB_POOL_SIZE': 8, 'SEEDER_DB_POOL_PRE_PING': False})
+    assert pool_args('sqlite:///seeder.db', settings) == {}
+    args = pool_args('postgresql://user@host/db', settings)
+    assert args['pool_size'] == 8
+    assert args['pool_pre_ping'] is False
+    assert args['max_overflow'] == 10
+
+  def test_sessions_are_thread_local(self, tmp_path):
+    mixin = DatabaseMixin(engine=sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'seeder.db'}"))
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(mixin.sessionmaker()))
+    thread.start()
+    thread.join()
+    assert mixin.sessionmaker() is mixin.sessionmaker()
+    assert sessions[0] is not mixin.sessionmaker()
+
+  def test_create_all_once_per_engine(self, monkeypatch):
+    engine = sqlalchemy.create_engine('sqlite://')
+    calls = []
+    monkeypatch.setattr(BaseModel.metadata, 'create_all', lambda bind: calls.append(bind))
+    assert create_all(engine, BaseModel)
+    assert not create_all(engine, BaseModel)
+    assert create_all(sqlalchemy.create_engine('sqlite://'), BaseModel)
+    assert len(calls) == 2
+
+
+class TestUpsertDict:
+
+  @pytest.mark.parametrize('exists', [None, True, False])
+  def test_upsert_with_known_existence(self, sessionmaker, exists):
+    match_id = Match.surrogate_key(1)
+    upsert_dict(sessionmaker, Match, {'match_id': match_id, 'match_number': 1})
+    # The upsert must succeed even when the existence assumption is wrong
+    assert upsert_dict(sessionmaker, Match, {'match_id': match_id, 'tournament': '/a/'}, exists=exists)
+    assert upsert_dict(sessionmaker, Match, {'match_id': Match.surrogate_key(2), 'match_number': 2}, exists=exists)
+
+    rows = _rows(sessionmaker, Match)
+    assert rows[match_id]['match_number'] == 1
+    assert rows[match_id]['tournament'] == '/a/'
+    assert rows[Match.surrogate_key(2)]['match_number'] == 2
+
+
+class TestUpsertRow:
+
+  @pytest.mark.parametrize('exists', [None, True, False])
+  def test_upsert_row(self, sessionmaker, exists):
+    match_id = Match.surrogate_key(1)
+    assert upsert_row(sessionmaker, Match, Match.make_row(match_number=1, tournament='/a/'))
+    assert upsert_row(sessionmaker, Match, {'match_id': match_id, 'match_round': 'F'}, exists=exists)
+    assert upsert_row(sessionmaker, Match, Match.make_row(match_number=2), exists=exists)
+
+    rows = _rows(sessionmaker, Match)
+    assert rows[match_id]['tournament'] == '/a/'
+    assert rows[match_id]['match_round'] == 'F'
+    assert rows[match_id]['created_at'] is not None
+    assert rows[Match.surrogate_key(2)]['match_number'] == 2
+
+  def test_missing_primary_key(self, sessionmaker):
+    with pytest.raises(ValueError):
+      upsert_row(sessionmaker, Match, {'match_number': 1})
+
+
+class TestUpsertDicts:
+
+  def test_insert_and_partial_update(self, sessionmaker):
+    records = [r.to_partial_dict() for r in Player.make_with_dependencies(slug='/doubles-team/a/b/')]
+    assert upsert_dicts(sessionmaker, Player, records)
+
+    rows = _rows(sessionmaker, Player)
+    assert len(rows) == 3
+    team = rows[Player.surrogate_key('/doubles-team/a/b/')]
+    assert team['p1'] == Player.surrogate_key('/player/a/')
+    assert team['created_at'] is not None
+
+    # Only the provided keys are updated on existing rows
+    upsert_dicts(sessionmaker, Player, [{
+      'player_id': Player.surrogate_key('/player/a/'),
+      'name': 'A',
+    }])
+    player = _rows(sessionmaker, Player)[Player.surrogate_key('/player/a/')]
+    assert player['name'] == 'A'
+    assert player['slug'] == '/player/a/'
+    assert player['player_type'] == PlayerType.single
+
+  def test_merges_records_with_the_same_primary_key(self, sessionmaker):
+    match_id = Match.surrogate_key(1)
+    upsert_dicts(sessionmaker, Match, [
+      {'match_id': match_id, 'match_number': 1, 'tournament': '/a/'},
+      {'match_id': match_id, 'match_round': 'Final'},
+    ])
+    assert _rows(sessionmaker, Match)[match_id]['tournament'] == '/a/'
+    assert _rows(sessionmaker, Match)[match_id]['match_round'] == 'Final'
+
+  def test_missing_primary_key_raises(self, sessionmaker):
+    with pytest.raises(ValueError):
+      upsert_dicts(sessionmaker, Match, [{'match_number': 1}])
+
+
+class TestUpsertBuffer:
+
+  def test_flush_on_size(self, sessionmaker):
+    buffer = UpsertBuffer(sessionmaker, flush_size=2, flush_interval=None)
+    buffer.add(Match, {'match_id': Match.surrogate_key(1), 'match_number': 1})
+    buffer.add(Match, {'match_id': Match.surrogate_key(1), 'tournament': '/a/'})
+    assert len(buffer) == 1
+    assert len(_rows(sessionmaker, Match)) == 0
+
+    buffer.add(Match, {'match_id': Match.surrogate_key(2), 'match_number': 2})
+    assert len(buffer) == 0
+    assert len(_rows(sessionmaker, Match)) == 2
+
+  def test_flush_falls_back_to_individual_records(self, sessionmaker):
+    buffer = UpsertBuffer(sessionmaker, flush_size=10, flush_interval=None)
+    buffer.add(Match, {'match_id': Match.surrogate_key(1), 'match_number': 1})
+    buffer.add(Match, {'match_id': Match.surrogate_key(2), 'match_number': 'not-a-number', 'match_at': 'not-a-date'})
+    assert buffer.flush() == 1
+    assert list(_rows(sessionmaker, Match).keys()) == [Match.surrogate_key(1)]
+
+  def test_add_after(self, sessionmaker):
+    buffer = UpsertBuffer(sessionmaker, flush_size=None, flush_interval=None)
+    buffer.add(Match, {'match_id': Match.surrogate_key(1), 'match_number': 1})
+    buffer.add_after(Player, {'player_id': Player.surrogate_key('/player/a/'), 'player_type': PlayerType.single})
+    assert buffer.flush() == 2
+    assert len(_rows(sessionmaker, Player)) == 1
+    # Once any record failed, the records to add after them are discarded
+    buffer.add(Match, {'match_id': Match.surrogate_key(2), 'match_number': 2, 'match_at': 'not-a-date'})
+    buffer.add_after(Player, {'player_id': Player.surrogate_key('/player/b/'), 'player_type': PlayerType.single})
+    assert buffer.flush() == 0
+    buffer.add(Match, {'match_id': Match.surrogate_key(3), 'match_number': 3})
+    buffer.add_after(Player, {'player_id': Player.surrogate_key('/player/c/'), 'player_type': PlayerType.single})
+    assert buffer.flush() == 1
+    assert len(_rows(sessionmaker, Player)) == 1
+
+  def test_on_upsert(self, sessionmaker):
+    upserts = []
+    buffer = UpsertBuffer(sessionmaker, flush_size=None, flush_interval=None, on_upsert=lambda *args: upserts.append(args))
+    buffer.add(Player, {'player_id': Player.surrogate_key('/player/a/'), 'player_type': PlayerType.single})
+    buffer.add(Match, {'match_id': Match.surrogate_key(1), 'match_number': 1})
+    buffer.add(Match, {'match_id': Match.surrogate_key(2), 'match_number': 2})
+    buffer.flush()
+    assert [(model, num_rows) for (model, num_rows, _) in upserts] == [(Player, 1), (Match, 2)]
+    assert all(seconds >= 0 for (_, _, seconds) in upserts)
+
+
+class TestKeyCache:
+
+  def _record(self, n):
+    return {'match_id': Match.surrogate_key(n), 'match_number': n}
+
+  def test_preload(self, sessionmaker):
+    upsert_dicts(sessionmaker, Match, [self._record(n) for n in range(3)])
+    cache = KeyCache([Match, Player], max_size=3)
+    cache.preload(sessionmaker)
+    assert len(cache) == 3
+    assert cache.exists(Match, self._record(0)) is True
+    assert cache.exists(Match, self._record(3)) is False
+    assert cache.exists(Player, {'player_id': Player.surrogate_key('/player/a/')}) is False
+
+    cache = KeyCache([Match], max_size=2)
+    cache.preload(sessionmaker)
+    assert len(cache) == 2
+    assert cache.exists(Match, self._record(3)) is None
+
+  def test_add_evicts_least_recently_used(self):
+    cache = KeyCache([Match], max_size=2)
+    cache.is_complete[Match] = True
+    cache.add(Match, self._record(1))
+    cache.add(Match, self._record(2))
+    assert cache.contains(Match, self._record(1))
+    cache.add(Match, self._record(3))
+    assert cache.contains(Match, self._record(1))
+    assert not cache.contains(Match, self._record(2))
+    assert cache.exists(Match, self._record(2)) is None
+
+  def test_untracked_model(self):
+    cache = KeyCache([Match])
+    cache.add(Player, {'player_id': Player.surrogate_key('/player/a/')})
+    assert not cache.contains(Player, {'player_id': Player.surrogate_key('/player/a/')})
+
+
+class TestWriterPool:
+
+  def test_submit_runs_on_worker_threads(self):
+    pool = WriterPool(num_threads=2, max_pending=1)
+    deferreds = [pool.submit(lambda: threading.current_thread().name) for _ in range(3)]
+    assert len(pool.pending) == 3
+    wait(pool.close())
+    assert not pool.pending
+    assert not pool.is_started
+    for d in deferreds:
+      assert wait(d).startswith('PoolThread-seeder-db-writer')
+
+  def test_close_waits_for_chained_writes(self):
+    pool = WriterPool(num_threads=1)
+    results = []
+    d = pool.submit(results.append, 1)
+    d.addCallback(lambda _: pool.submit(results.append, 2))
+    wait(pool.close())
+    assert results == [1, 2]
+
+  def test_submit_waits_for_a_slot_once_max_pending(self):
+    pool = WriterPool(num_threads=2, max_pending=1)
+    release = threading.Event()
+    ran = threading.Event()
+    pool.submit(release.wait)
+    # The 2nd write returns at once, but isn't run (though a thread is idle) until the 1st finished
+    start = time.monotonic()
+    d = pool.submit(lambda: ran.set() or 2)
+    assert time.monotonic() - start < 0.1
+    assert not ran.wait(0.2)
+    assert not d.called
+    release.set()
+    assert wait(d) == 2
+    wait(pool.close())
+
+  def test_writer_pool_is_shared_per_engine(self, tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'seeder.db'}")
+    pool = get_writer_pool(engine, num_threads=4)
+    assert get_writer_pool(engine, num_threads=4) is pool
+    # A single writer for sqlite
+    assert pool.threadpool.max == 1
+    assert wait(pool.submit(lambda: 1)) == 1
+    # The threads are stopped once both users closed the pool, after which a new pool is created
+    wait(pool.close())
+    assert pool.is_started
+    wait(pool.close())
+    assert not pool.is_started
+    new_pool = get_writer_pool(engine)
+    assert new_pool is not pool
+    wait(new_pool.close())
+
+
+def test_create_and_drop_indexes_tolerate_concurrent_changes(tmp_path):
+  engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'seeder.db'}")
+  BaseModel.metadata.create_all(engine)
+  indexes = secondary_indexes([Match])
+  assert {index.table.name for index in indexes} == {'matches'}
+
+  def _after_concurrent(method):
+    # Another process runs the same statement between the existence check and this one's
+    def _method(index, bind, checkfirst=False):
+      method(index, bind, checkfirst=checkfirst)
+      method(index, bind, checkfirst=False)
+    return _method
+
+  with mock.patch.object(sqlalchemy.Index, 'drop', _after_concurrent(sqlalchemy.Index.drop)):
+    assert drop_indexes(engine, indexes) == indexes
+  with mock.patch.object(sqlalchemy.Index, 'create', _after_concurrent(sqlalchemy.Index.create)):
+    create_indexes(engine, indexes)
+  assert {i['name'] for i in sqlalchemy.inspect(engine).get_indexes('matches')} == {index.name for index in indexes}
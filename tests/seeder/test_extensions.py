@@ -0,0 +1,106 @@
+from unittest import mock
+
+import pytest
+import scrapy
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.settings import Settings
+from scrapy.signalmanager import SignalManager
+from scrapy.statscollectors import MemoryStatsCollector
+
+from seeder.extensions import CrawlMetrics, EndpointThrottle, page_parsed, rows_upserted
+from seeder.models import Match
+from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+
+SLOTS = {
+  'tennisexplorer.com/results/': {'concurrency': 4, 'target_concurrency': 1.0},
+  'tennisexplorer.com/match-detail/': {'concurrency': 8, 'target_concurrency': 4.0, 'min_delay': 0.1, 'max_delay': 0.5},
+}
+
+
+@pytest.fixture
+def throttle():
+  settings = Settings({'AUTOTHROTTLE_ENABLED': True, 'AUTOTHROTTLE_MAX_DELAY': 10.0, 'DOWNLOAD_SLOTS': SLOTS})
+  crawler = mock.Mock(settings=settings, signals=SignalManager())
+  throttle = EndpointThrottle(crawler)
+  throttle._spider_opened(mock.Mock())
+  return throttle
+
+
+def _adjust(throttle, slot_key, delay, latency, status=200):
+  slot = mock.Mock(delay=delay)
+  request = scrapy.Request('https://www.tennisexplorer.com/', meta={'download_slot': slot_key})
+  throttle._adjust_delay(slot, latency, scrapy.http.HtmlResponse(request.url, status=status, request=request))
+  return slot.delay
+
+
+def test_endpoint_throttle(throttle):
+  # Each slot targets its own concurrency
+  assert _adjust(throttle, 'tennisexplorer.com/results/', delay=0.0, latency=1.0) == 1.0
+  assert _adjust(throttle, 'tennisexplorer.com/match-detail/', delay=0.0, latency=1.0) == 0.25
+  # ...within its own delay bounds
+  assert _adjust(throttle, 'tennisexplorer.com/match-detail/', delay=0.0, latency=0.1) == 0.1
+  assert _adjust(throttle, 'tennisexplorer.com/match-detail/', delay=0.0, latency=8.0) == 0.5
+  # Other slots use the AUTOTHROTTLE_ settings
+  assert _adjust(throttle, 'example.com', delay=0.0, latency=4.0) == 4.0 / throttle.target_concurrency
+  # Error pages only increase the delay
+  assert _adjust(throttle, 'tennisexplorer.com/results/', delay=2.0, latency=0.1, status=500) == 2.0
+
+
+def test_endpoint_throttle_hooks(throttle):
+  # The EndpointThrottle overrides private hooks of scrapy's AutoThrottle: check that its
+  # response_downloaded handler (as of scrapy 2.19) still adjusts the delay through them
+  slot = mock.Mock(delay=0.0, transferring=[])
+  throttle.crawler.engine.downloader.slots = {'tennisexplorer.com/match-detail/': slot}
+  request = scrapy.Request('https://www.tennisexplorer.com/', meta={'download_slot': 'tennisexplorer.com/match-detail/', 'download_latency': 1.0})
+  throttle._response_downloaded(scrapy.http.HtmlResponse(request.url, request=request), request, mock.Mock())
+  assert slot.delay == 0.25
+  assert (throttle.mindelay, throttle.maxdelay) == (0.0, 10.0)
+
+
+def _metrics_crawler(**settings):
+  crawler = mock.Mock(settings=Settings({'SEEDER_METRICS_ENABLED': True, 'SEEDER_METRICS_INTERVAL': 0, **settings}))
+  crawler.signals = SignalManager()
+  crawler.stats = MemoryStatsCollector(crawler)
+  return crawler
+
+
+def _response(path, flags=None, latency=None):
+  request = scrapy.Request(f'https://www.tennisexplorer.com{path}', meta={'download_latency': latency})
+  return scrapy.http.HtmlResponse(request.url, request=request, flags=flags)
+
+
+def test_crawl_metrics(tmp_path):
+  textfile = str(tmp_path / 'seeder.prom')
+  crawler = _metrics_crawler(HTTPCACHE_ENABLED=True, SEEDER_METRICS_TEXTFILE=textfile)
+  extension = CrawlMetrics.from_crawler(crawler)
+  spider = TennisExplorerSpider()
+  crawler.signals.send_catch_log(signal=signals.spider_opened, spider=spider)
+
+  for (path, flags, latency) in [('/results/', None, 0.2), ('/results/', ['cached'], None), ('/player/a/', None, 0.3)]:
+    response = _response(path, flags=flags, latency=latency)
+    crawler.signals.send_catch_log(signal=signals.response_received, response=response, request=response.request, spider=spider)
+  crawler.signals.send_catch_log(signal=page_parsed, response=_response('/results/'), parse_seconds=0.02, num_items=3, num_links=40)
+  crawler.signals.send_catch_log(signal=rows_upserted, model=Match, num_rows=5, seconds=0.01)
+  crawler.signals.send_catch_log(signal=signals.spider_closed, spider=spider, reason='finished')
+
+  stats = crawler.stats.get_stats()
+  assert extension.loop is None
+  assert stats['seeder/metrics/download_latency_seconds/results']['count'] == 1
+  assert stats['seeder/metrics/download_latency_seconds/other']['count'] == 1
+  assert stats['seeder/metrics/httpcache_requests_total/results/hit'] == 1
+  assert stats['seeder/metrics/httpcache_requests_total/results/miss'] == 1
+  assert stats['seeder/metrics/parse_seconds/results']['sum'] == 0.02
+  assert stats['seeder/metrics/page_items/results']['mean'] == 3
+  assert stats['seeder/metrics/page_links/results']['count'] == 1
+  assert stats['seeder/metrics/db_upsert_seconds/Match']['count'] == 1
+  assert stats['seeder/metrics/db_rows_total/Match'] == 5
+  with open(textfile) as f:
+    text = f.read()
+  assert 'seeder_httpcache_requests_total{spider="tennisexplorer",endpoint="results",result="miss"} 1' in text
+  assert 'seeder_db_rows_total{spider="tennisexplorer",model="Match"} 5' in text
+
+
+def test_crawl_metrics_not_configured():
+  with pytest.raises(NotConfigured):
+    CrawlMetrics.from_crawler(_metrics_crawler(SEEDER_METRICS_ENABLED=False))
@@ -0,0 +1,187 @@
+import threading
+import uuid
+
+from unittest import mock
+import pytest
+import scrapy
+import sqlalchemy
+from scrapy.settings import Settings
+from scrapy.signalmanager import SignalManager
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.request import RequestFingerprinter
+from twisted.python.failure import Failure
+
+from seeder.frontier import FRONTIER_META_KEY, Frontier, FrontierScheduler
+from seeder.middlewares import FrontierMiddleware
+from seeder.models import BaseModel, FrontierRequest, FrontierStatus
+from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+
+RESULTS_URL = 'https://www.tennisexplorer.com/results/?type=all&year=2022&month=06&day={}&timezone=+0'
+DETAIL_URL = 'https://www.tennisexplorer.com/match-detail/?id={}&timezone=+0'
+
+
+@pytest.fixture
+def engine(tmp_path):
+  engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'seeder.db'}")
+  BaseModel.metadata.create_all(engine)
+  return engine
+
+
+def _row(url, priority=0, queue='q'):
+  return FrontierRequest.make_row(queue=queue, fingerprint=url[-40:], url=url, priority=priority, payload=url.encode())
+
+
+def _status(engine):
+  with sqlalchemy.orm.Session(engine) as session:
+    return {r.url: (r.status, r.attempts) for r in session.query(FrontierRequest).all()}
+
+
+class TestFrontier:
+
+  def test_push_deduplicates(self, engine):
+    frontier = Frontier('q', engine=engine)
+    assert frontier.push([_row(DETAIL_URL.format(1)), _row(DETAIL_URL.format(2))]) == 2
+    assert frontier.push([_row(DETAIL_URL.format(2)), _row(DETAIL_URL.format(3))]) == 1
+    # Queues are independent
+    assert frontier.push([_row(DETAIL_URL.format(1), queue='r')]) == 1
+    assert frontier.counts() == {'pending': 3}
+
+  def test_claim(self, engine):
+    frontier = Frontier('q', engine=engine)
+    frontier.push([_row(DETAIL_URL.format(k)) for k in range(3)] + [_row(RESULTS_URL.format(1), priority=1)])
+    (a, b) = (uuid.uuid4(), uuid.uuid4())
+    claimed_a = frontier.claim(a, 2)
+    claimed_b = frontier.claim(b, 10)
+    assert [payload for (_, payload) in claimed_a][0] == RESULTS_URL.format(1).encode()
+    assert (len(claimed_a), len(claimed_b)) == (2, 2)
+    assert not {f for (f, _) in claimed_a} & {f for (f, _) in claimed_b}
+    assert frontier.claim(a, 10) == []
+
+    # Each owner sees the requests held by the other as pending, but not its own
+    assert frontier.has_pending(a)
+    assert frontier.complete(b, [f for (f, _) in claimed_b]) == 2
+    assert not frontier.has_pending(a)
+    assert frontier.has_pending(b)
+    assert frontier.release(a) == 2
+    assert frontier.counts() == {'pending': 2, 'done': 2}
+
+  def test_expired_leases_are_reclaimed(self, engine):
+    frontier = Frontier('q', engine=engine, lease_secs=0, max_attempts=2)
+    frontier.push([_row(DETAIL_URL.format(1))])
+    (a, b) = (uuid.uuid4(), uuid.uuid4())
+    assert len(frontier.claim(a, 1)) == 1
+    # The lease of a expired, so b claims the request (for its last attempt)
+    assert len(frontier.claim(b, 1)) == 1
+    assert frontier.complete(a, [DETAIL_URL.format(1)[-40:]]) == 0
+    assert frontier.claim(a, 1) == []
+    assert _status(engine) == {DETAIL_URL.format(1): (FrontierStatus.leased, 2)}
+
+  def test_concurrent_claims(self, engine):
+    frontier = Frontier('q', engine=engine)
+    frontier.push([_row(DETAIL_URL.format(k)) for k in range(200)])
+    claims = {}
+
+    def _work(owner):
+      worker = Frontier('q', engine=sqlalchemy.create_engine(engine.url))
+      claims[owner] = []
+      while True:
+        rows = worker.claim(owner, 7)
+        if not rows:
+          return
+        claims[owner] += [f for (f, _) in rows]
+
+    threads = [threading.Thread(target=_work, args=(uuid.uuid4(),)) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    claimed = [f for fingerprints in claims.values() for f in fingerprints]
+    assert len(claimed) == len(set(claimed)) == 200
+
+
+def _crawler(**settings):
+  crawler = mock.Mock(spidercls=TennisExplorerSpider, settings=Settings(settings))
+  crawler.signals = SignalManager()
+  crawler.stats = MemoryStatsCollector(crawler)
+  crawler.request_fingerprinter = RequestFingerprinter()
+  return crawler
+
+
+class TestFrontierScheduler:
+
+  def _scheduler(self, engine, spider):
+    crawler = _crawler(SCHEDULER='seeder.frontier.FrontierScheduler')
+    scheduler = FrontierScheduler(crawler, Frontier('q', engine=engine), batch_size=2, flush_size=100)
+    scheduler.open(spider)
+    return (crawler, scheduler)
+
+  def test_crawl(self, engine):
+    spider = TennisExplorerSpider()
+    (crawler, scheduler) = self._scheduler(engine, spider)
+    middleware = FrontierMiddleware.from_crawler(crawler)
+    for url in (DETAIL_URL.format(1), RESULTS_URL.format(1), DETAIL_URL.format(1)):
+      assert scheduler.enqueue_request(scrapy.Request(url, spider.parse, priority=int('results' in url)))
+    assert len(scheduler) == 2
+
+    request = scheduler.next_request()
+    assert request.url == RESULTS_URL.format(1)
+    assert request.callback == spider.parse
+    # A retry of the request stays with this worker
+    assert scheduler.enqueue_request(request.replace(dont_filter=True))
+    assert scheduler.next_request().url == RESULTS_URL.format(1)
+
+    # The links of a page are pushed before the page is done
+    response = scrapy.http.HtmlResponse(request.url, body=b'', request=request)
+    output = middleware.process_spider_output(response, [scrapy.Request(DETAIL_URL.format(2), spider.parse)], spider)
+    for link in output:
+      scheduler.enqueue_request(link)
+    assert scheduler.completions and scheduler.pushes
+    scheduler.flush()
+    status = _status(engine)
+    assert status[RESULTS_URL.format(1)] == (FrontierStatus.done, 1)
+    assert status[DETAIL_URL.format(2)] == (FrontierStatus.pending, 0)
+    assert scheduler.has_pending_requests()
+
+    detail = scheduler.next_request()
+    assert detail.meta[FRONTIER_META_KEY]
+    assert scheduler.next_request().url == DETAIL_URL.format(2)
+    assert scheduler.next_request() is None
+    scheduler.close('finished')
+    assert _status(engine)[DETAIL_URL.format(1)] == (FrontierStatus.pending, 1)
+    assert crawler.stats.get_value('frontier/duplicate') == 1
+
+  def test_failed_downloads_are_released(self, engine):
+    spider = TennisExplorerSpider()
+    (crawler, scheduler) = self._scheduler(engine, spider)
+    scheduler.frontier.max_attempts = 2
+    assert scheduler.enqueue_request(scrapy.Request(DETAIL_URL.format(1), spider.parse))
+    for attempt in (1, 2):
+      request = scheduler.next_request()
+      assert request.errback == scheduler.download_failed
+      # The errback passes the failure on to scrapy, which logs it
+      failure = Failure(scrapy.exceptions.IgnoreRequest())
+      failure.request = request
+      assert request.errback(failure) is failure
+      scheduler.flush()
+      assert _status(engine)[DETAIL_URL.format(1)] == (FrontierStatus.pending, attempt)
+    # ...until its attempts are exhausted
+    assert scheduler.next_request() is None
+    assert not scheduler.has_pending_requests()
+    assert crawler.stats.get_value('frontier/failed') == 2
+
+    # A redirect of a claimed request is pushed without the errback, and completes the claimed request
+    scheduler.frontier.max_attempts = 3
+    scheduler.last_empty_claim = None
+    request = scheduler.next_request()
+    assert scheduler.enqueue_request(request.replace(url=DETAIL_URL.format(2)))
+    scheduler.flush()
+    assert _status(engine)[DETAIL_URL.format(1)] == (FrontierStatus.done, 3)
+    redirect = scheduler.next_request()
+    assert redirect.url == DETAIL_URL.format(2)
+    assert redirect.errback == scheduler.download_failed
+    assert redirect.meta[FRONTIER_META_KEY] != request.meta[FRONTIER_META_KEY]
+    scheduler.close('finished')
+
+  def test_middleware_not_configured(self):
+    with pytest.raises(scrapy.exceptions.NotConfigured):
+      FrontierMiddleware.from_crawler(_crawler())
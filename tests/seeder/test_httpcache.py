@@ -0,0 +1,208 @@
+import datetime
+import dbm
+import pickle
+import time
+
+from unittest import mock
+
+import scrapy
+from scrapy.settings import Settings
+from scrapy.utils.request import RequestFingerprinter
+
+from seeder.httpcache import SegmentCache, SegmentCacheStorage, SettledPolicy, iter_cached_responses
+
+
+def _timestamp(dt):
+  return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def test_iter_cached_responses(tmp_path):
+  path = str(tmp_path / 'tennisexplorer.db')
+  url = 'https://www.tennisexplorer.com/match-detail/?id=1'
+  stored_at = time.time()
+  # As written by scrapy's DbmCacheStorage
+  with dbm.open(path, 'c') as db:
+    response = scrapy.http.HtmlResponse(url, body=b'<html><body>1</body></html>')
+    db['ab12_data'] = pickle.dumps(response.to_dict(), protocol=4)
+    db['ab12_time'] = str(stored_at)
+
+  [(cached_at, cached)] = list(iter_cached_responses(path))
+  assert cached_at == stored_at
+  assert isinstance(cached, scrapy.http.HtmlResponse)
+  assert (cached.url, cached.body) == (url, b'<html><body>1</body></html>')
+
+
+class TestSettledPolicy:
+
+  NOW = datetime.datetime(2022, 6, 20, 12)
+  DETAIL_BODY = b'<div class="box boxBasic lGray"><span class="upper">19.06.2022</span>, 14:25</div>'
+
+  def _policy(self, **settings):
+    return SettledPolicy(Settings({'SEEDER_HTTPCACHE_SETTLE_DAYS': 2, **settings}))
+
+  def _is_fresh(self, policy, url, cached_at, body=b'<html></html>', now=NOW):
+    request = scrapy.Request(url, meta={'cache_timestamp': _timestamp(cached_at) if cached_at else None})
+    cached = scrapy.http.HtmlResponse(url, body=body)
+    with mock.patch('seeder.httpcache.time.time', return_value=_timestamp(now)):
+      return policy.is_cached_response_fresh(cached, request)
+
+  def test_results_pages(self):
+    policy = self._policy()
+    url = 'https://www.tennisexplorer.com/results/?type=all&year=2022&month=06&day={}'
+    # Settled 2 days after the end of the page's date, i.e. from 2022-06-16 for 2022-06-13
+    assert self._is_fresh(policy, url.format(13), cached_at=datetime.datetime(2022, 6, 16, 1))
+    assert not self._is_fresh(policy, url.format(13), cached_at=datetime.datetime(2022, 6, 15, 23))
+    assert not self._is_fresh(policy, url.format(20), cached_at=datetime.datetime(2022, 6, 20, 11))
+    assert not self._is_fresh(policy, url.format(13), cached_at=None)
+
+  def test_match_detail_pages(self):
+    policy = self._policy()
+    url = 'https://www.tennisexplorer.com/match-detail/?id=1'
+    now = datetime.datetime(2022, 6, 25)
+    assert self._is_fresh(policy, url, cached_at=datetime.datetime(2022, 6, 22), body=self.DETAIL_BODY, now=now)
+    assert not self._is_fresh(policy, url, cached_at=datetime.datetime(2022, 6, 20), body=self.DETAIL_BODY, now=now)
+    assert not self._is_fresh(policy, url, cached_at=datetime.datetime(2022, 6, 22), body=b'<span class="upper">today</span>', now=now)
+
+  def test_ttls(self):
+    policy = self._policy(SEEDER_HTTPCACHE_TTLS={'/next/': 3600, '/results/': 0})
+    assert self._is_fresh(policy, 'https://www.tennisexplorer.com/next/', cached_at=datetime.datetime(2022, 6, 20, 11, 30))
+    assert not self._is_fresh(policy, 'https://www.tennisexplorer.com/next/', cached_at=datetime.datetime(2022, 6, 20, 10, 30))
+    # Endpoints without a ttl are always fresh
+    assert self._is_fresh(policy, 'https://www.tennisexplorer.com/robots.txt', cached_at=None)
+    assert self._is_fresh(policy, 'https://www.tennisexplorer.com/match-detail/?id=1', cached_at=None)
+
+  def test_server_errors(self):
+    policy = self._policy()
+    url = 'https://www.tennisexplorer.com/results/'
+    request = scrapy.Request(url)
+    (cached, ok, error) = (scrapy.http.HtmlResponse(url, status=status) for status in (200, 200, 503))
+    assert not policy.is_cached_response_valid(cached, ok, request)
+    assert policy.is_cached_response_valid(cached, error, request)
+    assert policy.should_cache_response(ok, request)
+    assert not policy.should_cache_response(error, request)
+
+
+def _response_dict(url, body=b'<html></html>'):
+  return scrapy.http.HtmlResponse(url, body=body).to_dict()
+
+
+class TestSegmentCache:
+
+  RESULTS_URL = 'https://www.tennisexplorer.com/results/?type=all&year=2022&month=06&day={}'
+  DETAIL_URL = 'https://www.tennisexplorer.com/match-detail/?id={}'
+
+  def test_put_get(self, tmp_path):
+    for compress in (True, False):
+      cache = SegmentCache(tmp_path / str(compress), compress=compress)
+      cache.put('ab12', _response_dict(self.DETAIL_URL.format(1), b'<html>1</html>'), cached_at=100.0)
+      (cached_at, data) = cache.get('ab12')
+      assert cached_at == 100.0
+      assert (data['url'], data['body']) == (self.DETAIL_URL.format(1), b'<html>1</html>')
+      assert cache.get('cd34') is None
+      cache.close()
+
+  def test_concurrent_reader(self, tmp_path):
+    writer = SegmentCache(tmp_path)
+    writer.put('1', _response_dict(self.DETAIL_URL.format(1), b'1'))
+    reader = SegmentCache(tmp_path, readonly=True)
+    assert reader.get('1')[1]['body'] == b'1'
+    # Records appended to a segment the reader has already mapped
+    writer.put('2', _response_dict(self.DETAIL_URL.format(2), b'2'))
+    writer.put('1', _response_dict(self.DETAIL_URL.format(1), b'1 again'))
+    assert reader.get('2')[1]['body'] == b'2'
+    assert reader.get('1')[1]['body'] == b'1 again'
+    reader.close()
+    writer.close()
+
+  def test_segment_rotation(self, tmp_path):
+    cache = SegmentCache(tmp_path, compress=False, segment_bytes=1024)
+    for i in range(10):
+      cache.put(str(i), _response_dict(self.DETAIL_URL.format(i), b'x' * 500))
+    cache.close()
+    assert len(list(tmp_path.glob('*.seg'))) == 10
+    cache = SegmentCache(tmp_path, readonly=True)
+    assert [r.url for (_, r) in cache.iter_responses()] == [self.DETAIL_URL.format(i) for i in range(10)]
+    cache.close()
+
+  def test_iter_responses(self, tmp_path):
+    cache = SegmentCache(tmp_path)
+    for day in (12, 13, 14):
+      cache.put(f'r{day}', _response_dict(self.RESULTS_URL.format(day)))
+    cache.put('d1', _response_dict(self.DETAIL_URL.format(1)))
+
+    responses = cache.iter_responses(
+      endpoint='/results/',
+      start_date=datetime.datetime(2022, 6, 13),
+      stop_date=datetime.datetime(2022, 6, 14),
+    )
+    assert sorted(r.url for (_, r) in responses) == [self.RESULTS_URL.format(13), self.RESULTS_URL.format(14)]
+    responses = cache.iter_responses(url_filter=lambda url: 'match-detail' in url)
+    assert [r.url for (_, r) in responses] == [self.DETAIL_URL.format(1)]
+    cache.close()
+    assert len(list(iter_cached_responses(str(tmp_path)))) == 4
+
+  def test_compact(self, tmp_path):
+    # Two records per segment
+    cache = SegmentCache(tmp_path, compress=False, segment_bytes=2048)
+    for i in range(4):
+      cache.put(str(i), _response_dict(self.DETAIL_URL.format(i), b'x' * 500))
+    cache.put('0', _response_dict(self.DETAIL_URL.format(0), b'y' * 500))
+    cache.close()
+    assert len(list(tmp_path.glob('*.seg'))) == 3
+
+    reader = SegmentCache(tmp_path, readonly=True)
+    assert reader.get('1')[1]['body'] == b'x' * 500
+    (first_segment,) = reader.index.execute("SELECT segment FROM responses WHERE fingerprint = '1'").fetchone()
+    cache = SegmentCache(tmp_path, compress=False, segment_bytes=2048)
+    assert cache.compact(min_dead_ratio=0.1) > 0
+    cache.close()
+    # Only the first segment was half dead
+    assert not (tmp_path / first_segment).exists()
+    assert len(list(tmp_path.glob('*.seg'))) == 3
+    # Readers find the moved records, and the records stored again are kept
+    assert reader.get('0')[1]['body'] == b'y' * 500
+    for i in range(1, 4):
+      assert reader.get(str(i))[1]['body'] == b'x' * 500
+    reader.close()
+
+
+  def test_iter_responses_during_compaction(self, tmp_path):
+    # Two records per segment
+    cache = SegmentCache(tmp_path, compress=False, segment_bytes=2048)
+    for i in range(4):
+      cache.put(str(i), _response_dict(self.DETAIL_URL.format(i), b'x' * 500))
+    cache.put('2', _response_dict(self.DETAIL_URL.format(2), b'y' * 500))
+    cache.close()
+
+    reader = SegmentCache(tmp_path, readonly=True)
+    responses = reader.iter_responses()
+    assert next(responses)[1].url == self.DETAIL_URL.format(0)
+    # The 2nd segment (of records 2 & 3) is half dead, so record 3 moves to a new segment
+    cache = SegmentCache(tmp_path, compress=False, segment_bytes=2048)
+    assert cache.compact(min_dead_ratio=0.25) > 0
+    cache.close()
+    assert [(r.url, r.body[:1]) for (_, r) in responses] == [
+      (self.DETAIL_URL.format(1), b'x'),
+      (self.DETAIL_URL.format(3), b'x'),
+      (self.DETAIL_URL.format(2), b'y'),
+    ]
+    reader.close()
+
+
+def test_segment_cache_storage(tmp_path):
+  settings = Settings({'HTTPCACHE_DIR': str(tmp_path), 'HTTPCACHE_EXPIRATION_SECS': 0, 'HTTPCACHE_GZIP': True})
+  spider = mock.Mock()
+  spider.name = 'tennisexplorer'
+  spider.crawler.request_fingerprinter = RequestFingerprinter()
+  storage = SegmentCacheStorage(settings)
+  storage.open_spider(spider)
+
+  request = scrapy.Request('https://www.tennisexplorer.com/match-detail/?id=1')
+  assert storage.retrieve_response(spider, request) is None
+  storage.store_response(spider, request, scrapy.http.HtmlResponse(request.url, body=b'<html>1</html>'))
+  cached = storage.retrieve_response(spider, request)
+  assert isinstance(cached, scrapy.http.HtmlResponse)
+  assert cached.body == b'<html>1</html>'
+  assert time.time() - request.meta['cache_timestamp'] < 60
+  storage.close_spider(spider)
+  assert (tmp_path / 'tennisexplorer' / SegmentCache.INDEX).exists()
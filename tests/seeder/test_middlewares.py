@@ -0,0 +1,198 @@
+import datetime
+
+from unittest import mock
+import pytest
+import scrapy
+import sqlalchemy
+
+from seeder.db import upsert_dicts
+from seeder.items import MatchItem
+from seeder.middlewares import FinalizedMatchMiddleware, UrlCacheMiddleware, page_scraped
+from seeder.models import BaseModel, Crawl, CrawledUrl, Match, MatchOdds, MatchOddsSeries, MatchSurface
+from seeder.parsers import PARSERS_VERSION
+from seeder.pipelines import DatabasePipeline
+from seeder.spiders.tennis_explorer_spider import TennisExplorerSpider
+from seeder.util.fingerprint import FINGERPRINT_META_KEY, UNCHANGED_META_KEY, VOLATILE_PATTERNS, fingerprint_body
+
+from tests.seeder.test_db import wait
+
+
+@pytest.fixture
+def engine():
+  return sqlalchemy.create_engine('sqlite://')
+
+
+def _rows(engine):
+  with sqlalchemy.orm.Session(engine) as session:
+    return [r.to_dict() for r in session.query(CrawledUrl).all()]
+
+
+class TestUrlCacheMiddleware:
+
+  URL = "https://www.tennisexplorer.com/match-detail/?id=1"
+
+  def _process(self, middleware, spider):
+    response = scrapy.http.HtmlResponse(self.URL, body=b'')
+    middleware.process_spider_input(response, spider)
+    return list(middleware.process_spider_output(response, [1, 2], spider))
+
+  def test_write_through(self, engine):
+    spider = TennisExplorerSpider()
+    middleware = UrlCacheMiddleware(engine=engine)
+    middleware.spider_opened(spider)
+    assert self._process(middleware, spider) == [1, 2]
+
+    rows = _rows(engine)
+    assert len(rows) == 1
+    assert rows[0]['is_crawled']
+    assert rows[0]['last_crawl_id'] == spider.crawl_id
+    middleware.spider_closed(spider)
+
+  def test_write_behind(self, engine):
+    spider = TennisExplorerSpider()
+    middleware = UrlCacheMiddleware(engine=engine, flush_interval=60)
+    middleware.spider_opened(spider)
+    assert self._process(middleware, spider) == [1, 2]
+    assert len(middleware.buffer) == 1
+    assert _rows(engine) == []
+
+    middleware.spider_idle(spider)
+    rows = _rows(engine)
+    assert len(rows) == 1
+    assert rows[0]['url_id'] == CrawledUrl.surrogate_key(self.URL)
+    assert rows[0]['path'] == '/match-detail/'
+    assert rows[0]['is_crawled']
+    assert rows[0]['last_crawl_id'] == spider.crawl_id
+
+    middleware.spider_closed(spider)
+    assert not middleware.flush_loop.running
+
+  def test_write_behind_flush_size(self, engine):
+    spider = TennisExplorerSpider()
+    middleware = UrlCacheMiddleware(engine=engine, flush_interval=60, flush_size=1)
+    middleware.spider_opened(spider)
+    response = scrapy.http.HtmlResponse(self.URL, body=b'')
+    middleware.process_spider_input(response, spider)
+    rows = _rows(engine)
+    assert len(rows) == 1
+    assert not rows[0]['is_crawled']
+    middleware.spider_closed(spider)
+
+  def test_writer_threads_are_shared_with_the_pipeline(self, tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'seeder.db'}")
+    spider = TennisExplorerSpider()
+    pipeline = DatabasePipeline(engine=engine, writer_threads=2, flush_interval=None)
+    middleware = UrlCacheMiddleware(engine=engine, writer_threads=2)
+    # A single sqlite writer for both
+    assert middleware.writer_pool is pipeline.writer_pool
+    assert middleware.writer_pool.threadpool.max == 1
+    pipeline.open_spider(spider)
+    middleware.spider_opened(spider)
+    assert self._process(middleware, spider) == [1, 2]
+    wait(pipeline.close_spider(spider))
+    assert middleware.writer_pool.is_started
+    wait(middleware.spider_closed(spider))
+    assert not middleware.writer_pool.is_started
+
+    rows = _rows(engine)
+    assert len(rows) == 1
+    assert rows[0]['is_crawled']
+
+  def test_fingerprint(self, engine):
+    BaseModel.metadata.create_all(engine)
+    stored = fingerprint_body(b'<p>1</p><script>var t = 1;</script>', VOLATILE_PATTERNS, version=PARSERS_VERSION)
+    upsert_dicts(sqlalchemy.orm.sessionmaker(bind=engine), CrawledUrl, [
+      {**CrawledUrl.insert_payload(self.URL), 'is_crawled': True, 'body_fingerprint': stored},
+    ])
+    spider = TennisExplorerSpider()
+    stats = mock.MagicMock()
+    middleware = UrlCacheMiddleware(engine=engine, fingerprint_patterns=VOLATILE_PATTERNS, stats=stats)
+    middleware.signals = mock.MagicMock()
+    middleware.spider_opened(spider)
+    item = MatchItem(match_number=1)
+
+    def _crawl(body, result):
+      response = scrapy.http.HtmlResponse(self.URL, body=body, request=scrapy.Request(self.URL))
+      middleware.process_spider_input(response, spider)
+      assert list(middleware.process_spider_output(response, result, spider)) == result
+      return response
+
+    # The stored fingerprint was preloaded when the spider was opened
+    response = _crawl(b'<p>1</p><script>var t = 2;</script>', [])
+    assert response.meta[UNCHANGED_META_KEY]
+    # The fingerprint of a changed page is passed on once all its items were processed
+    response = _crawl(b'<p>2</p>', [item, scrapy.Request(self.URL)])
+    assert not response.meta[UNCHANGED_META_KEY]
+    middleware.signals.send_catch_log.assert_not_called()
+    middleware.item_scraped(item, response, spider)
+    middleware.signals.send_catch_log.assert_called_once_with(
+      signal=page_scraped, url=self.URL, fingerprint=response.meta[FINGERPRINT_META_KEY],
+    )
+    # ...but not if any of its items failed
+    response = _crawl(b'<p>3</p>', [item])
+    middleware.item_failed(item, response, spider, exception=ValueError())
+    assert middleware.signals.send_catch_log.call_count == 1
+    assert middleware.pages == {}
+    middleware.spider_closed(spider)
+
+    # The fingerprint is not stored by the middleware
+    assert [row['body_fingerprint'] for row in _rows(engine)] == [stored]
+    assert [c.args[0] for c in stats.inc_value.call_args_list] == [
+      'seeder/fingerprint/hit',
+      'seeder/fingerprint/miss',
+      'seeder/fingerprint/miss',
+    ]
+
+
+class TestFinalizedMatchMiddleware:
+
+  def _populate(self, engine):
+    BaseModel.metadata.create_all(engine)
+    sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine)
+    long_ago = datetime.datetime(2000, 1, 1)
+    matches = {
+      1: {'is_win_p1': True, 'match_surface': MatchSurface.clay, 'issued_at': long_ago},
+      2: {'is_win_p1': None, 'match_surface': MatchSurface.clay, 'issued_at': long_ago},
+      3: {'is_win_p1': True, 'match_surface': MatchSurface.unknown, 'issued_at': long_ago},
+      4: {'is_win_p1': True, 'match_surface': MatchSurface.clay, 'issued_at': datetime.datetime.utcnow()},
+    }
+    upsert_dicts(sessionmaker, Match, [{
+      'match_id': Match.surrogate_key(n),
+      'match_number': n,
+      'is_win_p1': m['is_win_p1'],
+      'match_surface': m['match_surface'],
+    } for (n, m) in matches.items()])
+    upsert_dicts(sessionmaker, MatchOdds, [{
+      **MatchOdds.make(match_number=n, issued_by='bookie', issued_at=m['issued_at']).to_partial_dict(),
+      'is_closing': True,
+    } for (n, m) in matches.items()])
+
+  def test_process_spider_output(self, engine):
+    self._populate(engine)
+    spider = mock.MagicMock()
+    stats = mock.MagicMock()
+    middleware = FinalizedMatchMiddleware(engine=engine, stats=stats)
+    middleware.spider_opened(spider)
+    assert middleware.finalized == {1}
+
+    result = [
+      scrapy.Request("https://www.tennisexplorer.com/match-detail/?id=1&timezone=+0"),
+      scrapy.Request("https://www.tennisexplorer.com/match-detail/?id=2&timezone=+0"),
+      scrapy.Request("https://www.tennisexplorer.com/results/?id=1"),
+      {'match_number': 1},
+    ]
+    response = scrapy.http.HtmlResponse("https://www.tennisexplorer.com/results/", body=b'')
+    actual = list(middleware.process_spider_output(response, result, spider))
+    assert actual == result[1:]
+    stats.inc_value.assert_called_once_with('seeder/finalized_matches/skipped', spider=spider)
+
+  def test_odds_series_closing_lines(self, engine):
+    self._populate(engine)
+    sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine)
+    upsert_dicts(sessionmaker, Match, [{'match_id': Match.surrogate_key(5), 'match_number': 5, 'is_win_p1': True, 'match_surface': MatchSurface.clay}])
+    upsert_dicts(sessionmaker, MatchOddsSeries, [MatchOddsSeries.make_row(**MatchOddsSeries.payload_from_ticks([
+      {'match_number': 5, 'issued_by': 'bookie', 'issued_at': datetime.datetime(2000, 1, 1), 'odds_p1': 1.5},
+    ]))])
+    middleware = FinalizedMatchMiddleware(engine=engine)
+    middleware.spider_opened(mock.MagicMock())
+    assert middleware.finalized == {1, 5}
@@ -1,6 +1,10 @@
 import datetime
 
-from seeder.models import PlayerType, Player, Match
+import pytest
+import sqlalchemy
+
+from seeder.db import upsert_row
+from seeder.models import BaseModel, PlayerType, Player, Match, MatchOdds, MatchOddsSeries
 
 
 class TestPlayer:
@@ -73,3 +77,48 @@ class TestMatch:
       }
     }]
     assert [r.to_partial_dict() for r in actual] == expected
+
+
+class TestMakeRows:
+
+  @pytest.mark.parametrize('model, payload', [
+    (Player, {'slug': '/doubles-team/o-brien/palmer/'}),
+    (Player, {'slug': '/player/c/', 'name': 'C'}),
+    (Match, {'match_number': 1, 'p1': '/doubles-team/a/b/', 'p2': '/player/c/', 'match_type': PlayerType.double}),
+    (Match, {'match_number': 2, 'p1': None, 'tournament': '/indian-wells/2000/atp-men/'}),
+    (MatchOdds, {'match_number': 1, 'issued_by': 'b', 'issued_at': datetime.datetime(2000, 3, 19), 'odds_p1': 1.5}),
+  ])
+  def test_rows_match_records(self, model, payload):
+    records = model.make_with_dependencies(**payload)
+    rows = model.make_rows_with_dependencies(**payload)
+    assert rows == [(type(r), r.to_partial_dict()) for r in records]
+
+
+class TestMatchOddsSeries:
+
+  TICKS = [
+    {'match_number': 1, 'issued_by': 'b', 'issued_at': datetime.datetime(2022, 6, 19, 9, 10), 'odds_p1': 1.61, 'odds_p2': 2.2},
+    {'match_number': 1, 'issued_by': 'b', 'issued_at': datetime.datetime(2022, 6, 19, 4, 34), 'odds_p1': 1.72, 'odds_p2': None, 'is_opening': True},
+    {'match_number': 1, 'issued_by': 'b', 'issued_at': datetime.datetime(2022, 6, 19, 9, 51), 'odds_p1': 1.53, 'odds_p2': 2.37},
+  ]
+
+  def test_read_ticks(self):
+    engine = sqlalchemy.create_engine('sqlite://')
+    BaseModel.metadata.create_all(engine)
+    sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine)
+    payload = MatchOddsSeries.payload_from_ticks(self.TICKS)
+    assert payload['num_ticks'] == 3
+    assert payload['opening_at'] == datetime.datetime(2022, 6, 19, 4, 34)
+    for (model, row) in MatchOddsSeries.make_rows_with_dependencies(**payload):
+      upsert_row(sessionmaker, model, row)
+
+    ticks = MatchOddsSeries.read_ticks(sessionmaker, match_numbers=[1])
+    assert [(t['issued_at'].hour, t['index'], t['index_rev'], t['is_opening'], t['is_closing']) for t in ticks] == [
+      (4, 1, 3, True, False),
+      (9, 2, 2, False, False),
+      (9, 3, 1, False, True),
+    ]
+    assert [(t['odds_p1'], t['odds_p2']) for t in ticks] == [(1.72, None), (1.61, 2.2), (1.53, 2.37)]
+    with sessionmaker() as session:
+      assert session.get(MatchOddsSeries, MatchOddsSeries.surrogate_key(1, 'b')).to_ticks() == ticks
+    assert MatchOddsSeries.read_ticks(sessionmaker, match_numbers=[2]) == []
@@ -0,0 +1,202 @@
+import datetime
+
+from unittest import mock
+import pytest
+import sqlalchemy
+from scrapy.exceptions import DropItem
+
+from seeder.db import upsert_dicts
+from seeder.items import MatchItem, MatchOddsItem
+from seeder.models import BaseModel, CrawledUrl, Match, MatchOdds, Player, PlayerType
+from seeder.pipelines import ColumnarFilePipeline, DatabasePipeline
+
+from tests.seeder.test_db import wait
+
+
+@pytest.fixture
+def engine():
+  return sqlalchemy.create_engine('sqlite://')
+
+
+URL = "https://www.tennisexplorer.com/match-detail/?id=1"
+
+
+def _fingerprints(engine):
+  with sqlalchemy.orm.Session(engine) as session:
+    return dict(session.execute(sqlalchemy.select(CrawledUrl.url, CrawledUrl.body_fingerprint)).all())
+
+
+def _count(engine, model):
+  with sqlalchemy.orm.Session(engine) as session:
+    return session.query(model).count()
+
+
+class TestDatabasePipeline:
+
+  ITEMS = [
+    MatchItem(match_number=1, p1='/player/a/', p2='/player/b/', match_at=datetime.datetime(2022, 1, 1)),
+    MatchOddsItem(match_number=1, issued_by='bookie', issued_at=datetime.datetime(2022, 1, 1), odds_p1=1.5),
+    MatchOddsItem(match_number=2, issued_by='bookie', issued_at=datetime.datetime(2022, 1, 1), odds_p1=2.5),
+  ]
+
+  @pytest.mark.parametrize('key_cache_size', [0, 100])
+  @pytest.mark.parametrize('write_mode', ['record', 'bulk'])
+  def test_process_item(self, engine, write_mode, key_cache_size):
+    pipeline = DatabasePipeline(engine=engine, write_mode=write_mode, flush_interval=None, key_cache_size=key_cache_size)
+    spider = mock.MagicMock()
+    pipeline.open_spider(spider)
+    for item in self.ITEMS:
+      assert pipeline.process_item(item, spider) is item
+    pipeline.close_spider(spider)
+
+    assert _count(engine, Player) == 2
+    assert _count(engine, Match) == 2
+    assert _count(engine, MatchOdds) == 2
+    spider.logger.error.assert_not_called()
+
+  @pytest.mark.parametrize('write_mode', ['record', 'bulk'])
+  def test_key_cache_skips_existing_dependencies(self, engine, write_mode):
+    spider = mock.MagicMock()
+    for _ in range(2):
+      pipeline = DatabasePipeline(engine=engine, write_mode=write_mode, flush_interval=None, key_cache_size=100)
+      pipeline.open_spider(spider)
+      for item in self.ITEMS:
+        pipeline.process_item(item, spider)
+      pipeline.close_spider(spider)
+
+    # The 2nd crawl has every Player and Match dependency preloaded in the cache
+    assert pipeline.num_skipped == 4
+    assert _count(engine, Match) == 2
+    spider.logger.error.assert_not_called()
+
+  @pytest.mark.parametrize('write_mode', ['record', 'bulk'])
+  def test_process_item_on_writer_threads(self, tmp_path, write_mode):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'seeder.db'}")
+    pipeline = DatabasePipeline(engine=engine, write_mode=write_mode, flush_interval=None, writer_threads=4)
+    assert pipeline.writer_pool.threadpool.max == 1
+    spider = mock.MagicMock()
+    pipeline.open_spider(spider)
+    deferreds = [pipeline.process_item(item, spider) for item in self.ITEMS]
+    wait(pipeline.close_spider(spider))
+
+    assert [wait(d) for d in deferreds] == self.ITEMS
+    assert _count(engine, Player) == 2
+    assert _count(engine, Match) == 2
+    assert _count(engine, MatchOdds) == 2
+    spider.logger.error.assert_not_called()
+
+  @pytest.mark.parametrize('write_mode', ['record', 'bulk'])
+  def test_page_scraped_stores_fingerprint(self, engine, write_mode):
+    pipeline = DatabasePipeline(engine=engine, write_mode=write_mode, flush_interval=None)
+    spider = mock.MagicMock()
+    pipeline.open_spider(spider)
+    pipeline.process_item(self.ITEMS[0], spider)
+    pipeline.page_scraped(URL, 'f1')
+    # In bulk mode, the fingerprint is written after the buffered rows
+    assert _fingerprints(engine) == ({} if write_mode == 'bulk' else {URL: 'f1'})
+    pipeline.close_spider(spider)
+    assert _fingerprints(engine) == {URL: 'f1'}
+    assert _count(engine, Match) == 1
+
+  @pytest.mark.parametrize('write_mode', ['record', 'bulk'])
+  def test_failed_rows(self, engine, write_mode):
+    pipeline = DatabasePipeline(engine=engine, write_mode=write_mode, flush_interval=None)
+    spider = mock.MagicMock()
+    pipeline.open_spider(spider)
+    item = MatchItem(match_number=3, match_at='not-a-date')
+    if write_mode == 'record':
+      # The item is dropped, so its page's fingerprint is never passed on
+      with pytest.raises(DropItem):
+        pipeline.process_item(item, spider)
+    else:
+      pipeline.process_item(item, spider)
+      pipeline.page_scraped(URL, 'f1')
+    pipeline.close_spider(spider)
+    assert _fingerprints(engine) == {}
+
+  def test_backfill_load_mode(self, tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'seeder.db'}")
+    index_names = lambda: set(
+      index['name']
+      for table in ['players', 'matches', 'match_odds']
+      for index in sqlalchemy.inspect(engine).get_indexes(table)
+    )
+    pipeline = DatabasePipeline(engine=engine, write_mode='bulk', flush_interval=None, load_mode='backfill')
+    spider = mock.MagicMock()
+    pipeline.open_spider(spider)
+    assert index_names() == set()
+    # Only the indexes of the bulk written tables are dropped
+    assert {i['name'] for i in sqlalchemy.inspect(engine).get_indexes('frontier')} >= {'ix_frontier_status', 'ix_frontier_lease_id'}
+    for item in self.ITEMS:
+      pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+
+    assert 'ix_match_odds_issued_at' in index_names()
+    assert _count(engine, MatchOdds) == 2
+    with engine.connect() as conn:
+      assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+    spider.logger.error.assert_not_called()
+
+  def test_backfill_load_mode_without_managing_indexes(self, tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'seeder.db'}")
+    BaseModel.metadata.create_all(engine)
+    pipeline = DatabasePipeline(engine=engine, write_mode='bulk', flush_interval=None, load_mode='backfill', manage_indexes=False)
+    spider = mock.MagicMock()
+    pipeline.open_spider(spider)
+    # The indexes are left to the backfill command
+    assert sqlalchemy.inspect(engine).get_indexes('match_odds')
+    for item in self.ITEMS:
+      pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+    assert _count(engine, MatchOdds) == 2
+    spider.logger.error.assert_not_called()
+
+  def test_invalid_write_mode(self, engine):
+    with pytest.raises(ValueError):
+      DatabasePipeline(engine=engine, write_mode='unknown')
+
+
+class TestColumnarFilePipeline:
+
+  ITEMS = TestDatabasePipeline.ITEMS + [
+    MatchItem(match_number=3, p1='/doubles-team/a/c/', p2='/player/b/', match_at=datetime.datetime(2022, 1, 2), match_type=PlayerType.double),
+    MatchOddsItem(match_number=3, issued_by='bookie', issued_at=datetime.datetime(2021, 12, 31), odds_p1=1.8),
+  ]
+
+  @pytest.mark.parametrize('file_format', ['parquet', 'arrow'])
+  def test_rows_load_into_database(self, tmp_path, engine, file_format):
+    pytest.importorskip('pyarrow')
+    from seeder.util import columnar
+
+    pipeline = ColumnarFilePipeline(directory=str(tmp_path), file_format=file_format, row_group_size=2)
+    spider = mock.MagicMock()
+    pipeline.open_spider(spider)
+    for item in self.ITEMS:
+      assert pipeline.process_item(item, spider) is item
+    pipeline.close_spider(spider)
+
+    assert sorted(p.name for p in (tmp_path / 'matches').iterdir()) == [
+      'date=2022-01-01',
+      'date=2022-01-02',
+      f'date={columnar.NULL_PARTITION}',
+    ]
+    # Odds are partitioned by the date of their match, if known, else by their issued_at
+    assert sorted(p.name for p in (tmp_path / 'match_odds').iterdir()) == ['date=2022-01-01', 'date=2022-01-02']
+    # Skeleton dependencies are written once per key
+    players = columnar.read_rows(str(tmp_path), Player)
+    assert len(players) == 4
+
+    BaseModel.metadata.create_all(engine)
+    sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine)
+    for model in ColumnarFilePipeline.MODELS:
+      for rows in columnar.iter_rows(str(tmp_path), model, batch_size=1):
+        assert len(rows) == 1
+        upsert_dicts(sessionmaker, model, rows)
+    assert _count(engine, Player) == 4
+    assert _count(engine, Match) == 3
+    assert _count(engine, MatchOdds) == 3
+    with sessionmaker() as session:
+      match = session.get(Match, Match.surrogate_key(3))
+      assert match.match_type == PlayerType.double
+      assert match.p1 == Player.surrogate_key('/doubles-team/a/c/')
+      assert match.created_at is not None
@@ -0,0 +1,13 @@
+from seeder.util.fingerprint import fingerprint_body, normalize_body
+
+def test_normalize_body():
+  assert normalize_body(b'<p>a</p>\n  <p>b</p>\n') == b'<p>a</p> <p>b</p>'
+  assert normalize_body(b'<p>a</p><script type="x">var t = 1;\n</script><!-- 12:00 -->') == b'<p>a</p>'
+  assert normalize_body(b'<p>a</p><!-- 12:00 -->', patterns=[]) == b'<p>a</p><!-- 12:00 -->'
+
+def test_fingerprint_body():
+  assert fingerprint_body(b'<p>a</p><script>1</script>') == fingerprint_body(b'<p>a</p>\n<script>2</script>')
+  assert fingerprint_body(b'<p>a</p>') != fingerprint_body(b'<p>b</p>')
+  # A new parsers' version changes the fingerprint of the same page
+  assert fingerprint_body(b'<p>a</p>', version=1) == fingerprint_body(b'<p>a</p>', version=1)
+  assert fingerprint_body(b'<p>a</p>', version=2) != fingerprint_body(b'<p>a</p>', version=1)
@@ -0,0 +1,52 @@
+import os
+
+from seeder.util.metrics import Histogram, MetricRegistry
+
+
+def test_histogram():
+  histogram = Histogram([1.0, 2.0, 4.0])
+  assert histogram.quantile(0.5) is None
+  for value in [0.5, 1.0, 1.5, 3.0, 10.0]:
+    histogram.observe(value)
+  # Buckets are upper inclusive, with the last count above the largest bucket
+  assert histogram.counts == [2, 1, 1, 1]
+  assert histogram.cumulative_counts() == [2, 3, 4, 5]
+  assert histogram.quantile(0.2) == 0.5
+  assert histogram.quantile(0.5) == 1.5
+  assert histogram.quantile(0.99) == 4.0
+  summary = histogram.summary()
+  assert (summary['count'], summary['sum'], summary['mean']) == (5, 16.0, 3.2)
+
+
+def test_registry_to_prometheus():
+  registry = MetricRegistry()
+  registry.histogram('seeder_parse_seconds', "Parse time.", [0.1, 1.0])
+  registry.counter('seeder_rows_total', "Rows.")
+  registry.observe('seeder_parse_seconds', 0.05, endpoint='results')
+  registry.observe('seeder_parse_seconds', 0.5, endpoint='results')
+  registry.inc('seeder_rows_total', 3, model='Match')
+  registry.inc('seeder_rows_total', model='Match')
+  assert registry.to_prometheus({'spider': 'tennisexplorer'}).splitlines() == [
+    '# HELP seeder_parse_seconds Parse time.',
+    '# TYPE seeder_parse_seconds histogram',
+    'seeder_parse_seconds_bucket{spider="tennisexplorer",endpoint="results",le="0.1"} 1',
+    'seeder_parse_seconds_bucket{spider="tennisexplorer",endpoint="results",le="1.0"} 2',
+    'seeder_parse_seconds_bucket{spider="tennisexplorer",endpoint="results",le="+Inf"} 2',
+    'seeder_parse_seconds_sum{spider="tennisexplorer",endpoint="results"} 0.55',
+    'seeder_parse_seconds_count{spider="tennisexplorer",endpoint="results"} 2',
+    '# HELP seeder_rows_total Rows.',
+    '# TYPE seeder_rows_total counter',
+    'seeder_rows_total{spider="tennisexplorer",model="Match"} 4',
+  ]
+
+
+def test_registry_write_textfile(tmp_path):
+  registry = MetricRegistry()
+  registry.counter('seeder_rows_total', "Rows.")
+  registry.inc('seeder_rows_total', model='Match')
+  path = str(tmp_path / 'textfile' / 'seeder.prom')
+  registry.write_textfile(path)
+  registry.write_textfile(path)
+  with open(path) as f:
+    assert f.read() == registry.to_prometheus()
+  assert os.listdir(tmp_path / 'textfile') == ['seeder.prom']
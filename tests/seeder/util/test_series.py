@@ -0,0 +1,20 @@
+import datetime
+import struct
+
+from seeder.util.series import pack_floats, pack_timestamps, unpack_floats, unpack_timestamps
+
+def test_pack_timestamps():
+  timestamps = [datetime.datetime(1969, 12, 31, 23, 59), datetime.datetime(2022, 6, 19, 14, 25, 0, 1)]
+  data = pack_timestamps(timestamps)
+  assert len(data) == 16
+  assert unpack_timestamps(data) == timestamps
+
+def test_pack_floats():
+  values = [1.53, None, 2.37]
+  data = pack_floats(values)
+  assert data[:8] == struct.pack('<d', 1.53)
+  assert unpack_floats(data) == values
+
+def test_pack_empty():
+  assert unpack_timestamps(pack_timestamps([])) == []
+  assert unpack_floats(pack_floats([])) == []